@@ -0,0 +1,107 @@
+import asyncio
+import functools
+import weakref
+from contextlib import asynccontextmanager
+from main import Bank
+
+'''
+asyncio front end for the Bank
+
+Every Bank call does blocking storage I/O, so AsyncBank runs them in an
+executor and the event loop keeps serving other requests meanwhile. Requests
+touching the same account are serialized with an asyncio lock per account,
+requests on unrelated accounts run concurrently.
+'''
+
+class AsyncBank():
+    def __init__(self, bank=None, executor=None):
+        '''
+        AsyncBank: Coroutine versions of the Bank operations, e.g for an ASGI app
+
+        Args:
+            bank: The Bank doing the work, defaults to a new Bank
+
+            executor: concurrent.futures executor running the blocking calls,
+            defaults to the event loop's thread pool
+        '''
+        self.bank = bank if bank is not None else Bank("The Royal Bank")
+        self.executor = executor
+        # Locks are dropped once no request holds or waits on them
+        self._locks = weakref.WeakValueDictionary()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def _lock(self, acc_no):
+        lock = self._locks.get(acc_no)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[acc_no] = lock
+        return lock
+
+    @asynccontextmanager
+    async def locked(self, *account_numbers):
+        '''
+        locked: Holds the locks of the given accounts, always taken in account number
+        order so two transfers between the same accounts never deadlock
+        '''
+        locks = [self._lock(acc_no) for acc_no in sorted({int(acc_no) for acc_no in account_numbers})]
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    async def create_account(self, owner_name, initial_deposit, pin, contact_info):
+        return await self._run(self.bank.create_account, owner_name, initial_deposit, pin, contact_info)
+
+    async def find_account(self, account_number):
+        return await self._run(self.bank.find_account, account_number)
+
+    async def get_receipt(self, transaction_id):
+        return await self._run(self.bank.get_receipt, transaction_id)
+
+    async def authenticate(self, account_number, pin):
+        async with self.locked(account_number):
+            return await self._run(self.bank.authenticate, account_number, pin)
+
+    async def login(self, account_number, pin):
+        async with self.locked(account_number):
+            return await self._run(self.bank.login, account_number, pin)
+
+    def session_account(self, token):
+        # Only a dictionary lookup, no need for the executor
+        return self.bank.session_account(token)
+
+    async def deposit(self, account_number, amount, idempotency_key=None):
+        '''
+        deposit: Deposits amount into the account
+
+        returns formatted string detailing amount deposited
+        '''
+        async with self.locked(account_number):
+            account = await self._run(self.bank.find_account, account_number)
+            if account is None:
+                return "Account not found. Please create an account"
+            return await self._run(account.deposit, amount, idempotency_key)
+
+    async def withdraw(self, account_number, amount, idempotency_key=None):
+        '''
+        withdraw: Withdraws amount from the account
+
+        returns formatted string detailing amount withdrawn
+        '''
+        async with self.locked(account_number):
+            account = await self._run(self.bank.find_account, account_number)
+            if account is None:
+                return "Account not found. Please create an account"
+            return await self._run(account.withdraw, amount, idempotency_key)
+
+    async def transfer(self, from_account, to_account, amount, idempotency_key=None):
+        async with self.locked(from_account, to_account):
+            return await self._run(self.bank.transfer, from_account, to_account, amount, idempotency_key)
@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from main import Bank, hash_pin
+from storage import DURABILITY_LEVELS, JournalStore, JsonBackend
+from sqlite_backend import SQLiteBackend
+
+'''
+Benchmarks the core Bank and Account operations on synthetic books
+
+Usage: python benchmark.py [--sizes 1000 100000 1000000] [--backend json sqlite]
+                           [--ops 1000] [--output results.json] [--baseline baseline.json]
+
+Every book is built in its own temporary directory. Results are printed as a
+table and can be written as JSON, then compared against an earlier run.
+Everything runs offline, bytes read and written come from /proc/self/io.
+'''
+
+PIN = "1234"
+OPERATIONS = ["create_account", "authenticate", "find_account", "deposit",
+              "withdraw", "transfer", "save_data", "load_data"]
+
+
+def make_backend(kind, directory, name="bank", durability="async"):
+    if kind == "sqlite":
+        return SQLiteBackend(os.path.join(directory, f"{name}.db"))
+    return JsonBackend(JournalStore(os.path.join(directory, f"{name}_users.json"), durability=durability),
+                       JournalStore(os.path.join(directory, f"{name}_utils.json"), durability=durability),
+                       history_dir=os.path.join(directory, f"{name}_history"))
+
+
+def io_counters():
+    '''
+    io_counters: Bytes this process has read and written so far, (None, None) off Linux
+    '''
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(latencies, fraction):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(name, calls):
+    '''
+    measure: Times every call and collects latency, I/O and memory figures
+
+    Args:
+        name: Operation name
+
+        calls: Iterable of zero argument callables
+
+    returns dict
+    '''
+    read_before, written_before = io_counters()
+    latencies = []
+    start = time.perf_counter()
+    for call in calls:
+        began = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - began)
+    seconds = time.perf_counter() - start
+    read_after, written_after = io_counters()
+
+    return {
+        "operation": name,
+        "count": len(latencies),
+        "seconds": round(seconds, 4),
+        "throughput": round(len(latencies) / seconds, 1) if seconds else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "bytes_read": read_after - read_before if read_after is not None else None,
+        "bytes_written": written_after - written_before if written_after is not None else None,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def build_book(bank, size, batch_size=10000):
+    '''
+    build_book: Fills bank with size synthetic accounts
+    '''
+    pin = hash_pin(PIN)
+    customers = ({
+        "name": f"Customer {index}",
+        "initial_deposit": 1000 + index % 9000,
+        "pin": pin,
+        "contact_info": {"phone": f"555{index:07d}", "address": f"{index} Main Street"}
+    } for index in range(size))
+    created, _ = bank.create_accounts(customers, batch_size=batch_size, workers=0, hash_pins=False)
+    return created
+
+
+def run_size(kind, size, ops, seed=0, durability="async"):
+    '''
+    run_size: Benchmarks every operation against a book of size accounts
+
+    returns list of result dicts
+    '''
+    rng = random.Random(seed)
+    pin = hash_pin(PIN)
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="bank-bench-") as directory:
+        bank = Bank("Benchmark", backend=make_backend(kind, directory, durability=durability),
+                    receipt_dir=os.path.join(directory, "receipts"))
+        started = time.perf_counter()
+        acc_nos = build_book(bank, size)
+        print(f"  built {size} accounts in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+        def pick():
+            return rng.choice(acc_nos)
+
+        def pair():
+            source, destination = rng.sample(acc_nos, 2)
+            return source, destination
+
+        results.append(measure("create_account", (
+            lambda index=index: bank.create_account(f"New {index}", 500, pin, {"phone": "555"})
+            for index in range(ops))))
+        results.append(measure("authenticate", (
+            lambda acc_no=pick(): bank.authenticate(acc_no, pin) for _ in range(ops))))
+        results.append(measure("find_account", (
+            lambda acc_no=pick(): bank.find_account(acc_no) for _ in range(ops))))
+        results.append(measure("deposit", (
+            lambda acc_no=pick(): bank.find_account(acc_no).deposit(10) for _ in range(ops))))
+        results.append(measure("withdraw", (
+            lambda acc_no=pick(): bank.find_account(acc_no).withdraw(5) for _ in range(ops))))
+        results.append(measure("transfer", (
+            lambda accounts=pair(): bank.transfer(accounts[0], accounts[1], 1) for _ in range(ops))))
+
+        export_file = os.path.join(directory, "export")
+        results.append(measure("save_data", [lambda: bank.save_data(export_file)]))
+        restored = Bank("Restore", backend=make_backend(kind, directory, "restore", durability),
+                        receipt_dir=os.path.join(directory, "restore_receipts"))
+        results.append(measure("load_data", [lambda: restored.load_data(export_file)]))
+
+    for result in results:
+        result.update({"backend": kind, "size": size})
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    compare: Matches results with a baseline run by backend, size and operation
+
+    A result regressed when its throughput fell, or its p99 latency rose, by more
+    than tolerance
+
+    returns list of (result, baseline result, throughput ratio, p99 ratio, regressed)
+    '''
+    previous = {(result["backend"], result["size"], result["operation"]): result
+                for result in baseline["results"]}
+    rows = []
+    for result in results:
+        old = previous.get((result["backend"], result["size"], result["operation"]))
+        if old is None or not old["throughput"] or not old["p99_ms"]:
+            continue
+        throughput_ratio = (result["throughput"] or 0) / old["throughput"]
+        p99_ratio = result["p99_ms"] / old["p99_ms"]
+        regressed = throughput_ratio < 1 - tolerance or p99_ratio > 1 + tolerance
+        rows.append((result, old, throughput_ratio, p99_ratio, regressed))
+    return rows
+
+
+def print_results(results):
+    print(f"{'backend':8} {'size':>8} {'operation':15} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} "
+          f"{'read KB':>10} {'written KB':>11} {'peak MB':>8}")
+    for result in results:
+        read = result["bytes_read"] // 1024 if result["bytes_read"] is not None else "-"
+        written = result["bytes_written"] // 1024 if result["bytes_written"] is not None else "-"
+        print(f"{result['backend']:8} {result['size']:>8} {result['operation']:15} "
+              f"{result['throughput']:>10} {result['p50_ms']:>9} {result['p99_ms']:>9} "
+              f"{read:>10} {written:>11} {result['peak_rss_mb']:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the core Bank operations")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000],
+                        help="Number of accounts in each synthetic book")
+    parser.add_argument("--backend", nargs="+", choices=["json", "sqlite"], default=["json", "sqlite"])
+    parser.add_argument("--ops", type=int, default=1000, help="Calls timed per operation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--durability", choices=DURABILITY_LEVELS, default="async",
+                        help="Journal durability of the json backend")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against results written earlier with --output")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown before a result counts as a regression")
+    args = parser.parse_args(argv)
+
+    results = []
+    for kind in args.backend:
+        for size in args.sizes:
+            print(f"{kind}: {size} accounts", file=sys.stderr)
+            results.extend(run_size(kind, size, args.ops, args.seed, args.durability))
+    print_results(results)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "ops": args.ops,
+        "durability": args.durability,
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, args.tolerance)
+        print()
+        print(f"{'backend':8} {'size':>8} {'operation':15} {'ops/s ratio':>12} {'p99 ratio':>10}")
+        for result, _, throughput_ratio, p99_ratio, regressed in rows:
+            print(f"{result['backend']:8} {result['size']:>8} {result['operation']:15} "
+                  f"{throughput_ratio:>12.2f} {p99_ratio:>10.2f}{'  REGRESSION' if regressed else ''}")
+        if any(row[4] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
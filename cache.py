@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+'''
+Bounded LRU caches used by the Bank, e.g to index accounts by account number
+'''
+
+class LRUCache():
+    def __init__(self, max_size=1024):
+        '''
+        LRUCache: Dictionary that evicts the least recently used entry once full
+
+        Every entry is stored with the version it was loaded at. A lookup with a
+        different version is treated as a miss and the stale entry is dropped.
+        Safe to share between threads.
+
+        Args:
+            max_size(int): Maximum number of entries kept in memory
+        '''
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, entry_version = entry
+            if entry_version != version:
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, version=None):
+        with self._lock:
+            self._entries[key] = (value, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[0] if entry else None
+
+    def values(self):
+        with self._lock:
+            return [value for value, _ in self._entries.values()]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TTLCache(LRUCache):
+    def __init__(self, max_size=1024, ttl=3600.0):
+        '''
+        TTLCache: LRUCache whose entries also expire ttl seconds after they were put
+
+        Args:
+            max_size(int): Maximum number of entries kept in memory
+
+            ttl(float): Default lifetime of an entry in seconds
+        '''
+        super().__init__(max_size)
+        self.ttl = ttl
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        super().put(key, value, time.monotonic() + (ttl if ttl is not None else self.ttl))
@@ -0,0 +1,78 @@
+import atexit
+import threading
+
+'''
+Background checkpoints for the journal stores
+
+Without them a restart replays every journal record since the last compaction,
+so start up gets slower as the ledger grows. The Checkpointer snapshots each
+store once enough journal has built up, and a restart then loads the latest
+snapshot and replays only what came after it.
+
+Snapshots do not shrink the journal itself. Once it passes compact_bytes the
+store is compacted instead, which folds the journal into the base file and
+truncates it. Writers wait while the base file is written, so the threshold
+keeps this rare.
+'''
+
+class Checkpointer():
+    def __init__(self, stores, interval=30.0, min_bytes=1 << 20, compact_bytes=64 << 20):
+        '''
+        Checkpointer: Thread that periodically writes a snapshot of every store
+
+        Args:
+            stores: JournalStores to checkpoint
+
+            interval(float): Seconds between checks
+
+            min_bytes(int): Journal written since the last snapshot before a new one is taken
+
+            compact_bytes(int): Journal size at which the store is compacted instead
+        '''
+        self.stores = list(stores)
+        self.interval = interval
+        self.min_bytes = min_bytes
+        self.compact_bytes = compact_bytes
+        self.checkpoints = 0
+        self.compactions = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        '''
+        run_once: Compacts every store whose journal is too long and checkpoints
+        every other store with enough new journal
+
+        returns the number of snapshots written
+        '''
+        written = 0
+        for store in self.stores:
+            if store.journal_size() >= self.compact_bytes:
+                store.compact()
+                self.compactions += 1
+            elif store.tail_size() >= self.min_bytes and store.checkpoint():
+                written += 1
+        self.checkpoints += written
+        return written
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="checkpointer", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        '''
+        stop: Stops the thread and takes a last round of checkpoints
+        '''
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            atexit.unregister(self.stop)
+        self.run_once()
@@ -0,0 +1,396 @@
+import ast
+import csv
+import json
+import os
+from transaction_log import TIME_FORMAT, TYPE_CODES
+from money import SCALE
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+'''
+Streaming export and import of the whole book
+
+Accounts and transactions are written as two flat tables, chunk_size rows at a
+time, so memory stays bounded however many accounts and transactions there
+are. Parquet and Arrow IPC need pyarrow, CSV only needs the standard library.
+Loading reads the tables back chunk by chunk with pandas and checks whole
+columns at once.
+
+Amounts are exported in major units, e.g 12.5, so the files read naturally in
+other tools, and converted back to integer minor units on load.
+'''
+
+FORMATS = ("parquet", "arrow", "csv")
+
+ACCOUNT_COLUMNS = ["Name", "Acc_no", "Account Balance", "Other Info", "Created On"]
+TRANSACTION_COLUMNS = ["Acc_no", "Transaction Id", "Time Stamp", "Transaction Type",
+                       "Amount", "Source", "Ending Balance", "Destination"]
+
+if pa is not None:
+    ACCOUNT_SCHEMA = pa.schema([
+        ("Name", pa.string()),
+        ("Acc_no", pa.int64()),
+        ("Account Balance", pa.float64()),
+        ("Other Info", pa.string()),
+        ("Created On", pa.string())
+    ])
+    TRANSACTION_SCHEMA = pa.schema([
+        ("Acc_no", pa.int64()),
+        ("Transaction Id", pa.string()),
+        ("Time Stamp", pa.string()),
+        ("Transaction Type", pa.string()),
+        ("Amount", pa.float64()),
+        ("Source", pa.int64()),
+        ("Ending Balance", pa.float64()),
+        ("Destination", pa.int64())
+    ])
+
+
+class CsvTableWriter():
+    def __init__(self, filename, columns):
+        self.columns = columns
+        self.file = open(filename, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowTableWriter():
+    def __init__(self, filename, columns, schema, file_format="parquet"):
+        '''
+        ArrowTableWriter: Writes chunks of rows as Parquet row groups or Arrow IPC record batches
+        '''
+        self.columns = columns
+        self.schema = schema
+        if file_format == "parquet":
+            self.writer = pq.ParquetWriter(filename, schema)
+        else:
+            self.sink = pa.OSFile(filename, "wb")
+            self.writer = ipc.new_file(self.sink, schema)
+
+    def write(self, rows):
+        columns = {name: [row[index] for row in rows] for index, name in enumerate(self.columns)}
+        self.writer.write_table(pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        if hasattr(self, "sink"):
+            self.sink.close()
+
+
+def open_table(filename, columns, schema, file_format):
+    if file_format == "csv":
+        return CsvTableWriter(filename, columns)
+    return ArrowTableWriter(filename, columns, schema, file_format)
+
+
+def account_row(record):
+    return [
+        record["Account Name"],
+        int(record["Account Number"]),
+        # Division of two integers rounds once, so the float prints as the exact decimal
+        record["Balance"] / SCALE,
+        json.dumps(record["Other info"]),
+        record["Created on"]
+    ]
+
+
+def transaction_row(acc_no, entry):
+    transaction_id, timestamp, transaction_type, amount, source, ending_balance, destination = \
+        (list(entry) + [None])[:7]
+    return [
+        acc_no, str(transaction_id), str(timestamp), transaction_type, amount / SCALE,
+        int(source) if source is not None else None, ending_balance / SCALE,
+        int(destination) if destination is not None else None
+    ]
+
+
+def export_book(backend, filename, file_format="parquet", chunk_size=10000):
+    '''
+    export_book: Streams every account and every transaction in backend to two files
+
+    Accounts go to {filename}.{ext} and transactions, one row per history entry,
+    to {filename}_transactions.{ext}. Parquet and Arrow fall back to CSV when
+    pyarrow is not installed.
+
+    Args:
+        backend: Any storage backend
+
+        filename: File name without extension
+
+        file_format: "parquet", "arrow" or "csv"
+
+        chunk_size(int): Rows held in memory before they are written out
+
+    returns (accounts file, transactions file, accounts written, transactions written)
+    '''
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown export format {file_format}")
+    if pa is None:
+        file_format = "csv"
+    accounts_file = f"{filename}.{file_format}"
+    transactions_file = f"{filename}_transactions.{file_format}"
+    accounts = open_table(accounts_file, ACCOUNT_COLUMNS,
+                          ACCOUNT_SCHEMA if pa is not None else None, file_format)
+    transactions = open_table(transactions_file, TRANSACTION_COLUMNS,
+                              TRANSACTION_SCHEMA if pa is not None else None, file_format)
+
+    account_count = transaction_count = 0
+    account_rows = []
+    transaction_rows = []
+    try:
+        for record in backend.iter_accounts(include_history=False):
+            account_rows.append(account_row(record))
+            if len(account_rows) >= chunk_size:
+                accounts.write(account_rows)
+                account_count += len(account_rows)
+                account_rows = []
+
+            acc_no = int(record["Account Number"])
+            position = None
+            while True:
+                entries, position = backend.page_history(acc_no, position, chunk_size)
+                transaction_rows.extend(transaction_row(acc_no, entry) for entry in entries)
+                if len(transaction_rows) >= chunk_size:
+                    transactions.write(transaction_rows)
+                    transaction_count += len(transaction_rows)
+                    transaction_rows = []
+                if position is None:
+                    break
+
+        if account_rows:
+            accounts.write(account_rows)
+            account_count += len(account_rows)
+        if transaction_rows:
+            transactions.write(transaction_rows)
+            transaction_count += len(transaction_rows)
+    finally:
+        accounts.close()
+        transactions.close()
+
+    return accounts_file, transactions_file, account_count, transaction_count
+
+
+# Loading
+def read_chunks(filename, file_format, columns, chunk_size):
+    '''
+    read_chunks: Reads a table chunk_size rows at a time, every column as a string
+
+    yields DataFrames
+    '''
+    dtypes = {column: "string" for column in columns}
+    if file_format == "csv":
+        yield from pd.read_csv(filename, dtype=dtypes, usecols=lambda column: column in dtypes,
+                               chunksize=chunk_size, keep_default_na=False, na_values=[""])
+        return
+
+    if pa is None:
+        raise ImportError(f"pyarrow is needed to read {file_format} files")
+    if file_format == "parquet":
+        batches = pq.ParquetFile(filename).iter_batches(batch_size=chunk_size)
+    else:
+        reader = ipc.open_file(filename)
+        batches = (reader.get_batch(index) for index in range(reader.num_record_batches))
+    for batch in batches:
+        yield batch.to_pandas().astype(dtypes)
+
+
+def parse_contact_info(text):
+    # Older snapshots stored the dict as its Python repr
+    if not isinstance(text, str):
+        return None
+    for parse in (json.loads, ast.literal_eval):
+        try:
+            info = parse(text)
+        except (ValueError, SyntaxError):
+            continue
+        return info if isinstance(info, dict) else None
+    return None
+
+
+def parse_contact_column(column):
+    '''
+    parse_contact_column: Parses a column of contact info, None where it is not a dict
+
+    The whole column is decoded as one JSON array, row by row parsing is only
+    needed when some row is not valid JSON
+    '''
+    if not column.isna().any():
+        try:
+            parsed = json.loads("[" + ",".join(column.tolist()) + "]")
+        except ValueError:
+            parsed = None
+        if parsed is not None and len(parsed) == len(column):
+            return pd.Series([info if isinstance(info, dict) else None for info in parsed],
+                             index=column.index, dtype=object)
+    return column.map(parse_contact_info, na_action="ignore")
+
+
+def numbers(column):
+    # Plain float64 with NaN for anything that is not a number
+    return pd.to_numeric(column, errors="coerce").astype("float64")
+
+
+def minor_units(column):
+    # Major unit amounts in minor units, NaN as well for amounts finer than a minor unit
+    scaled = numbers(column) * SCALE
+    minor = scaled.round()
+    return minor.where((scaled - minor).abs() < 1e-6)
+
+
+def first_errors(index, checks):
+    '''
+    first_errors: The first failed check of every row
+
+    Args:
+        checks: (boolean Series of failing rows, message) pairs
+
+    returns a string Series, missing where the row passed every check
+    '''
+    errors = pd.Series(pd.NA, index=index, dtype="string")
+    for failed, message in checks:
+        errors = errors.mask(failed.fillna(True).astype(bool) & errors.isna(), message)
+    return errors
+
+
+def check_accounts(chunk):
+    '''
+    check_accounts: Validates a chunk of the accounts table
+
+    returns (account records of the valid rows, error Series)
+    '''
+    acc_nos = numbers(chunk["Acc_no"])
+    names = chunk["Name"].fillna("").str.strip()
+    balances = minor_units(chunk["Account Balance"])
+    contact_info = parse_contact_column(chunk["Other Info"])
+    created = pd.to_datetime(chunk["Created On"], format=TIME_FORMAT, errors="coerce")
+
+    errors = first_errors(chunk.index, [
+        (acc_nos.isna() | (acc_nos < 1) | (acc_nos % 1 != 0), "Invalid account number"),
+        (acc_nos.duplicated(keep="last"), "Duplicate account number"),
+        (names == "", "Missing account name"),
+        (balances.isna() | (balances < 0), "Invalid balance"),
+        (contact_info.isna(), "Invalid contact info"),
+        (created.isna(), "Invalid creation date")
+    ])
+
+    valid = errors.isna().to_numpy()
+    records = [{
+        "Account Name": name,
+        "Account Number": str(int(acc_no)),
+        "Balance": int(balance),
+        "Other info": info,
+        "Created on": created_on,
+        "Transaction History": []
+    } for name, acc_no, balance, info, created_on in zip(
+        names[valid].tolist(), acc_nos[valid].tolist(), balances[valid].tolist(),
+        contact_info[valid].tolist(), chunk["Created On"][valid].tolist())]
+    return records, errors
+
+
+def check_transactions(chunk, backend):
+    '''
+    check_transactions: Validates a chunk of the transactions table, every account must exist
+
+    returns ((account_number, history entry) tuples of the valid rows, error Series)
+    '''
+    acc_nos = numbers(chunk["Acc_no"])
+    amounts = minor_units(chunk["Amount"])
+    sources = numbers(chunk["Source"])
+    ending_balances = minor_units(chunk["Ending Balance"])
+    destinations = numbers(chunk["Destination"])
+    types = chunk["Transaction Type"]
+    timestamps = pd.to_datetime(chunk["Time Stamp"], format=TIME_FORMAT, errors="coerce")
+
+    candidates = acc_nos.dropna().unique()
+    known = backend.get_states([str(int(acc_no)) for acc_no in candidates if acc_no % 1 == 0])
+    errors = first_errors(chunk.index, [
+        (acc_nos.isna() | (acc_nos % 1 != 0), "Invalid account number"),
+        (~acc_nos.isin([int(acc_no) for acc_no in known]), "Unknown account"),
+        (chunk["Transaction Id"].isna(), "Missing transaction id"),
+        (timestamps.isna(), "Invalid time stamp"),
+        (~types.isin(list(TYPE_CODES)), "Invalid transaction type"),
+        (amounts.isna() | (amounts <= 0), "Invalid amount"),
+        (sources.isna(), "Invalid source account"),
+        (ending_balances.isna(), "Invalid ending balance"),
+        ((types == "Transfer") & destinations.isna(), "Missing destination account")
+    ])
+
+    valid = errors.isna().to_numpy()
+    entries = [(str(int(acc_no)), [
+        transaction_id, timestamp, transaction_type, int(amount), int(source), int(ending_balance),
+        int(destination) if destination == destination else None
+    ]) for acc_no, transaction_id, timestamp, transaction_type, amount, source, ending_balance, destination in zip(
+        *(column[valid].tolist() for column in (
+            acc_nos, chunk["Transaction Id"], chunk["Time Stamp"], types,
+            amounts, sources, ending_balances, destinations)))]
+    return entries, errors
+
+
+def error_report(filename, offset, errors):
+    failed = errors.reset_index(drop=True).dropna()
+    return [(filename, offset + position, message) for position, message in failed.items()]
+
+
+def load_book(backend, filename, file_format="csv", chunk_size=100000):
+    '''
+    load_book: Restores the accounts and transactions written by export_book into backend
+
+    Accounts are loaded first, replacing existing ones and clearing their history,
+    then the transactions table, when there is one, refills the history. Invalid
+    rows are skipped and reported.
+
+    Args:
+        backend: Any storage backend
+
+        filename: File name without extension
+
+        file_format: "csv", "parquet" or "arrow"
+
+        chunk_size(int): Rows read, checked and written at a time
+
+    returns (accounts loaded, transactions loaded, [(file, row index, error message)])
+    '''
+    if pd is None:
+        raise ImportError("pandas is needed to load data")
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown import format {file_format}")
+
+    accounts_file = f"{filename}.{file_format}"
+    transactions_file = f"{filename}_transactions.{file_format}"
+    account_count = transaction_count = 0
+    errors = []
+
+    offset = 0
+    for chunk in read_chunks(accounts_file, file_format, ACCOUNT_COLUMNS, chunk_size):
+        records, chunk_errors = check_accounts(chunk)
+        backend.restore_accounts(records)
+        account_count += len(records)
+        errors.extend(error_report(accounts_file, offset, chunk_errors))
+        offset += len(chunk)
+
+    if os.path.exists(transactions_file):
+        offset = 0
+        for chunk in read_chunks(transactions_file, file_format, TRANSACTION_COLUMNS, chunk_size):
+            entries, chunk_errors = check_transactions(chunk, backend)
+            backend.append_history(entries)
+            transaction_count += len(entries)
+            errors.extend(error_report(transactions_file, offset, chunk_errors))
+            offset += len(chunk)
+
+    return account_count, transaction_count, errors
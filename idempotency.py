@@ -0,0 +1,102 @@
+import json
+import time
+from cache import TTLCache
+from metrics import registry
+
+'''
+Idempotency keys for deposits, withdrawals and transfers
+
+A client sends the same key with every retry of one request. The first attempt
+stores the key and its result in the same write as the money movement, so a
+key is never recorded without the ledger change or the other way around. A
+replay returns the stored result and leaves the ledger alone.
+
+Recent keys are served from a bounded in-memory LRU with a time to live, older
+ones from the backend's persisted index, which is purged once keys expire.
+'''
+
+KEY_REUSED = "Idempotency key already used for another request"
+
+
+def encode_result(result):
+    # Receipts hold datetimes, they are stored as text
+    return json.loads(json.dumps(result, default=str))
+
+
+def decode_result(result):
+    return tuple(result) if isinstance(result, list) else result
+
+
+class IdempotencyStore():
+    def __init__(self, backend, max_size=10000, ttl=86400.0, purge_every=1000):
+        '''
+        IdempotencyStore: Remembers the result of every request sent with an idempotency key
+
+        Args:
+            backend: Storage backend holding the persisted keys
+
+            max_size(int): Keys kept in memory, bounds the memory used
+
+            ttl(float): Seconds a key is honoured
+
+            purge_every(int): Keys recorded between purges of expired keys from the backend
+        '''
+        self.backend = backend
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.cache = TTLCache(max_size, ttl)
+        registry.watch_cache("idempotency", self.cache)
+        self._recorded = 0
+
+    def lookup(self, key, request):
+        '''
+        lookup: The result of an earlier request sent with key
+
+        Args:
+            key(str): Idempotency key
+
+            request(list): What is asked for e.g ["Deposit", account number, amount]
+
+        returns the earlier result, KEY_REUSED if key came with a different request,
+        or None if the key is new
+        '''
+        entry = self.cache.get(key)
+        if entry is None:
+            record = self.backend.get_idempotency_key(key)
+            if record is None:
+                return None
+            age = time.time() - record["created"]
+            if age >= self.ttl:
+                # Expired but still stored, apply_transactions would refuse the key
+                self.backend.expire_idempotency_keys(time.time() - self.ttl)
+                return None
+            entry = (record["request"], decode_result(record["result"]))
+            self.cache.put(key, entry, self.ttl - age)
+
+        stored_request, result = entry
+        if stored_request != encode_result(request):
+            return KEY_REUSED
+        return result
+
+    def entry(self, key, request, result):
+        '''
+        entry: What apply_transactions stores for key, None without a key
+
+        returns (key, record) or None
+        '''
+        if key is None:
+            return None
+        return key, {
+            "request": encode_result(request),
+            "result": encode_result(result),
+            "created": time.time()
+        }
+
+    def remember(self, key, request, result):
+        '''
+        remember: Caches the result of a request whose key was just stored
+        '''
+        self.cache.put(key, (encode_result(request), result))
+        self._recorded += 1
+        if self._recorded % self.purge_every == 0:
+            self.backend.expire_idempotency_keys(time.time() - self.ttl)
@@ -1,57 +1,92 @@
-import streamlit as st
 from datetime import datetime
-import pandas as pd
+import os
 import json
-import uuid
+import itertools
 import time
 import hashlib
+import csv
+import base64
+from storage import JournalStore, JsonBackend, MAX_RETRIES
+from cache import LRUCache
+from transaction_log import BalanceIndex, TransactionLog
+from checkpoint import Checkpointer
+from metrics import registry, timed
+from sessions import SessionStore
+from idempotency import IdempotencyStore
+from money import to_minor, minor_amount, format_money
+from receipts import ReceiptStore
 
 user_file = "users.json"
 pin_file = "utils.json"
 
+# Wrong pins allowed before an account is locked, overridable per Bank
+MAX_TRIALS = int(os.environ.get("BANK_MAX_TRIALS", 3))
+NO_PIN = "No pin is set for this account. Please reach out to customer care"
+
+# When journal writes reach the disk: "fsync" per operation, "group" commit or "async"
+DURABILITY = os.environ.get("BANK_DURABILITY", "async")
+GROUP_COMMIT_MS = float(os.environ.get("BANK_GROUP_COMMIT_MS", 2))
+GROUP_COMMIT_SIZE = int(os.environ.get("BANK_GROUP_COMMIT_SIZE", 64))
+
+# Folder of the default backend's receipt store, see receipts.py
+RECEIPT_DIR = os.environ.get("BANK_RECEIPT_DIR", "receipts")
+
 '''
 Helper functions to load and write to JSON and hash pin
 '''
+# The default files are only opened when first used, so importing this module stays cheap
+stores = {}
+checkpointer = None
+_default_backend = None
+_default_receipts = None
+
+def get_store(filename):
+    if filename not in stores:
+        stores[filename] = JournalStore(filename, durability=DURABILITY,
+                                        group_window=GROUP_COMMIT_MS / 1000,
+                                        group_size=GROUP_COMMIT_SIZE)
+    return stores[filename]
+
+
+def default_backend():
+    '''
+    default_backend: The JSON backend over users.json and utils.json, opened on first use
+
+    returns JsonBackend
+    '''
+    global checkpointer, _default_backend
+    if _default_backend is None:
+        _default_backend = JsonBackend(get_store(user_file), get_store(pin_file))
+        # Snapshots are taken in the background so a restart only replays the end of the journals
+        checkpointer = Checkpointer([stores[user_file], stores[pin_file]])
+        checkpointer.start()
+    return _default_backend
+
+
+def default_receipts():
+    '''
+    default_receipts: The receipt store in RECEIPT_DIR, opened on first use
+
+    returns ReceiptStore
+    '''
+    global _default_receipts
+    if _default_receipts is None:
+        _default_receipts = ReceiptStore(RECEIPT_DIR)
+    return _default_receipts
+
+
+@timed("read_json")
 def read_json(file):
-    if file == "utils.json":
-        try:
-            with open("utils.json", "r") as f:
-                data = json.load(f)
-                return data
-        except FileNotFoundError:
-            data = {"users":{
-
-            },
-            "next_account_number": 1}
-
-            with open("utils.json", "w") as f:
-                json.dump(data, f, indent=4, sort_keys = True)
-                return data
-    elif file == "users.json":
-        try:
-            with open("users.json", "r") as f:
-                data = json.load(f)
-                return data
-        except FileNotFoundError:
-            data = {"users":{
-
-            },
-            "next_account_number": 1}
-
-            with open("users.json", "w") as f:
-                json.dump(data, f, indent=4, sort_keys = True)
-                return data
+    if file in (user_file, pin_file):
+        return get_store(file).read()
     else:
         return "File not found"
 
 
+@timed("write_json")
 def write_json(data, filename):
-    if filename == "utils.json":
-        with open("utils.json", "w") as f:
-            json.dump(data, f, indent=4, sort_keys=True)
-    elif filename == "users.json":
-        with open("users.json", "w") as f:
-            json.dump(data, f, indent=4, sort_keys=True)
+    if filename in (user_file, pin_file):
+        get_store(filename).replace(data)
     else:
         return "File not found"
         
@@ -63,11 +98,101 @@ def hash_pin(pin):
     pin_hash = sha256.hexdigest()
     return pin_hash
 
+
+def read_customers_csv(filename):
+    '''
+    read_customers_csv: Reads customers for Bank.create_accounts from a csv file
+
+    Args:
+        filename: csv file with name, initial_deposit and pin columns, other columns are contact info
+
+    returns a generator of customer dicts
+    '''
+    with open(filename, newline="") as f:
+        for row in csv.DictReader(f):
+            name = row.pop("name", None)
+            initial_deposit = row.pop("initial_deposit", None)
+            pin = row.pop("pin", None)
+            try:
+                # Major units in the file, e.g 150.25, minor units from here on
+                initial_deposit = to_minor(initial_deposit) if initial_deposit else None
+            except ArithmeticError:
+                initial_deposit = None
+            yield {
+                "name": name,
+                "initial_deposit": initial_deposit,
+                "pin": pin,
+                "contact_info": row
+            }
+
+
+# Transaction ids: 48 bits of milliseconds, 40 random bits per process and a 40 bit counter
+_id_prefix = int.from_bytes(os.urandom(5), "big") << 40
+_id_counter = itertools.count()
+ID_COUNTER_MASK = (1 << 40) - 1
+
+
+def _reseed_transaction_ids():
+    # Forked workers would otherwise repeat the parent's ids
+    global _id_prefix, _id_counter
+    _id_prefix = int.from_bytes(os.urandom(5), "big") << 40
+    _id_counter = itertools.count()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reseed_transaction_ids)
+
+
+def generate_transaction_id():
+    '''
+    generate_transaction_id: Time ordered 128 bit id as 32 hex digits
+
+    Ids sort by creation time, never repeat within a process and are 16 bytes in
+    binary form, see receipts.transaction_key
+
+    returns str
+    '''
+    return f"{(time.time_ns() // 1000000) << 80 | _id_prefix | (next(_id_counter) & ID_COUNTER_MASK):032x}"
+
+
+def account_from_record(record, backend=None, idempotency=None, receipts=None, cache=None):
+    '''
+    account_from_record: Builds an Account from its stored data
+
+    Args:
+        record(dict): The stored account data
+
+        backend: Storage backend the account belongs to
+
+        idempotency(IdempotencyStore): Shared store for idempotency keys
+
+        receipts(ReceiptStore): Where receipts of the account's transactions are kept
+
+        cache(LRUCache): The Bank's account cache, the account puts itself back after its writes
+
+    returns Account
+    '''
+    return Account(
+        record["Account Name"],
+        int(record["Account Number"]),
+        record["Balance"],
+        record["Other info"],
+        record["Created on"],
+        record["Transaction History"],
+        backend=backend,
+        idempotency=idempotency,
+        receipts=receipts,
+        cache=cache
+    )
+
 '''
 Initializing Classes
 '''
 # Create Transaction class
 class Transaction():
+    __slots__ = ("transaction_id", "timestamp", "transaction_type", "amount",
+                 "source_account", "ending_balance", "destination_account")
+
     def __init__ (self, transaction_id, timestamp, transaction_type, amount,
                   source_account,  ending_balance, destination_account=None):
         
@@ -77,13 +202,12 @@ class Transaction():
         self.amount = amount
         self.source_account = source_account
         self.ending_balance = ending_balance
-        if transaction_type == "Transfer":
-            self.destination_account = destination_account   
+        self.destination_account = destination_account if transaction_type == "Transfer" else None
         
     # Generate receipt
     def generate_receipt(self):
         '''
-        generate receipts: Generates a receipt for every successful transfer
+        generate receipts: Generates a receipt for every successful transaction
 
         returns a dictionary of transaction details
         '''
@@ -99,7 +223,35 @@ class Transaction():
                 "Receiver": self.destination_account
             }
             return receipt
+
+        return {
+            "Transaction Id": self.transaction_id,
+            "Time Stamp": self.timestamp,
+            "Transaction Type": self.transaction_type,
+            "Amount": self.amount,
+            "Account": self.source_account,
+            "Ending Balance": self.ending_balance
+        }
     
+    def to_json(self):
+        '''
+        to_json: The transaction as it is stored in the transaction history
+
+        returns list
+        '''
+        timestamp = self.timestamp
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        return [
+            self.transaction_id,
+            timestamp,
+            self.transaction_type,
+            self.amount,
+            self.source_account,
+            self.ending_balance,
+            self.destination_account
+        ]
+
     # Save transaction
     def save_to_history(self, account, transaction):
         '''
@@ -122,86 +274,161 @@ class Transaction():
 # Create Bank Account
 class Account():
     def __init__(self, account_name, account_number, balance, 
-                  contact_info, creation_date, transaction_history=None):
+                  contact_info, creation_date, transaction_history=None, backend=None, idempotency=None,
+                  receipts=None, cache=None):
         self.account_name = account_name
         self.account_number = account_number
         self.balance = balance
         self.contact_info = contact_info
         self.creation_date = creation_date
-        self.transaction_history = transaction_history if transaction_history is not None else []
+        self.transaction_history = TransactionLog.from_entries(transaction_history)
+        self.backend = backend if backend is not None else default_backend()
+        self._idempotency = idempotency
+        self._receipts = receipts
+        self._cache = cache
+
+    @property
+    def idempotency(self):
+        # Accounts built outside a Bank get their own store on first use
+        if self._idempotency is None:
+            self._idempotency = IdempotencyStore(self.backend)
+        return self._idempotency
+
+    @property
+    def receipts(self):
+        if self._receipts is None:
+            self._receipts = default_receipts()
+        return self._receipts
+
+    def recache(self):
+        # Our own write moved the version, without this the next lookup rebuilds the account
+        if self._cache is not None:
+            acc_no = str(self.account_number)
+            self._cache.put(acc_no, self, self.backend.account_version(acc_no))
     
-    def deposit(self, amount):
+    @timed("Account.deposit")
+    def deposit(self, amount, idempotency_key=None):
         '''
         deposit: Function to add money into your account without Transfer
 
         Args:
-            amount(float): Amount to deposit
+            amount(int): Amount to deposit in minor units, e.g cents
+
+            idempotency_key(str): Sent again with every retry of the same deposit, a
+            replay returns the first result without depositing again
 
         returns formatted string detailing amount deposited
         '''
 
-        user_data = read_json(user_file)
         acc_no = str(self.account_number)
+        amount = minor_amount(amount)
+        if amount is None or amount <= 0:
+            return "Invalid amount"
+        request = ["Deposit", acc_no, amount]
 
         if amount:
-            new_balance = self.balance + amount
-            self.balance = new_balance
-            transaction_id = str(uuid.uuid4()) + str(int(time.time()) * 1000)
-            timestamp = datetime.now()
-            transaction = Transaction(
-                transaction_id,
-                timestamp,
-                "Deposit",
-                amount,
-                self.account_number,
-                ending_balance = new_balance
-            )
+            # Retry from the stored balance if another process changed it first
+            for _ in range(MAX_RETRIES):
+                if idempotency_key is not None:
+                    replay = self.idempotency.lookup(idempotency_key, request)
+                    if replay is not None:
+                        return replay
+
+                balance, version = self.backend.get_states([acc_no])[acc_no]
+                new_balance = balance + amount
+                transaction_id = generate_transaction_id()
+                timestamp = datetime.now()
+                transaction = Transaction(
+                    transaction_id,
+                    timestamp,
+                    "Deposit",
+                    amount,
+                    self.account_number,
+                    ending_balance = new_balance
+                )
+
+                result = f"Your deposit of {format_money(amount)} is successful"
 
-            user_data["users"][acc_no]["Balance"] = new_balance
-            write_json(user_data, user_file)
+                if self.backend.apply_transactions([(acc_no, new_balance, transaction.to_json())],
+                                                   expected={acc_no: version},
+                                                   idempotency=self.idempotency.entry(idempotency_key, request, result)
+                                                   if idempotency_key is not None else None):
+                    self.balance = new_balance
+                    self.transaction_history.append(transaction)
+                    self.recache()
+                    self.receipts.add([transaction.generate_receipt()])
+                    if idempotency_key is not None:
+                        self.idempotency.remember(idempotency_key, request, result)
+                    return result
 
-            self.transaction_history.append(transaction)
-            return f"Your deposit of {amount} is successful"
+            return "Account busy. Please try again"
 
     # Withdraw
-    def withdraw(self, amount):
+    @timed("Account.withdraw")
+    def withdraw(self, amount, idempotency_key=None):
         '''
         withdraw: Function to remove money into your account without Transfer
 
         Args:
-            amount(float): Amount to withdraw
+            amount(int): Amount to withdraw in minor units, e.g cents
+
+            idempotency_key(str): Sent again with every retry of the same withdrawal, a
+            replay returns the first result without withdrawing again
 
         returns formatted string detailing amount withdrawn
         '''
-        user_data = read_json(user_file)
         acc_no = str(self.account_number)
+        amount = minor_amount(amount)
+        if amount is None or amount <= 0:
+            return "Invalid amount"
+        request = ["Withdraw", acc_no, amount]
+
+        # Retry from the stored balance if another process changed it first
+        for _ in range(MAX_RETRIES):
+            if idempotency_key is not None:
+                replay = self.idempotency.lookup(idempotency_key, request)
+                if replay is not None:
+                    return replay
+
+            balance, version = self.backend.get_states([acc_no])[acc_no]
+            self.balance = balance
+
+            if amount < balance:
+                new_balance = balance - amount
+
+                transaction_id = generate_transaction_id()
+                timestamp = datetime.now()
+
+                transaction = Transaction(
+                    transaction_id,
+                    timestamp,
+                    "Withdraw",
+                    amount,
+                    self.account_number,
+                    ending_balance = new_balance
+                )
 
-        if amount < self.balance:
-            new_balance = self.balance - amount
-            self.balance = new_balance
-
-            transaction_id = str(uuid.uuid4()) + str(int(time.time()) * 1000)
-            timestamp = datetime.now()
-
-            transaction = Transaction(
-                transaction_id,
-                timestamp,
-                "Withdraw",
-                amount,
-                self.account_number,
-                ending_balance = new_balance
-            )
-
-            user_data["users"][acc_no]["Balance"] = new_balance
-            write_json(user_data, user_file)
+                result = f"Your withdrawal of {format_money(amount)} is successful"
+
+                if self.backend.apply_transactions([(acc_no, new_balance, transaction.to_json())],
+                                                   expected={acc_no: version},
+                                                   idempotency=self.idempotency.entry(idempotency_key, request, result)
+                                                   if idempotency_key is not None else None):
+                    self.balance = new_balance
+                    self.transaction_history.append(transaction)
+                    self.recache()
+                    self.receipts.add([transaction.generate_receipt()])
+                    if idempotency_key is not None:
+                        self.idempotency.remember(idempotency_key, request, result)
+                    return result
+            
+            else:
+                return "Insufficient balance."
 
-            self.transaction_history.append(transaction)
-            return f"Your withdrawal of {amount} is successful"
-        
-        else:
-            return "Insufficient balance."
+        return "Account busy. Please try again"
 
     # Check balance      
+    @timed("Account.check_balance")
     def check_balance(self):
         '''
         check balance: Checks account balance
@@ -209,11 +436,12 @@ class Account():
         returns formatted text detailing account_balance
         '''
         if self.account_number:
-            return f"You have ${self.balance} in your account"
+            return f"You have ${format_money(self.balance)} in your account"
         else:
             return f"Please login"
     
     # Change pin
+    @timed("Account.change_pin")
     def change_pin(self, old_pin, new_pin):
         '''
         change_pin: Function to change pin
@@ -229,25 +457,25 @@ class Account():
         '''
 
         account = str(self.account_number)
-        pin_data = read_json(pin_file)
-        for account in pin_data["users"].keys():
-            if int(account) == self.account_number:
-                if old_pin == pin_data["users"][account]["pin"]:
-                    if new_pin == old_pin:
-                        return f"Same pin as previous"
-                    else:            
-                        try:   
-                            if account:         
-                                pin_data["users"][account]["pin"] = new_pin
-                                write_json(pin_data, pin_file)
-                                return "Pin changed successfully"
-                            else:
-                                return "Account not found. Please create an account"
-                        except Exception as e:
-                            return f"Error accessing key {e}"
-                else:
-                    return "Old pin incorrect. Try again"
+        credentials = self.backend.get_credentials(account)
+        if credentials is None:
+            return "Account not found. Please create an account"
+
+        if not credentials["pin"]:
+            return NO_PIN
+        if old_pin == credentials["pin"]:
+            if new_pin == old_pin:
+                return f"Same pin as previous"
+            else:            
+                try:   
+                    self.backend.set_pin(account, new_pin)
+                    return "Pin changed successfully"
+                except Exception as e:
+                    return f"Error accessing key {e}"
+        else:
+            return "Old pin incorrect. Try again"
         
+    @timed("Account.update_contact_info")
     def update_contact_info(self,new_info):
         '''
         update_contact_info: Function to update contact info
@@ -257,15 +485,14 @@ class Account():
 
         returns formatted string
         '''
-        user_data = read_json(user_file)
         account = str(self.account_number)
 
         if new_info:
             self.contact_info = new_info
-            user_data["users"][account]["contact info"] = new_info
-            write_json(user_data, user_file)
+            self.backend.set_contact_info(account, new_info)
             return f"Contact info updated successfully"
         
+    @timed("Account.get_transaction_history")
     def get_transaction_history(self):
         '''
         get transaction history: Gets the transaction history of given account
@@ -274,18 +501,82 @@ class Account():
         '''
 
         if self.transaction_history:
-            return self.transaction_history
+            return self.transaction_history.to_entries()
         else:
             return "No transactions yet"
 
+    @timed("Account.get_transaction_page")
+    def get_transaction_page(self, page_size=50, since=None, until=None, types=None, token=None):
+        '''
+        get_transaction_page: Gets one page of the stored transaction history, oldest first
+
+        Args:
+            page_size(int): Maximum number of transactions in the page
+
+            since, until(datetime or str): Only transactions in this time range
+
+            types(list): Only these transaction types e.g ["Deposit", "Transfer"]
+
+            token(str): The token returned with the previous page, None for the first page
+
+        returns a tuple of (list of transactions, token for the next page or None on the last page)
+        '''
+        position = None
+        if token:
+            acc_no, position = json.loads(base64.urlsafe_b64decode(token.encode()))
+            if acc_no != str(self.account_number):
+                raise ValueError("Token belongs to another account")
+
+        if isinstance(since, datetime):
+            since = since.strftime("%Y-%m-%d %H:%M:%S")
+        if isinstance(until, datetime):
+            until = until.strftime("%Y-%m-%d %H:%M:%S")
+
+        entries, position = self.backend.page_history(
+            self.account_number, position, page_size, since, until,
+            set(types) if types is not None else None)
+
+        next_token = None
+        if position is not None:
+            next_token = base64.urlsafe_b64encode(
+                json.dumps([str(self.account_number), position]).encode()).decode()
+        return entries, next_token
+
+    def iter_transaction_history(self, page_size=500, since=None, until=None, types=None):
+        '''
+        iter_transaction_history: Lazily yields every stored transaction, one page at a time
+
+        Takes the same filters as get_transaction_page
+        '''
+        token = None
+        while True:
+            entries, token = self.get_transaction_page(page_size, since, until, types, token)
+            yield from entries
+            if token is None:
+                return
+
 
 # Creating the Bank
 class Bank():
-    def __init__(self, name):
+    def __init__(self, name, cache_size=1024, backend=None, max_trials=MAX_TRIALS, session_ttl=900,
+                 receipt_dir=None):
         self.name = name
-        self.accounts = []
+        self.max_trials = max_trials
+        self.accounts = LRUCache(cache_size)
+        registry.watch_cache("accounts", self.accounts)
+        # Per account time index for balance_at, kept across writes and caught up instead
+        self.balance_indexes = LRUCache(cache_size)
+        registry.watch_cache("balance_indexes", self.balance_indexes)
+        self.backend = backend if backend is not None else default_backend()
+        self.sessions = SessionStore(self.backend, lockout_at=max_trials - 1, ttl=session_ttl)
+        self.idempotency = IdempotencyStore(self.backend)
+        # Receipts live next to the backend's files unless a folder is given
+        if receipt_dir is None and backend is not None:
+            receipt_dir = getattr(self.backend, "receipt_dir", None)
+        self.receipts = ReceiptStore(receipt_dir) if receipt_dir is not None else default_receipts()
 
     # Create Account
+    @timed("Bank.create_account")
     def create_account(self, owner_name, initial_deposit, pin, contact_info):
         '''
         Create Account: Function to create account
@@ -294,7 +585,7 @@ class Bank():
 
             Owner_name(str): Name of account owner
 
-            Initial_deposit(float): Non zero Amount initially deposited into the account
+            Initial_deposit(int): Non zero Amount initially deposited into the account, in minor units
 
             pin: 4 digits used to login to your account
 
@@ -302,26 +593,17 @@ class Bank():
 
         returns formatted string with account_number
         '''
- 
-        pin_data = read_json(pin_file)
+        initial_deposit = minor_amount(initial_deposit)
+        if initial_deposit is None or initial_deposit <= 0:
+            return "Invalid amount"
 
-        user_data = read_json(user_file)
-
-        
         if owner_name and initial_deposit and pin and contact_info:
             
             creation_time = datetime.now()
             time_data = creation_time.strftime("%Y-%m-%d %H:%M:%S")
             transaction_history = []
-            account_number = int(user_data["next_account_number"])
+            account_number = self.backend.reserve_account_numbers(1)
             acc_no = str(account_number)
-           
-            pin_data["users"].update({acc_no:{               
-                "pin": pin,
-                "attempts": 0
-            }})
-
-            write_json(pin_data, pin_file)
 
             accounts = Account(
                 owner_name,
@@ -329,7 +611,11 @@ class Bank():
                 initial_deposit,
                 contact_info,
                 creation_time,
-                transaction_history
+                transaction_history,
+                backend=self.backend,
+                idempotency=self.idempotency,
+                receipts=self.receipts,
+                cache=self.accounts
                 )
             
             account_data = {
@@ -341,19 +627,88 @@ class Bank():
                 "Transaction History": transaction_history
             }
 
-            user_data["users"].update({
-                acc_no: account_data
-            })
+            self.backend.add_account(acc_no, account_data, pin)
 
+            self.accounts.put(acc_no, accounts, self.backend.account_version(acc_no))
 
-            self.accounts.append(accounts)
-            user_data["next_account_number"] = account_number + 1
+            return f"Account with account number {account_number:08d} successfully created."
 
-            write_json(user_data, user_file)
+    # Bulk account creation
+    @timed("Bank.create_accounts")
+    def create_accounts(self, customers, batch_size=10000, workers=None, hash_pins=True):
+        '''
+        create_accounts: Creates many accounts at once, e.g when migrating a customer book
 
-            return f"Account with account number {account_number:08d} successfully created."
+        Account numbers for all valid customers are reserved as one contiguous block,
+        pins are hashed in a process pool and accounts are saved batch_size at a time.
+
+        Args:
+            customers: Iterable of dicts with "name", "initial_deposit", "pin" and
+            "contact_info", or the path of a csv file with name, initial_deposit and pin
+            columns where every other column becomes contact info
+
+            batch_size(int): Number of accounts saved per write
+
+            workers(int): Processes used to hash pins, 0 hashes in this process.
+            Defaults to a pool for large batches
+
+            hash_pins(bool): False if the pins are already hashed
+
+        returns a tuple of (created account numbers, [(row index, error message)])
+        '''
+        if isinstance(customers, str):
+            customers = read_customers_csv(customers)
+
+        valid = []
+        errors = []
+        for index, customer in enumerate(customers):
+            initial_deposit = minor_amount(customer.get("initial_deposit"))
+            if not (customer.get("name") and customer.get("initial_deposit") is not None
+                    and customer.get("pin") and customer.get("contact_info")):
+                errors.append((index, "Please input all necessary details"))
+            elif initial_deposit is None or initial_deposit <= 0:
+                errors.append((index, "Invalid amount"))
+            else:
+                valid.append(dict(customer, initial_deposit=initial_deposit))
+
+        if not valid:
+            return [], errors
+
+        pins = [customer["pin"] for customer in valid]
+        if hash_pins:
+            if workers is None:
+                workers = None if len(pins) >= 10000 else 0
+            if workers == 0:
+                pins = [hash_pin(pin) for pin in pins]
+            else:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(workers) as pool:
+                    pins = list(pool.map(hash_pin, pins, chunksize=max(1, len(pins) // 64)))
+
+        first = self.backend.reserve_account_numbers(len(valid))
+        time_data = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        created = []
+
+        for start in range(0, len(valid), batch_size):
+            batch = []
+            for offset in range(start, min(start + batch_size, len(valid))):
+                customer = valid[offset]
+                account_number = first + offset
+                batch.append((str(account_number), {
+                    "Account Name": customer["name"],
+                    "Account Number": str(account_number),
+                    "Balance": customer["initial_deposit"],
+                    "Other info": customer["contact_info"],
+                    "Created on": time_data,
+                    "Transaction History": []
+                }, pins[offset]))
+                created.append(account_number)
+            self.backend.add_accounts(batch)
+
+        return created, errors
 
     # Find account
+    @timed("Bank.find_account")
     def find_account(self, account_number):
         '''
     Find account: Function to create account
@@ -365,25 +720,95 @@ class Bank():
     returns the matched Account instance otherwise None
 
     '''
-        user_data = read_json(user_file)
-
         acc_no = str(account_number)
+        version = self.backend.account_version(acc_no)
 
-        acc_data = list(user_data["users"][acc_no].values())
-        
-        acc = Account(*acc_data)
-        self.accounts.append(acc)
-
-        for account in self.accounts:
-            if acc_no == account.account_number:
-                return account
-                
-        return None
+        account = self.accounts.get(acc_no, version)
+        if account is not None:
+            return account
+
+        record = self.backend.get_account(acc_no)
+        if record is None:
+            return None
+
+        account = account_from_record(record, self.backend, self.idempotency, self.receipts, self.accounts)
+        self.accounts.put(acc_no, account, version)
+        return account
         
-    if "max_trials" not in st.session_state:
-        st.session_state.max_trials = 3
-    
+    # Point in time balances
+    @timed("Bank.balance_at")
+    def balance_at(self, account_number, timestamp):
+        '''
+        balance_at: The balance an account had at a point in time, e.g for an audit
+
+        Answered by bisection over a per account index of (time, ending balance). The
+        index is built on first use and afterwards only reads the transactions
+        recorded since, by this or any other process
+
+        Args:
+            account_number: The account to look up
+
+            timestamp(datetime or str): Point in time, strings as "%Y-%m-%d %H:%M:%S"
+
+        returns the balance in minor units, or None if the account did not exist at that time
+        '''
+        acc_no = str(account_number)
+        version = self.backend.account_version(acc_no)
+        index = self.balance_indexes.get(acc_no)
+
+        if index is None or not index.refresh(self.backend, version):
+            index = BalanceIndex.build(self.backend, acc_no)
+            if index is None:
+                return None
+            index.version = version
+            self.balance_indexes.put(acc_no, index)
+        return index.balance_at(timestamp)
+
+    # Receipts
+    @timed("Bank.get_receipt")
+    def get_receipt(self, transaction_id):
+        '''
+        get_receipt: Looks up the receipt of any transaction by its id, e.g for support staff
+
+        One probe of the receipt store's hash index and one read, see receipts.py
+
+        Args:
+            transaction_id(str): The id on the receipt or in the transaction history
+
+        returns the receipt dict, or None if no receipt is stored for that id
+        '''
+        return self.receipts.get(transaction_id)
+
+    @timed("Bank.index_receipts")
+    def index_receipts(self, page_size=500):
+        '''
+        index_receipts: Stores receipts for transactions recorded before receipts were kept
+
+        Walks every account's history once, transactions that already have a receipt are skipped
+
+        returns the number of receipts added
+        '''
+        added = 0
+        for record in self.backend.iter_accounts(include_history=False):
+            acc_no = str(record["Account Number"])
+            receipts = []
+            position = None
+            while True:
+                entries, position = self.backend.page_history(acc_no, position, page_size)
+                for entry in entries:
+                    # Transfers are stored for both accounts, the sender's copy is used
+                    if entry[2] == "Transfer" and str(entry[4]) != acc_no:
+                        continue
+                    if self.receipts.get(entry[0]) is None:
+                        receipts.append(Transaction(*entry).generate_receipt())
+                if position is None:
+                    break
+            self.receipts.add(receipts)
+            added += len(receipts)
+        return added
+
     # Authentication
+    @timed("Bank.authenticate")
     def authenticate(self, account_number, pin):
         '''
         Authenticate: Function to verify pin and account number before login
@@ -396,33 +821,63 @@ class Bank():
         
         returns formatted text
         '''
+        message, _ = self.login(account_number, pin)
+        return message
 
-        pin_data = read_json(pin_file)
-        acc_no = str(account_number)
-        saved_pin = pin_data["users"][acc_no]["pin"]
-        trials = pin_data["users"][acc_no]["attempts"]
+    @timed("Bank.login")
+    def login(self, account_number, pin):
+        '''
+        login: Checks the pin once and starts a session
+
+        Failed attempts are counted in memory, storage is only written when the
+        account gets locked, or unlocked by a successful login
+
+        Args:
+            account_number: The account that wants to login
+
+            pin: Pin used to login
+
+        returns a tuple of (formatted text, session token or None)
+        '''
 
-        if trials >= (st.session_state.max_trials - 1):
-            return "You have exceeded your login attempts. Please reach out to customer care"
+        acc_no = str(account_number)
+        credentials = self.backend.get_credentials(acc_no)
+        if credentials is None:
+            return "No account number found. Check the account number or Create an account", None
+
+        saved_pin = credentials["pin"]
+        # Accounts restored from a snapshot have no pin until one is set
+        if not saved_pin:
+            return NO_PIN, None
+        trials = self.sessions.attempts(acc_no, credentials["attempts"])
+
+        if trials >= (self.max_trials - 1):
+            return "You have exceeded your login attempts. Please reach out to customer care", None
         
-        for acc_no in pin_data["users"].keys():
-            if account_number == int(acc_no): 
-                if pin == saved_pin:
-                    pin_data["users"][acc_no]["attempts"] = 0
+        if pin == saved_pin:
+            return "Login successful", self.sessions.succeeded(acc_no)
+        else:
+            remaining = (self.max_trials - trials)
+            self.sessions.failed(acc_no)
+            return f"Wrong Pin. You have {remaining} chances left", None
 
-                    write_json(pin_data, pin_file)
-                    return "Login successful"
-                else:
-                    pin_data["users"][acc_no]["attempts"] = int(pin_data["users"][acc_no]["attempts"]) + 1
-                    remaining = (st.session_state.max_trials - trials)
-                    write_json(pin_data, pin_file)
-                    return f"Wrong Pin. You have {remaining} chances left"
-        return "No account number found. Check the account number or Create an account"
+    def session_account(self, token):
+        '''
+        session_account: The account number a session token belongs to, checked in memory
+
+        returns int, or None if the token is unknown or expired
+        '''
+        acc_no = self.sessions.validate(token)
+        return int(acc_no) if acc_no is not None else None
+
+    def logout(self, token):
+        self.sessions.revoke(token)
         
             
             
     # Transfer function
-    def transfer(self, from_account, to_account, amount):
+    @timed("Bank.transfer")
+    def transfer(self, from_account, to_account, amount, idempotency_key=None):
         '''
         transfer: To transfer from one account(from_account) to another(to_account)
 
@@ -431,29 +886,47 @@ class Bank():
 
             to_account: Account receiving the transfer
 
-            amount: Amount to be transferred
+            amount(int): Amount to be transferred in minor units, e.g cents
+
+            idempotency_key(str): Sent again with every retry of the same transfer, a
+            replay returns the first receipt without transferring again
 
         
         returns formatted string detailing amount transferred
         '''
-        user_data = read_json(user_file)
         f_acc = str(from_account)
         t_acc = str(to_account)
-
-        source_account = self.find_account(from_account)
-        
-        destination_account = self.find_account(to_account)
-        
-        if source_account and destination_account:
-            if source_account.balance >= amount:
+        amount = minor_amount(amount)
+        if amount is None:
+            return "Invalid amount"
+        request = ["Transfer", f_acc, t_acc, amount]
+
+        # Retry from the stored balances if another process changed them first
+        for _ in range(MAX_RETRIES):
+            if idempotency_key is not None:
+                replay = self.idempotency.lookup(idempotency_key, request)
+                if replay is not None:
+                    return replay
+
+            # Existence comes with the balances, no Account is built for a transfer
+            states = self.backend.get_states([f_acc, t_acc])
+            if f_acc not in states or t_acc not in states:
+                return "Accounts not found"
+            # Both sides would write the same balance and the credit would win
+            if f_acc == t_acc:
+                return "Cannot transfer to the same account"
+            cached = [self.accounts.get(acc_no, self.backend.account_version(acc_no)) for acc_no in (f_acc, t_acc)]
+            s_balance, s_version = states[f_acc]
+            d_balance, d_version = states[t_acc]
+
+            if s_balance >= amount:
                 if amount > 0:
-                    s_balance = (source_account.balance - amount)
-                    d_balance = (destination_account.balance + amount)
+                    s_balance = (s_balance - amount)
+                    d_balance = (d_balance + amount)
 
-                    transaction_id = str(uuid.uuid4()) + str(int(time.time()) * 1000)
+                    transaction_id = generate_transaction_id()
                     timestamp = datetime.now()
-                    json_timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                    transaction_sender = (
+                    tx_receipt = Transaction(
                         transaction_id,
                         timestamp,
                         "Transfer",
@@ -462,129 +935,229 @@ class Bank():
                         s_balance,
                         to_account
                         )
-                    
-                    transaction_receiver = (
-                        transaction_id,
-                        timestamp,
-                        "Transfer",
-                        amount,
-                        from_account,
-                        d_balance,
-                        to_account
-                    )
-                    tx_receipt = Transaction(*transaction_sender)
 
-                    source_account.balance = s_balance
-                    destination_account.balance = d_balance
+                    # The receiver's copy only differs in the ending balance
+                    transaction_sender_json = tx_receipt.to_json()
+                    transaction_receiver_json = transaction_sender_json[:5] + [d_balance, to_account]
+                    result = tx_receipt.generate_receipt(), f"Transfer successful"
+
+                    if not self.backend.apply_transactions([
+                        (f_acc, s_balance, transaction_sender_json),
+                        (t_acc, d_balance, transaction_receiver_json)
+                    ], expected={f_acc: s_version, t_acc: d_version},
+                            idempotency=self.idempotency.entry(idempotency_key, request, result)
+                            if idempotency_key is not None else None):
+                        continue
+
+                    # Accounts cached before the write stay cached at their new version
+                    for account, balance, entry in zip(cached, (s_balance, d_balance),
+                                                       (transaction_sender_json, transaction_receiver_json)):
+                        if account is not None:
+                            account.balance = balance
+                            tx_receipt.save_to_history(account, entry)
+                            account.recache()
+                    self.receipts.add([result[0]])
+
+                    if idempotency_key is not None:
+                        self.idempotency.remember(idempotency_key, request, result)
+                    return result
+            
+                else:
+                    return "Invalid amount"
+            else:
+                return "Insufficient amount. Please deposit"
 
+        return "Account busy. Please try again"
 
-                    tx_receipt.save_to_history(source_account, transaction_sender)
-                    tx_receipt.save_to_history(destination_account, transaction_receiver)
+    # Batch transfer
+    @timed("Bank.transfer_many")
+    def transfer_many(self, transfers):
+        '''
+        transfer_many: Applies many transfers in order and saves them with a single write
 
-                    transaction_sender_json = (
-                        transaction_id,
-                        json_timestamp,
-                        "Transfer",
-                        amount,
-                        from_account,
-                        s_balance,
-                        to_account
-                        )
-                    
-                    transaction_receiver_json = (
-                        transaction_id,
-                        json_timestamp,
-                        "Transfer",
-                        amount,
-                        from_account,
-                        d_balance,
-                        to_account
-                    )
+        Balances are loaded once and every transfer is checked against the balances left
+        by the transfers before it. A failed transfer is reported and the batch continues.
 
-                    user_data["users"][f_acc]["Transaction History"].append(transaction_sender_json)
-                    user_data["users"][t_acc]["Transaction History"].append(transaction_receiver_json)
-                    write_json(user_data, user_file)
+        Args:
+            transfers(list): (from_account, to_account, amount) tuples, amounts in minor units
 
-                    result = tx_receipt.generate_receipt()
+        returns a list with one result per transfer, either (receipt, "Transfer successful")
+        or the error message Bank.transfer would have returned
+        '''
+        transfers = [(from_account, to_account, minor_amount(amount)) for from_account, to_account, amount in transfers]
+        acc_nos = {str(acc) for from_account, to_account, _ in transfers for acc in (from_account, to_account)}
 
-                    return result, f"Transfer successful"
-            
-                else:
-                    return "Invalid amount"
-            else:
-                return "Insufficient amount. Please deposit"
-        else:
-            return "Accounts not found"
+        # Retry the whole batch if another process changed one of its accounts first
+        for _ in range(MAX_RETRIES):
+            states = self.backend.get_states(acc_nos)
+            balances = {acc_no: balance for acc_no, (balance, _) in states.items()}
+
+            results = []
+            changes = []
+            timestamp = datetime.now()
+            json_timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S")
+
+            for from_account, to_account, amount in transfers:
+                f_acc = str(from_account)
+                t_acc = str(to_account)
+
+                if f_acc not in balances or t_acc not in balances:
+                    results.append("Accounts not found")
+                    continue
+                if f_acc == t_acc:
+                    results.append("Cannot transfer to the same account")
+                    continue
+                if amount is None:
+                    results.append("Invalid amount")
+                    continue
+                if balances[f_acc] < amount:
+                    results.append("Insufficient amount. Please deposit")
+                    continue
+                if amount <= 0:
+                    results.append("Invalid amount")
+                    continue
+
+                balances[f_acc] -= amount
+                balances[t_acc] += amount
+
+                tx_receipt = Transaction(
+                    generate_transaction_id(),
+                    json_timestamp,
+                    "Transfer",
+                    amount,
+                    from_account,
+                    balances[f_acc],
+                    to_account
+                )
+                transaction_sender_json = tx_receipt.to_json()
+                transaction_receiver_json = transaction_sender_json[:5] + [balances[t_acc], to_account]
+
+                changes.append((f_acc, balances[f_acc], transaction_sender_json))
+                changes.append((t_acc, balances[t_acc], transaction_receiver_json))
+                results.append((tx_receipt.generate_receipt(), "Transfer successful"))
+
+            expected = {acc_no: version for acc_no, (_, version) in states.items()}
+            if self.backend.apply_transactions(changes, expected=expected):
+                self.receipts.add([result[0] for result in results if isinstance(result, tuple)])
+                return results
+
+        return ["Account busy. Please try again"] * len(transfers)
+
+    # Settlement
+    @timed("Bank.settle")
+    def settle(self, transfers, workers=None, partitions=None):
+        '''
+        settle: Applies a large batch of transfers, settling independent accounts in parallel
+
+        Same results as transfer_many, see settlement.SettlementEngine
+
+        Args:
+            transfers(list): (from_account, to_account, amount) tuples, amounts in minor units
+
+            workers(int): Processes used, 0 settles in this process. Defaults to one per core
+
+            partitions(int): Number of account partitions, defaults to the number of workers
+
+        returns a list with one result per transfer
+        '''
+        from settlement import SettlementEngine
+        return SettlementEngine(self, workers, partitions).settle(transfers)
+
+    # Statements
+    @timed("Bank.generate_statements")
+    def generate_statements(self, period, directory=".", file_format="csv", workers=None):
+        '''
+        generate_statements: Writes the monthly statement of every account to one file
+
+        Args:
+            period(str): Month as "YYYY-MM"
+
+            directory: Folder the statements_{period} file is written to
+
+            file_format: "csv", "json" or "text"
+
+            workers(int): Processes rendering statements, 0 renders in this process
+
+        returns formatted string detailing filename
+        '''
+        try:
+            from statements import generate_statements
+            filename, count = generate_statements(self.backend, period, directory, file_format, workers)
+        except (OSError, ValueError) as e:
+            return f"Error generating statements {e}"
+        return f"Saved {count} statements for {period} to {filename} successfully"
 
     # Save data      
-    def save_data(self, filename):
+    @timed("Bank.save_data")
+    def save_data(self, filename, file_format="csv", chunk_size=10000):
         '''
-        save_data: Saves account information to file, (specifically csv)
+        save_data: Saves every account and its transactions to file
+
+        Accounts and transactions are streamed from storage in chunks into two
+        tables, {filename}.{format} and {filename}_transactions.{format}
 
         Args:
 
-            filename: The name of the csv file where the file will be saved
+            filename: The name of the file where the data will be saved, without extension
+
+            file_format: "csv", "parquet" or "arrow". Parquet and Arrow need pyarrow and
+            fall back to csv without it
+
+            chunk_size(int): Rows written at a time
 
 
         returns formatted string detailing filename
         '''
 
-        if not self.accounts:
-            return []
-        
         if filename:
-            account_data = []
-            for account in self.accounts:
-                account_data.append({
-                    "Name": account.account_name,
-                    "Acc_no": account.account_number,
-                    "Owner's Name": account.owner_name,
-                    "Account Balance": account.balance,
-                    "Other Info": account.contact_info,
-                    "Created On": account.creation_date,
-                    "Transaction History": account.transaction_history
-                })
-
-            account_df = pd.DataFrame(account_data)
-
             try:
-                account_df.to_csv(f"{filename}.csv", index=False)
-                return f"Saved to {filename}.csv successfully"
+                from export import export_book
+                accounts_file, transactions_file, accounts, transactions = export_book(
+                    self.backend, filename, file_format, chunk_size)
+                return (f"Saved {accounts} accounts to {accounts_file} and "
+                        f"{transactions} transactions to {transactions_file} successfully")
             except Exception as e:
                 return f"Error saving file {e}"
         else:
             return "Please input a filename"
         
     # Load data
-    def load_data(self, filename):
+    @timed("Bank.load_data")
+    def load_data(self, filename, file_format="csv", chunk_size=100000):
         '''
-        load_data: Load data from file specifically csv
+        load_data: Loads accounts and transactions saved by save_data back into storage
+
+        The tables are read chunk_size rows at a time and every chunk is checked and
+        written in bulk. Loaded accounts replace existing ones with the same number,
+        invalid rows are skipped.
 
         Args:
-            filename: The name of the file from which the data is loaded from
+            filename: The name of the file from which the data is loaded from, without extension
+
+            file_format: "csv", "parquet" or "arrow"
+
+            chunk_size(int): Rows read at a time
 
         
-        returns formatted string detailing filename
+        returns a tuple of (formatted string detailing filename, [(file, row index, error message)])
         '''
 
 
         if not filename:
-            return "Please input a valid filename"
+            return "Please input a valid filename", []
         
         try:
-            account_df = pd.read_csv(f"{filename}.csv")
-            self.accounts = []
-
-            for _, row in account_df.iterrows():
-                account = Account(row['Name'], row['Acc_no'], row['Owner\'s Name'],
-                                  row['Account Balance'],  row['Other Info'],
-                                  row['Created On'], row['Transaction History'])
-                
-                self.accounts.append(account)
-                return f"Loaded from {filename}.csv successfully"
-
-        except ValueError as e:
-            return f"Skipping Invalid Account: {e}"
+            # pandas is only imported when data is actually loaded
+            from export import load_book
+            accounts, transactions, errors = load_book(self.backend, filename, file_format, chunk_size)
+        except (OSError, ValueError, ImportError) as e:
+            return f"Error loading file {e}", []
+
+        # Cached accounts and indexes are stale now
+        self.accounts.clear()
+        self.balance_indexes.clear()
+        return (f"Loaded {accounts} accounts and {transactions} transactions from {filename} "
+                f"successfully, skipped {len(errors)} invalid rows"), errors
 
 
 
@@ -0,0 +1,299 @@
+import atexit
+import bisect
+import functools
+import os
+import threading
+import time
+import weakref
+
+'''
+Instrumentation for the Bank: operation latencies, storage I/O and cache hit rates
+
+Everything is recorded into one in-process MetricsRegistry. Sinks receive the
+registry on flush, PrometheusFileSink writes the Prometheus text format and
+render_streamlit shows the same numbers on a Streamlit page. While the registry
+is disabled every instrumented call costs a single attribute check.
+
+Set BANK_METRICS=1 to enable it and BANK_METRICS_FILE to a path to have the
+Prometheus file rewritten every BANK_METRICS_INTERVAL seconds (15 by default).
+'''
+
+# Upper bounds in seconds, from 100 microseconds to 10 seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class Histogram():
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        '''
+        Histogram: Counts observations per bucket, plus their total and sum
+        '''
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        '''
+        quantile: Upper bound of the bucket holding the given fraction of observations
+        '''
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.buckets[-1]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class MetricsRegistry():
+    def __init__(self, enabled=False):
+        '''
+        MetricsRegistry: Holds every histogram and counter recorded in this process
+
+        Args:
+            enabled(bool): Nothing is recorded until this is True
+        '''
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.sinks = []
+        self._caches = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Recording
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def record_io(self, kind, store, nbytes):
+        '''
+        record_io: Counts one storage read or write of nbytes
+
+        Args:
+            kind: "read" or "write"
+
+            store: File the bytes went to or came from
+        '''
+        if not self.enabled:
+            return
+        self.inc(f"bank_storage_{kind}s_total", store=store)
+        self.inc("bank_storage_bytes_read_total" if kind == "read" else "bank_storage_bytes_written_total",
+                 nbytes, store=store)
+
+    def watch_cache(self, name, cache):
+        '''
+        watch_cache: Reports the hits and misses of an LRUCache under name
+
+        Only a weak reference is kept, the counters are read when metrics are collected
+        '''
+        with self._lock:
+            self._caches.setdefault(name, weakref.WeakSet()).add(cache)
+
+    def cache_stats(self):
+        '''
+        cache_stats: Hits, misses and hit rate of every watched cache name
+
+        returns dict of name to (hits, misses, hit rate or None)
+        '''
+        with self._lock:
+            caches = {name: list(group) for name, group in self._caches.items()}
+        stats = {}
+        for name, group in caches.items():
+            hits = sum(cache.hits for cache in group)
+            misses = sum(cache.misses for cache in group)
+            stats[name] = (hits, misses, hits / (hits + misses) if hits + misses else None)
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    # Reading
+    def snapshot(self):
+        '''
+        snapshot: Copy of every metric, for the in-process consumers
+
+        returns dict with "histograms", "counters" and "caches"
+        '''
+        with self._lock:
+            histograms = {key: (histogram.count, histogram.sum, histogram.quantile(0.5),
+                                histogram.quantile(0.99), list(histogram.counts))
+                          for key, histogram in self.histograms.items()}
+            counters = dict(self.counters)
+        return {"histograms": histograms, "counters": counters, "caches": self.cache_stats()}
+
+    def to_prometheus(self):
+        '''
+        to_prometheus: Every metric in the Prometheus text exposition format
+
+        returns str
+        '''
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            seen = set()
+            for (name, labels), histogram in histograms:
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+            for (name, labels), value in counters:
+                if name not in seen:
+                    lines.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        cache_stats = self.cache_stats()
+        for metric, index in (("bank_cache_hits_total", 0), ("bank_cache_misses_total", 1)):
+            if cache_stats:
+                lines.append(f"# TYPE {metric} counter")
+            for name, stats in sorted(cache_stats.items()):
+                lines.append(f"{metric}{_format_labels([('cache', name)])} {stats[index]}")
+        return "\n".join(lines) + "\n"
+
+    # Sinks
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.emit(self)
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def start(self, interval=15.0):
+        '''
+        start: Flushes to every sink every interval seconds from a background thread
+        '''
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,),
+                                            name="metrics", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            atexit.unregister(self.stop)
+            self.flush()
+
+
+class PrometheusFileSink():
+    def __init__(self, filename):
+        '''
+        PrometheusFileSink: Rewrites filename with the registry in Prometheus text format,
+        e.g for the node exporter textfile collector
+        '''
+        self.filename = filename
+
+    def emit(self, registry):
+        tmp_file = f"{self.filename}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(registry.to_prometheus())
+        os.replace(tmp_file, self.filename)
+
+
+registry = MetricsRegistry(enabled=os.environ.get("BANK_METRICS", "") not in ("", "0"))
+
+if os.environ.get("BANK_METRICS_FILE"):
+    registry.add_sink(PrometheusFileSink(os.environ["BANK_METRICS_FILE"]))
+    registry.start(float(os.environ.get("BANK_METRICS_INTERVAL", 15)))
+
+
+def timed(operation):
+    '''
+    timed: Decorator recording the latency of every call under operation
+
+    The check of registry.enabled is all a call pays while metrics are off
+    '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe("bank_operation_seconds", time.perf_counter() - start,
+                                 operation=operation)
+        return wrapper
+    return decorate
+
+
+def render_streamlit(metrics=None):
+    '''
+    render_streamlit: Shows the registry on the current Streamlit page, for an admin view
+    '''
+    import streamlit as st
+
+    metrics = metrics if metrics is not None else registry
+    snapshot = metrics.snapshot()
+    st.header("Metrics")
+    if not metrics.enabled:
+        st.info("Metrics are disabled. Set BANK_METRICS=1 to collect them")
+
+    st.subheader("Operations")
+    st.table([{
+        "operation": dict(labels).get("operation", name),
+        "calls": count,
+        "mean ms": round(total / count * 1000, 3) if count else None,
+        "p50 ms <=": p50 * 1000 if p50 is not None else None,
+        "p99 ms <=": p99 * 1000 if p99 is not None else None
+    } for (name, labels), (count, total, p50, p99, _) in sorted(snapshot["histograms"].items())])
+
+    st.subheader("Storage")
+    st.table([{"metric": name, **dict(labels), "value": value}
+              for (name, labels), value in sorted(snapshot["counters"].items())])
+
+    st.subheader("Caches")
+    st.table([{"cache": name, "hits": hits, "misses": misses,
+               "hit rate": round(rate, 3) if rate is not None else None}
+              for name, (hits, misses, rate) in sorted(snapshot["caches"].items())])
@@ -0,0 +1,56 @@
+import sys
+import json
+from storage import JournalStore
+from sqlite_backend import SQLiteBackend
+from money import SCALE, to_minor, entry_to_minor
+
+'''
+Imports the existing users.json and utils.json (including their journals) into SQLite
+
+Usage: python migrate.py [users.json] [utils.json] [bank.db]
+'''
+
+def migrate_json_to_sqlite(user_file="users.json", pin_file="utils.json", db_file="bank.db"):
+    '''
+    migrate_json_to_sqlite: Copies every account, pin and transaction into the database
+
+    Args:
+        user_file: JSON file with account data
+
+        pin_file: JSON file with pins and login attempts
+
+        db_file: SQLite database to import into
+
+    returns formatted string detailing the number of accounts imported
+    '''
+    user_data = JournalStore(user_file).read()
+    pin_data = JournalStore(pin_file).read()
+    backend = SQLiteBackend(db_file)
+    # Files not yet opened by a JsonBackend still hold major unit floats
+    legacy = user_data.get("money_scale") != SCALE
+
+    statements = []
+    for acc_no, record in user_data["users"].items():
+        credentials = pin_data["users"].get(acc_no, {"pin": None, "attempts": 0})
+        statements.append((
+            "INSERT OR REPLACE INTO accounts (account_number, account_name, balance, contact_info, created_on) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (int(acc_no), record["Account Name"], to_minor(record["Balance"]) if legacy else record["Balance"],
+             json.dumps(record.get("Other info", {})), record.get("Created on"))))
+        statements.append((
+            "INSERT OR REPLACE INTO credentials (account_number, pin, attempts) VALUES (?, ?, ?)",
+            (int(acc_no), credentials["pin"], credentials["attempts"])))
+        statements.append(("DELETE FROM transactions WHERE account_number = ?", (int(acc_no),)))
+        for entry in record.get("Transaction History", []):
+            statements.append(backend._insert_transaction(acc_no, entry_to_minor(entry) if legacy else entry))
+
+    statements.append(("UPDATE meta SET value = ? WHERE key = 'next_account_number'",
+                       (int(user_data["next_account_number"]),)))
+    backend._write(statements)
+    backend.close()
+
+    return f"Imported {len(user_data['users'])} accounts into {db_file}"
+
+
+if __name__ == "__main__":
+    print(migrate_json_to_sqlite(*sys.argv[1:4]))
@@ -0,0 +1,137 @@
+import numbers
+from decimal import Decimal, ROUND_HALF_EVEN
+from transaction_log import load_numpy
+
+'''
+Money as integer minor units
+
+Balances and amounts are stored and computed as whole cents (int64), so sums
+never drift and bulk arithmetic runs over integer arrays. Amounts typed by
+users, read from csv files or exports are converted exactly at the boundary
+with to_minor, and turned back into decimals for display with to_major or
+format_money.
+'''
+
+# Minor units per major unit, e.g cents per dollar
+SCALE = 100
+PLACES = Decimal(1) / SCALE
+
+
+def to_minor(amount):
+    '''
+    to_minor: Converts an amount in major units to integer minor units
+
+    Floats are read through their shortest repr, so 10.1 becomes exactly 1010.
+    Amounts with more decimals than SCALE allows are rounded half to even
+
+    Args:
+        amount(int, float, str or Decimal): Amount in major units e.g 12.5
+
+    returns int
+    '''
+    if isinstance(amount, float):
+        amount = repr(amount)
+    return int((Decimal(amount) * SCALE).quantize(Decimal(1), rounding=ROUND_HALF_EVEN))
+
+
+def minor_amount(amount):
+    '''
+    minor_amount: Checks that an amount passed to the Bank is in integer minor units
+
+    Floats, strings and bools are rejected rather than rounded, convert them with
+    to_minor at the boundary they come from
+
+    returns int, or None if the amount is not an integer
+    '''
+    if isinstance(amount, numbers.Integral) and not isinstance(amount, bool):
+        return int(amount)
+    return None
+
+
+def to_major(minor):
+    '''
+    to_major: Exact amount in major units, e.g 1250 -> Decimal("12.50")
+
+    returns Decimal
+    '''
+    return (Decimal(int(minor)) / SCALE).quantize(PLACES)
+
+
+def format_money(minor):
+    return f"{to_major(minor):,}"
+
+
+def entry_to_minor(entry):
+    '''
+    entry_to_minor: A stored history entry written in major units, with its amount
+    and ending balance converted to minor units
+
+    returns list
+    '''
+    entry = list(entry)
+    entry[3] = to_minor(entry[3])
+    entry[5] = to_minor(entry[5])
+    return entry
+
+
+# Vectorized arithmetic, numpy int64 when installed and plain ints otherwise
+def minor_array(amounts):
+    '''
+    minor_array: Converts many major unit floats to minor units at once
+
+    Exact for every amount with at most the decimals SCALE allows
+
+    returns numpy int64 array, or a list of ints without numpy
+    '''
+    np = load_numpy()
+    if np is not None:
+        return np.rint(np.asarray(amounts, dtype=np.float64) * SCALE).astype(np.int64)
+    return [to_minor(amount) for amount in amounts]
+
+
+def total(amounts):
+    '''
+    total: Exact sum of minor unit amounts
+
+    returns int
+    '''
+    np = load_numpy()
+    if np is not None:
+        return int(np.asarray(amounts, dtype=np.int64).sum())
+    return sum(int(amount) for amount in amounts)
+
+
+def interest(balances, rate_bp):
+    '''
+    interest: Interest on every balance, rounded half up to the minor unit
+
+    Args:
+        balances: Minor unit balances, not negative
+
+        rate_bp(int): Rate for the period in basis points, 1 bp = 0.01%
+
+    returns the interest of every balance, same type as minor_array
+    '''
+    np = load_numpy()
+    if np is not None:
+        return (np.asarray(balances, dtype=np.int64) * rate_bp + 5000) // 10000
+    return [(int(balance) * rate_bp + 5000) // 10000 for balance in balances]
+
+
+def reconcile(opening, changes, closing):
+    '''
+    reconcile: Accounts whose closing balance is not their opening balance plus their changes
+
+    Args:
+        opening, changes, closing: Minor unit amounts, one per account, changes is the
+        signed sum of the account's transactions
+
+    returns the positions that do not add up
+    '''
+    np = load_numpy()
+    if np is not None:
+        difference = (np.asarray(opening, dtype=np.int64) + np.asarray(changes, dtype=np.int64)
+                      - np.asarray(closing, dtype=np.int64))
+        return np.flatnonzero(difference).tolist()
+    return [position for position, (start, change, end) in enumerate(zip(opening, changes, closing))
+            if int(start) + int(change) != int(end)]
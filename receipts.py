@@ -0,0 +1,247 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from datetime import datetime
+from storage import FileLock
+from metrics import registry
+from transaction_log import TIME_FORMAT
+
+'''
+Receipt store with an on-disk hash index
+
+Every receipt is appended as one JSON line to "receipts.jsonl". "receipts.idx"
+is an open addressing hash table of fixed size slots, each holding the 16 byte
+binary transaction id with the offset and length of its receipt, and is mapped
+into memory. A lookup hashes the id, probes a slot or two and reads the receipt
+with a single pread, however many receipts are stored.
+
+The index is kept at most half full and rebuilt at double the size through a
+temp file and a rename. Processes share the files under the same fcntl lock
+discipline as the journal: writers hold it exclusively, readers shared. A
+receipt appended without its slot, e.g after a crash, is indexed by the next
+writer.
+'''
+
+MAGIC = b"RCPTIDX1"
+# Magic, capacity, receipts indexed, bytes of receipts.jsonl indexed
+HEADER = struct.Struct("<8sQQQ")
+# Binary transaction id, offset and length of the receipt
+SLOT = struct.Struct("<16sQQ")
+EMPTY_KEY = bytes(16)
+
+
+def transaction_key(transaction_id):
+    '''
+    transaction_key: The 16 byte binary form of a transaction id
+
+    Ids from generate_transaction_id are 32 hex digits and are their own bytes,
+    older uuid based ids are hashed down to 16 bytes
+
+    returns bytes
+    '''
+    transaction_id = str(transaction_id)
+    if len(transaction_id) == 32:
+        try:
+            return bytes.fromhex(transaction_id)
+        except ValueError:
+            pass
+    return hashlib.blake2b(transaction_id.encode(), digest_size=16).digest()
+
+
+def encode(value):
+    # Time stamps are stored the way the transaction history stores them
+    if isinstance(value, datetime):
+        return value.strftime(TIME_FORMAT)
+    return str(value)
+
+
+def find_slot(table, capacity, key):
+    '''
+    find_slot: Linear probing from the key's home slot
+
+    returns (slot, (offset, length)) if the key is stored, otherwise (first empty slot, None)
+    '''
+    slot = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") % capacity
+    while True:
+        stored, offset, length = SLOT.unpack_from(table, HEADER.size + slot * SLOT.size)
+        if stored == EMPTY_KEY:
+            return slot, None
+        if stored == key:
+            return slot, (offset, length)
+        slot = (slot + 1) % capacity
+
+
+def stamp(filename):
+    # A rebuilt index is renamed into place, so the inode changes
+    try:
+        stat = os.stat(filename)
+        return (stat.st_ino, stat.st_size)
+    except FileNotFoundError:
+        return None
+
+
+class ReceiptStore():
+    def __init__(self, directory, capacity=65536):
+        '''
+        ReceiptStore: Receipts of every transaction, looked up by transaction id
+
+        Args:
+            directory: Folder holding receipts.jsonl and receipts.idx
+
+            capacity(int): Slots of a new index, it doubles whenever it is half full
+        '''
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.data_file = os.path.join(directory, "receipts.jsonl")
+        self.index_file = os.path.join(directory, "receipts.idx")
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(os.path.join(directory, "receipts.lock"))
+        self._handle = open(self.data_file, "a+b")
+        self._map = None
+        self._stamp = None
+
+        with self._lock:
+            self._file_lock.acquire()
+            try:
+                if not os.path.exists(self.index_file):
+                    self._write_index(capacity, [], 0)
+            finally:
+                self._file_lock.release()
+
+    def _write_index(self, capacity, slots, end):
+        table = bytearray(HEADER.size + capacity * SLOT.size)
+        HEADER.pack_into(table, 0, MAGIC, capacity, len(slots), end)
+        for key, offset, length in slots:
+            slot, _ = find_slot(table, capacity, key)
+            SLOT.pack_into(table, HEADER.size + slot * SLOT.size, key, offset, length)
+
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(table)
+            f.flush()
+            os.fsync(f.fileno())
+            registry.record_io("write", self.index_file, len(table))
+        os.replace(tmp_file, self.index_file)
+
+    def _open(self):
+        # Remapped when another process rebuilt the index
+        current = stamp(self.index_file)
+        if self._map is not None and current == self._stamp:
+            return
+        if self._map is not None:
+            self._map.close()
+        with open(self.index_file, "r+b") as f:
+            self._map = mmap.mmap(f.fileno(), 0)
+        self._stamp = current
+
+    def _insert(self, slots, end):
+        _, capacity, count, _ = HEADER.unpack_from(self._map, 0)
+        if (count + len(slots)) * 2 > capacity:
+            stored = [SLOT.unpack_from(self._map, HEADER.size + slot * SLOT.size) for slot in range(capacity)]
+            stored = [entry for entry in stored if entry[0] != EMPTY_KEY]
+            while (count + len(slots)) * 2 > capacity:
+                capacity *= 2
+            self._write_index(capacity, stored, end)
+            self._open()
+
+        for key, offset, length in slots:
+            slot, found = find_slot(self._map, capacity, key)
+            SLOT.pack_into(self._map, HEADER.size + slot * SLOT.size, key, offset, length)
+            if found is None:
+                count += 1
+        HEADER.pack_into(self._map, 0, MAGIC, capacity, count, end)
+
+    def _catch_up(self):
+        '''
+        _catch_up: Indexes receipts appended after the index was last written
+
+        A half written last line is cut off
+        '''
+        _, _, _, end = HEADER.unpack_from(self._map, 0)
+        size = os.fstat(self._handle.fileno()).st_size
+        if size <= end:
+            return end
+
+        tail = os.pread(self._handle.fileno(), size - end, end)
+        slots = []
+        offset = end
+        for line in tail.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            slots.append((transaction_key(json.loads(line)["Transaction Id"]), offset, len(line)))
+            offset += len(line)
+        if offset < size:
+            os.truncate(self.data_file, offset)
+        self._insert(slots, offset)
+        return offset
+
+    def add(self, receipts):
+        '''
+        add: Stores receipts, a receipt stored again replaces the earlier one
+
+        Args:
+            receipts(list): Receipt dicts, see Transaction.generate_receipt
+        '''
+        if not receipts:
+            return
+        lines = [(json.dumps(receipt, default=encode) + "\n").encode() for receipt in receipts]
+        with self._lock:
+            self._file_lock.acquire()
+            try:
+                self._open()
+                offset = self._catch_up()
+                self._handle.write(b"".join(lines))
+                self._handle.flush()
+
+                slots = []
+                for receipt, line in zip(receipts, lines):
+                    slots.append((transaction_key(receipt["Transaction Id"]), offset, len(line)))
+                    offset += len(line)
+                self._insert(slots, offset)
+            finally:
+                self._file_lock.release()
+        registry.record_io("write", self.data_file, offset - slots[0][1])
+
+    def get(self, transaction_id):
+        '''
+        get: Looks up the receipt of a transaction
+
+        returns the receipt dict, or None if it is not stored
+        '''
+        key = transaction_key(transaction_id)
+        with self._lock:
+            self._file_lock.acquire(shared=True)
+            try:
+                self._open()
+                _, capacity, _, _ = HEADER.unpack_from(self._map, 0)
+                _, found = find_slot(self._map, capacity, key)
+                if found is None:
+                    return None
+                offset, length = found
+                line = os.pread(self._handle.fileno(), length, offset)
+            finally:
+                self._file_lock.release()
+        registry.record_io("read", self.data_file, length)
+
+        receipt = json.loads(line)
+        # Hashed legacy ids could collide, the stored id settles it
+        return receipt if str(receipt["Transaction Id"]) == str(transaction_id) else None
+
+    def __len__(self):
+        with self._lock:
+            self._file_lock.acquire(shared=True)
+            try:
+                self._open()
+                return HEADER.unpack_from(self._map, 0)[2]
+            finally:
+                self._file_lock.release()
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._handle.close()
@@ -0,0 +1,120 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+'''
+Login sessions and failed login counters
+
+A successful pin check issues a token that later requests present instead of
+the pin, validating it is a dictionary lookup. Failed attempts are counted in
+memory and only written to storage when an account becomes locked or unlocked,
+so other processes still see the lockout but ordinary logins write nothing.
+'''
+
+class SessionStore():
+    def __init__(self, backend, lockout_at=2, ttl=900.0):
+        '''
+        SessionStore: Issues expiring session tokens and tracks failed logins per account
+
+        Args:
+            backend: Storage backend holding the persisted attempt counters
+
+            lockout_at(int): Failed attempts at which an account is locked
+
+            ttl(float): Seconds a token stays valid
+        '''
+        self.backend = backend
+        self.lockout_at = lockout_at
+        self.ttl = ttl
+        # token -> (account number, expiry), in expiry order since every token gets the same ttl
+        self._tokens = OrderedDict()
+        # account number -> (failed attempts, value last seen in storage)
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    # Failed attempts
+    def attempts(self, acc_no, persisted):
+        '''
+        attempts: Failed attempts of an account
+
+        Args:
+            persisted(int): The counter read from storage with the credentials. If it
+            differs from what this process last saw, e.g an admin unlocked the account,
+            the stored value wins
+
+        returns int
+        '''
+        persisted = int(persisted)
+        with self._lock:
+            count, seen = self._attempts.get(acc_no, (persisted, persisted))
+            if persisted != seen:
+                count = seen = persisted
+            if count or seen:
+                self._attempts[acc_no] = (count, seen)
+            return count
+
+    def failed(self, acc_no):
+        '''
+        failed: Counts a wrong pin, the counter is only stored once the account locks
+        '''
+        with self._lock:
+            count, seen = self._attempts.get(acc_no, (0, 0))
+            count += 1
+            persist = count >= self.lockout_at and seen < self.lockout_at
+            self._attempts[acc_no] = (count, count if persist else seen)
+        if persist:
+            self.backend.set_attempts(acc_no, count)
+        return count
+
+    def succeeded(self, acc_no):
+        '''
+        succeeded: Clears the failed attempts and issues a session token
+
+        returns the token
+        '''
+        with self._lock:
+            _, seen = self._attempts.pop(acc_no, (0, 0))
+        if seen:
+            self.backend.set_attempts(acc_no, 0)
+        return self.issue(acc_no)
+
+    # Tokens
+    def _expire(self, now):
+        # Callers hold the lock
+        while self._tokens:
+            token, (_, expires) = next(iter(self._tokens.items()))
+            if expires > now:
+                break
+            del self._tokens[token]
+
+    def issue(self, acc_no):
+        token = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._tokens[token] = (acc_no, now + self.ttl)
+        return token
+
+    def validate(self, token):
+        '''
+        validate: The account a token was issued for, without touching storage
+
+        returns the account number, or None if the token is unknown or expired
+        '''
+        with self._lock:
+            session = self._tokens.get(token)
+            if session is None:
+                return None
+            acc_no, expires = session
+            if expires <= time.monotonic():
+                del self._tokens[token]
+                return None
+            return acc_no
+
+    def revoke(self, token):
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def __len__(self):
+        return len(self._tokens)
@@ -0,0 +1,279 @@
+import os
+from collections import deque
+from datetime import datetime
+from main import Transaction, generate_transaction_id, MAX_RETRIES
+from money import minor_amount
+
+'''
+Parallel settlement of large transfer batches, e.g at the end of the day
+
+Accounts are split into partitions by owner (the shard for a ShardedBackend,
+otherwise the account number modulo the number of partitions). Every partition
+keeps its transfers in batch order. Each epoch, every partition settles the run of
+transfers that stay inside it, in a process pool since partitions share no
+accounts. The coordinator then settles the cross partition transfers that are
+next in line on both sides, in two phases: prepare checks and debits the source
+partition, commit credits the destination.
+
+Epochs are planned before anything is settled. A batch without an epoch large
+enough for the pool is settled in batch order in this process instead.
+
+Every account sees its transfers in batch order, so the outcome is the same as
+applying the batch one transfer at a time, see Bank.transfer_many.
+'''
+
+def prepare_transfer(balances, from_account, to_account, amount):
+    '''
+    prepare_transfer: Checks a transfer against the source balance and debits it
+
+    Args:
+        balances(dict): Account number to balance, must hold the source account
+
+    returns None if the transfer can go ahead, otherwise the error Bank.transfer returns
+    '''
+    f_acc = str(from_account)
+    if f_acc == str(to_account):
+        return "Cannot transfer to the same account"
+    if amount is None:
+        return "Invalid amount"
+    if balances[f_acc] < amount:
+        return "Insufficient amount. Please deposit"
+    if amount <= 0:
+        return "Invalid amount"
+    balances[f_acc] -= amount
+    return None
+
+
+def commit_transfer(balances, from_account, to_account, amount, timestamp):
+    '''
+    commit_transfer: Credits a prepared transfer and builds its history entries and receipt
+
+    returns (receipt result, [sender change, receiver change])
+    '''
+    f_acc = str(from_account)
+    t_acc = str(to_account)
+    balances[t_acc] += amount
+
+    tx_receipt = Transaction(
+        generate_transaction_id(),
+        timestamp,
+        "Transfer",
+        amount,
+        from_account,
+        balances[f_acc],
+        to_account
+    )
+    transaction_sender_json = tx_receipt.to_json()
+    transaction_receiver_json = transaction_sender_json[:5] + [balances[t_acc], to_account]
+    return (tx_receipt.generate_receipt(), "Transfer successful"), [
+        (f_acc, balances[f_acc], transaction_sender_json),
+        (t_acc, balances[t_acc], transaction_receiver_json)
+    ]
+
+
+def settle_segment(balances, transfers, timestamp):
+    '''
+    settle_segment: Settles transfers that stay inside one partition, in order
+
+    Runs in the worker processes, everything it needs is passed in
+
+    Args:
+        balances(dict): Balances of every account the transfers touch
+
+        transfers(list): (batch index, from_account, to_account, amount) tuples
+
+        timestamp(str): Time stamp of the batch
+
+    returns (balances after the transfers, [(batch index, result, changes)])
+    '''
+    settled = []
+    for index, from_account, to_account, amount in transfers:
+        error = prepare_transfer(balances, from_account, to_account, amount)
+        if error is not None:
+            settled.append((index, error, []))
+            continue
+        result, changes = commit_transfer(balances, from_account, to_account, amount, timestamp)
+        settled.append((index, result, changes))
+    return balances, settled
+
+
+class SettlementEngine():
+    def __init__(self, bank, workers=None, partitions=None, partition_of=None, min_parallel=5000):
+        '''
+        SettlementEngine: Settles transfer batches across partitions in parallel
+
+        Args:
+            bank(Bank): The bank whose backend the batch is written to
+
+            workers(int): Processes in the pool, 0 settles everything in this process.
+            Defaults to one per core
+
+            partitions(int): Number of partitions when accounts are split by number,
+            defaults to the number of workers
+
+            partition_of: Callable mapping an account number to its partition. Defaults
+            to the owning shard of a ShardedBackend, otherwise the account number modulo partitions
+
+            min_parallel(int): Epochs with fewer transfers than this are settled in
+            this process, where the pool would cost more than it saves. Without any
+            larger epoch no pool is started
+        '''
+        self.bank = bank
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.partitions = partitions or max(self.workers, 1)
+        if partition_of is None:
+            backend = bank.backend
+            if hasattr(backend, "shard_name"):
+                partition_of = backend.shard_name
+            else:
+                partition_of = lambda acc_no: int(acc_no) % self.partitions
+        self.partition_of = partition_of
+        self.min_parallel = min_parallel
+        self.epochs = 0
+
+    def _plan(self, transfers, balances):
+        '''
+        _plan: Splits the transfers into epochs, which only depends on their accounts
+
+        Every epoch holds the runs of transfers inside one partition that come next
+        in each partition's queue (segments), then the cross partition transfers
+        that reach the head of both of their queues, in batch order
+
+        returns (list of (result, changes) with the transfers to unknown accounts
+        filled in, list of (segments, crossing) lists of batch indexes)
+        '''
+        settled = [None] * len(transfers)
+        partition = {}
+        queues = {}
+        for index, (from_account, to_account, amount) in enumerate(transfers):
+            f_acc = str(from_account)
+            t_acc = str(to_account)
+            if f_acc not in balances or t_acc not in balances:
+                settled[index] = ("Accounts not found", [])
+                continue
+            for acc_no in (f_acc, t_acc):
+                if acc_no not in partition:
+                    partition[acc_no] = self.partition_of(acc_no)
+            owners = {partition[f_acc], partition[t_acc]}
+            for owner in owners:
+                queues.setdefault(owner, deque()).append(index)
+
+        def crosses(index):
+            from_account, to_account, _ = transfers[index]
+            return partition[str(from_account)] != partition[str(to_account)]
+
+        epochs = []
+        while any(queues.values()):
+            segments = []
+            for queue in queues.values():
+                segment = []
+                while queue and not crosses(queue[0]):
+                    segment.append(queue.popleft())
+                if segment:
+                    segments.append(segment)
+
+            crossing = []
+            while True:
+                heads = {}
+                for queue in queues.values():
+                    if queue:
+                        heads[queue[0]] = heads.get(queue[0], 0) + 1
+                ready = sorted(index for index, count in heads.items() if count == 2)
+                if not ready:
+                    break
+                for index in ready:
+                    from_account, to_account, _ = transfers[index]
+                    queues[partition[str(from_account)]].popleft()
+                    queues[partition[str(to_account)]].popleft()
+                crossing.extend(ready)
+            epochs.append((segments, crossing))
+        return settled, epochs
+
+    def _parallel(self, segments):
+        # Below min_parallel transfers the pool costs more than it saves
+        return len(segments) > 1 and sum(len(segment) for segment in segments) >= self.min_parallel
+
+    def _settle_epochs(self, transfers, balances, timestamp, settled, epochs, pool):
+        '''
+        _settle_epochs: Settles every planned transfer against balances, which is updated in place
+
+        returns settled, with one (result, changes) per transfer
+        '''
+        for segments, crossing in epochs:
+            self.epochs += 1
+
+            # Runs of transfers inside one partition, settled in parallel
+            work = []
+            for segment in segments:
+                segment = [(index, *transfers[index]) for index in segment]
+                touched = {str(acc) for _, from_account, to_account, _ in segment
+                           for acc in (from_account, to_account)}
+                work.append(({acc_no: balances[acc_no] for acc_no in touched}, segment))
+
+            if pool is not None and self._parallel(segments):
+                outcomes = pool.map(settle_segment, *zip(*work), [timestamp] * len(work))
+            else:
+                outcomes = (settle_segment(segment_balances, segment, timestamp)
+                            for segment_balances, segment in work)
+            for segment_balances, segment_settled in outcomes:
+                balances.update(segment_balances)
+                for index, result, changes in segment_settled:
+                    settled[index] = (result, changes)
+
+            # Cross partition transfers, phase 1 on the source partition, phase 2 on the destination
+            for index in crossing:
+                from_account, to_account, amount = transfers[index]
+                error = prepare_transfer(balances, from_account, to_account, amount)
+                if error is not None:
+                    settled[index] = (error, [])
+                else:
+                    settled[index] = commit_transfer(balances, from_account, to_account,
+                                                     amount, timestamp)
+        return settled
+
+    def settle(self, transfers):
+        '''
+        settle: Settles a batch of transfers and saves it with a single write
+
+        The pool is only started when an epoch is large enough to use it. Random
+        batches cross partitions so often that their epochs stay small, they are
+        settled in batch order in this process, the same way transfer_many does
+
+        Args:
+            transfers: Iterable of (from_account, to_account, amount) tuples
+
+        returns a list with one result per transfer, exactly what Bank.transfer_many returns
+        '''
+        transfers = [(from_account, to_account, minor_amount(amount)) for from_account, to_account, amount in transfers]
+        acc_nos = {str(acc) for from_account, to_account, _ in transfers for acc in (from_account, to_account)}
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        pool = None
+        try:
+            # Settle again from the stored balances if another process changed an account first
+            for _ in range(MAX_RETRIES):
+                states = self.bank.backend.get_states(acc_nos)
+                balances = {acc_no: balance for acc_no, (balance, _) in states.items()}
+                settled, epochs = self._plan(transfers, balances)
+
+                if self.workers and any(self._parallel(segments) for segments, _ in epochs):
+                    if pool is None:
+                        from concurrent.futures import ProcessPoolExecutor
+                        pool = ProcessPoolExecutor(self.workers)
+                    self._settle_epochs(transfers, balances, timestamp, settled, epochs, pool)
+                else:
+                    serial = [(index, *transfer) for index, transfer in enumerate(transfers) if settled[index] is None]
+                    _, outcomes = settle_segment(balances, serial, timestamp)
+                    for index, result, changes in outcomes:
+                        settled[index] = (result, changes)
+
+                changes = [change for _, transfer_changes in settled for change in transfer_changes]
+                expected = {acc_no: version for acc_no, (_, version) in states.items()}
+                if self.bank.backend.apply_transactions(changes, expected=expected):
+                    self.bank.receipts.add([result[0] for result, _ in settled if isinstance(result, tuple)])
+                    return [result for result, _ in settled]
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        return ["Account busy. Please try again"] * len(transfers)
@@ -0,0 +1,379 @@
+import bisect
+import time
+import uuid
+from contextlib import contextmanager, ExitStack
+from storage import JournalStore
+
+'''
+Sharded storage: accounts are split across several backends by account number range
+
+A small directory file holds the range map, the next account number and the
+cross shard transfers that are in flight. Every shard is an ordinary backend
+(JsonBackend or SQLiteBackend), so a Bank routes to it through ShardedBackend
+without knowing how many shards there are.
+'''
+
+class ShardedBackend():
+    def __init__(self, shards, directory_file="shards.json", shard_size=100000, compact_bytes=1 << 20):
+        '''
+        ShardedBackend: Routes every account operation to the shard owning the account number
+
+        Args:
+            shards(dict): Shard name to backend, in range order. Every process using the
+            same directory must be given the same shards
+
+            directory_file: JSON file holding the range map
+
+            shard_size(int): Size of each range when the directory is first created,
+            the last shard also owns every account number after its range
+
+            compact_bytes(int): Directory journal size at which it is compacted once a
+            record is finished, the directory itself stays small
+        '''
+        self.shards = dict(shards)
+        self.directory = JournalStore(directory_file)
+        self.compact_bytes = compact_bytes
+        # Default folder of the Bank's receipt store, next to the directory file
+        self.receipt_dir = f"{directory_file}.receipts"
+        # (ranges, their start numbers), rebuilt when the directory holds a new range list
+        self._routes = None
+
+        with self.directory.locked() as data:
+            if "ranges" not in data:
+                ranges = [[1 + index * shard_size, name] for index, name in enumerate(self.shards)]
+                highest = max([int(acc_no) for backend in self.shards.values()
+                               for acc_no in backend.account_numbers()] or [0])
+                self.directory.apply([
+                    ["set", ["ranges"], ranges],
+                    ["set", ["intents"], {}],
+                    ["set", ["next_account_number"], max(int(data["next_account_number"]), highest + 1)]
+                ])
+
+        self.recover()
+
+    # Routing
+    def _routing(self):
+        # The starts are taken from the very list returned, another thread may switch the
+        # ranges at any time and a version check could pair old starts with new ranges
+        ranges = self.directory.read()["ranges"]
+        routes = self._routes
+        if routes is None or routes[0] is not ranges:
+            routes = (ranges, [start for start, _ in ranges])
+            self._routes = routes
+        return routes
+
+    def _ranges(self):
+        return self._routing()[0]
+
+    def shard_name(self, acc_no):
+        ranges, starts = self._routing()
+        index = bisect.bisect_right(starts, int(acc_no)) - 1
+        return ranges[max(index, 0)][1]
+
+    def shard_for(self, acc_no):
+        return self.shards[self.shard_name(acc_no)]
+
+    def _group(self, acc_nos):
+        groups = {}
+        for acc_no in acc_nos:
+            groups.setdefault(self.shard_name(acc_no), []).append(str(acc_no))
+        return groups
+
+    @contextmanager
+    def _locked_shards(self, acc_nos):
+        '''
+        _locked_shards: Locks the shards owning acc_nos in name order, so two writers never
+        deadlock, and makes sure no rebalance moved the accounts while waiting
+
+        Yields dict of shard name to the account numbers it owns
+        '''
+        acc_nos = [str(acc_no) for acc_no in acc_nos]
+        while True:
+            groups = self._group(acc_nos)
+            with ExitStack() as stack:
+                for name in sorted(groups):
+                    stack.enter_context(self.shards[name].locked())
+                if self._group(acc_nos) == groups:
+                    yield groups
+                    return
+
+    # Accounts
+    def get_account(self, acc_no):
+        return self.shard_for(acc_no).get_account(acc_no)
+
+    def account_version(self, acc_no):
+        name = self.shard_name(acc_no)
+        return (name, self.shards[name].account_version(acc_no))
+
+    def get_balances(self, acc_nos):
+        return {acc_no: balance for acc_no, (balance, _) in self.get_states(acc_nos).items()}
+
+    def get_states(self, acc_nos):
+        states = {}
+        for name, group in self._group(acc_nos).items():
+            states.update(self.shards[name].get_states(group))
+        return states
+
+    def iter_accounts(self, include_history=True):
+        for start, name in self._ranges():
+            for record in self.shards[name].iter_accounts(include_history):
+                # Skip copies left behind by a rebalance that is still cleaning up
+                if self.shard_name(record["Account Number"]) == name:
+                    yield record
+
+    def account_numbers(self, start=None, end=None):
+        numbers = []
+        for name, backend in self.shards.items():
+            numbers.extend(acc_no for acc_no in backend.account_numbers(start, end)
+                           if self.shard_name(acc_no) == name)
+        return sorted(numbers, key=int)
+
+    def reserve_account_numbers(self, count=1):
+        with self.directory.locked() as data:
+            first = int(data["next_account_number"])
+            self.directory.set(["next_account_number"], first + count)
+            return first
+
+    def add_account(self, acc_no, record, pin):
+        with self._locked_shards([acc_no]):
+            self.shard_for(acc_no).add_account(acc_no, record, pin)
+
+    def add_accounts(self, accounts):
+        by_shard = {}
+        for account in accounts:
+            by_shard.setdefault(self.shard_name(account[0]), []).append(account)
+        for name, group in by_shard.items():
+            with self._locked_shards([account[0] for account in group]):
+                self.shards[name].add_accounts(group)
+
+    def set_contact_info(self, acc_no, contact_info):
+        with self._locked_shards([acc_no]):
+            self.shard_for(acc_no).set_contact_info(acc_no, contact_info)
+
+    def apply_transactions(self, changes, expected=None, idempotency=None):
+        '''
+        apply_transactions: Writes balances and history entries to the owning shards
+
+        Changes that span several shards are committed in two phases: with every shard
+        locked the expected versions are checked and the full change set is recorded in
+        the directory, then each shard is written and the record is removed. recover()
+        finishes any record left behind by a crash.
+
+        A change on one shard is written by that shard alone, together with its
+        idempotency key. The key of a cross shard change is kept in the directory and
+        stored together with the removal of the record
+
+        Accounts of a record that was not finished, e.g because a shard failed in
+        phase 2, are fenced: the record is finished first and the caller, whose
+        versions are stale by then, retries
+
+        returns True if the changes were written, False on a version conflict or a known key
+        '''
+        acc_nos = {str(acc_no) for acc_no, _, _ in changes} | {str(acc_no) for acc_no in (expected or {})}
+        self.recover(acc_nos)
+        with self._locked_shards(acc_nos) as groups:
+            if self._pending_intents(self.directory.read(), acc_nos):
+                return False
+            if len(groups) == 1:
+                if idempotency is not None and self._key_known(self.directory.read(), idempotency[0]):
+                    return False
+                name = next(iter(groups))
+                return self.shards[name].apply_transactions(changes, expected, idempotency)
+
+            # Phase 1: check every version while all shards are locked
+            states = self.get_states(acc_nos)
+            for acc_no, version in (expected or {}).items():
+                if str(acc_no) not in states or states[str(acc_no)][1] != version:
+                    return False
+
+            per_shard = {}
+            for acc_no, balance, entry in changes:
+                per_shard.setdefault(self.shard_name(acc_no), []).append([str(acc_no), balance, entry])
+            intent_id = uuid.uuid4().hex
+            with self.directory.locked() as data:
+                if idempotency is not None and self._key_known(data, idempotency[0]):
+                    return False
+                intent = {
+                    "changes": per_shard,
+                    "created": time.time(),
+                    "idempotency": idempotency
+                }
+                self.directory.set(["intents", intent_id], intent)
+            self.directory.sync()
+
+            # Phase 2: write every shard, then forget the intent
+            self._apply_intent(intent_id, intent)
+        return True
+
+    def _apply_intent(self, intent_id, intent):
+        '''
+        _apply_intent: Writes every shard's part of a recorded change, then forgets the record
+
+        Each shard stores the intent id as an idempotency key in the same write as its
+        part, so a part that was already written is skipped when the intent is retried.
+        The caller holds the locks of every shard involved
+        '''
+        marker = {"request": ["Intent", intent_id], "result": None, "created": intent["created"]}
+        for name in sorted(intent["changes"]):
+            self.shards[name].apply_transactions([tuple(change) for change in intent["changes"][name]],
+                                                 idempotency=(f"intent:{intent_id}", marker))
+        self.directory.apply(self._finish_ops(intent_id, intent.get("idempotency")))
+        self._compact_directory()
+
+    def _compact_directory(self):
+        # Every record ever written would otherwise be replayed on each open
+        if self.directory.journal_size() >= self.compact_bytes:
+            self.directory.compact()
+
+    def _pending_intents(self, data, acc_nos):
+        # Recorded cross shard changes that touch any of acc_nos
+        return [intent_id for intent_id, intent in data.get("intents", {}).items()
+                if any(change[0] in acc_nos for changes in intent["changes"].values() for change in changes)]
+
+    def _key_known(self, data, key):
+        # Stored, or part of a transfer that is still in flight
+        return key in data.get("idempotency", {}) or any(
+            (intent.get("idempotency") or [None])[0] == key for intent in data["intents"].values())
+
+    def _finish_ops(self, intent_id, idempotency):
+        ops = [["delete", ["intents", intent_id], None]]
+        if idempotency is not None:
+            ops.append(["set", ["idempotency", idempotency[0]], idempotency[1]])
+        return ops
+
+    def recover(self, acc_nos=None):
+        '''
+        recover: Finishes cross shard transfers interrupted half way
+
+        Once recorded a transfer is committed, so every shard part not written yet is
+        written now, see _apply_intent
+
+        Args:
+            acc_nos: Only finish the transfers touching these accounts, defaults to all
+        '''
+        data = self.directory.read()
+        intent_ids = list(data.get("intents", {})) if acc_nos is None else self._pending_intents(data, acc_nos)
+        for intent_id in intent_ids:
+            intent = self.directory.read()["intents"].get(intent_id)
+            if intent is None:
+                continue
+            touched = [change[0] for changes in intent["changes"].values() for change in changes]
+            with self._locked_shards(touched):
+                # The writer may have finished while we waited for the locks
+                if intent_id not in self.directory.read()["intents"]:
+                    continue
+                self._apply_intent(intent_id, intent)
+
+    # Idempotency keys
+    def get_idempotency_key(self, key):
+        # Keys of cross shard changes are in the directory, the others on their shard
+        record = self.directory.read().get("idempotency", {}).get(key)
+        if record is not None:
+            return record
+        for backend in self.shards.values():
+            record = backend.get_idempotency_key(key)
+            if record is not None:
+                return record
+        return None
+
+    def expire_idempotency_keys(self, before):
+        with self.directory.locked() as data:
+            expired = [key for key, record in data.get("idempotency", {}).items() if record["created"] < before]
+            if expired:
+                self.directory.apply([["delete", ["idempotency", key], None] for key in expired])
+        self._compact_directory()
+        # Keys of single shard changes and the intent markers written by _apply_intent
+        for backend in self.shards.values():
+            backend.expire_idempotency_keys(before)
+
+    def get_history(self, acc_no):
+        return self.shard_for(acc_no).get_history(acc_no)
+
+    def page_history(self, acc_no, position=None, limit=50, since=None, until=None, types=None):
+        return self.shard_for(acc_no).page_history(acc_no, position, limit, since, until, types)
+
+    def restore_accounts(self, records):
+        if not records:
+            return
+        by_shard = {}
+        for record in records:
+            by_shard.setdefault(self.shard_name(record["Account Number"]), []).append(record)
+        for name, group in by_shard.items():
+            with self._locked_shards([record["Account Number"] for record in group]):
+                self.shards[name].restore_accounts(group)
+        with self.directory.locked() as data:
+            highest = max(int(record["Account Number"]) for record in records)
+            if highest >= int(data["next_account_number"]):
+                self.directory.set(["next_account_number"], highest + 1)
+
+    def append_history(self, entries):
+        by_shard = {}
+        for acc_no, entry in entries:
+            by_shard.setdefault(self.shard_name(acc_no), []).append((acc_no, entry))
+        for name, group in by_shard.items():
+            with self._locked_shards([acc_no for acc_no, _ in group]):
+                self.shards[name].append_history(group)
+
+    # Credentials
+    def get_credentials(self, acc_no):
+        return self.shard_for(acc_no).get_credentials(acc_no)
+
+    def set_pin(self, acc_no, pin):
+        with self._locked_shards([acc_no]):
+            self.shard_for(acc_no).set_pin(acc_no, pin)
+
+    def set_attempts(self, acc_no, attempts):
+        with self._locked_shards([acc_no]):
+            self.shard_for(acc_no).set_attempts(acc_no, attempts)
+
+    # Rebalancing
+    def add_shard(self, name, backend, start, batch_size=1000):
+        '''
+        add_shard: Adds a shard that takes over the account numbers from start up to the next range
+
+        Accounts are copied in batches while the old shard keeps serving requests.
+        Only the accounts that changed during the copy are copied again while the old
+        shard is briefly locked to switch the range map over.
+
+        Args:
+            name: Name of the new shard
+
+            backend: Backend of the new shard
+
+            start(int): First account number owned by the new shard
+
+            batch_size(int): Accounts copied per batch
+
+        returns formatted string detailing the number of accounts moved
+        '''
+        ranges, starts = self._routing()
+        index = bisect.bisect_right(starts, start) - 1
+        if index >= 0 and ranges[index][0] == start:
+            return f"A shard already starts at {start}"
+        owner = ranges[max(index, 0)][1]
+        end = ranges[index + 1][0] if index + 1 < len(ranges) else None
+        source = self.shards[owner]
+        self.shards[name] = backend
+
+        copied = {}
+        acc_nos = source.account_numbers(start, end)
+        for offset in range(0, len(acc_nos), batch_size):
+            entries = source.export_accounts(acc_nos[offset:offset + batch_size])
+            backend.import_accounts(entries)
+            copied.update({entry[0]: entry[3] for entry in entries})
+
+        # Pending transfers name the shard they were recorded for, finish them before the move
+        self.recover(set(acc_nos))
+        with source.locked(), backend.locked():
+            acc_nos = source.account_numbers(start, end)
+            self.recover(set(acc_nos))
+            states = source.get_states(acc_nos)
+            stale = [acc_no for acc_no in acc_nos if copied.get(acc_no) != states[acc_no][1]]
+            backend.import_accounts(source.export_accounts(stale))
+
+            with self.directory.locked() as data:
+                ranges = sorted(data["ranges"] + [[start, name]])
+                self.directory.set(["ranges"], ranges)
+
+        source.delete_accounts(acc_nos)
+        return f"Moved {len(acc_nos)} accounts to shard {name}"
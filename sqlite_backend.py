@@ -0,0 +1,515 @@
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from money import SCALE
+
+'''
+SQLite storage backend
+
+Accounts, pins and transactions live in their own indexed tables so a
+balance update or a login attempt only touches one row. Balances and amounts
+are integer minor units, see money.py.
+'''
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    account_number INTEGER PRIMARY KEY,
+    account_name TEXT NOT NULL,
+    balance INTEGER NOT NULL,
+    contact_info TEXT,
+    created_on TEXT,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS credentials (
+    account_number INTEGER PRIMARY KEY,
+    pin TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    account_number INTEGER NOT NULL,
+    transaction_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    transaction_type TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    source_account INTEGER,
+    ending_balance INTEGER NOT NULL,
+    destination_account INTEGER
+);
+CREATE INDEX IF NOT EXISTS transactions_account ON transactions (account_number, id);
+CREATE INDEX IF NOT EXISTS transactions_transaction_id ON transactions (transaction_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    record TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_created ON idempotency_keys (created);
+"""
+
+TRANSACTION_COLUMNS = ("transaction_id, timestamp, transaction_type, amount, "
+                       "source_account, ending_balance, destination_account")
+
+# Columns that held major unit floats before money was kept in minor units
+MONEY_COLUMNS = {"accounts": ("balance",), "transactions": ("amount", "ending_balance")}
+
+
+class SQLiteBackend():
+    def __init__(self, db_file="bank.db"):
+        '''
+        SQLiteBackend: Storage backend over a local SQLite database in WAL mode
+
+        Args:
+            db_file: Path of the database file
+        '''
+        self.db_file = db_file
+        # Default folder of the Bank's receipt store, next to the database
+        self.receipt_dir = f"{db_file}.receipts"
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # Wait for other processes holding the write lock instead of failing
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(SCHEMA)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(accounts)")]
+        if "version" not in columns:
+            self.conn.execute("ALTER TABLE accounts ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('next_account_number', 1)")
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._version = 0
+        self.key_versions = {}
+        self._migrate_money()
+        self._migrate_pins()
+
+    def _migrate_money(self):
+        '''
+        _migrate_money: Rebuilds tables created with REAL money columns with INTEGER
+        minor unit columns, in one transaction, and records the scale in meta
+        '''
+        with self.locked():
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = 'money_scale'").fetchone():
+                return
+            types = {row[1]: row[2] for row in self.conn.execute("PRAGMA table_info(accounts)")}
+            if types["balance"].upper() == "REAL":
+                columns = {}
+                for table in MONEY_COLUMNS:
+                    columns[table] = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+                    indexes = [row[1] for row in self.conn.execute(f"PRAGMA index_list({table})")
+                               if not row[1].startswith("sqlite_autoindex")]
+                    for index in indexes:
+                        self.conn.execute(f"DROP INDEX {index}")
+                    self.conn.execute(f"ALTER TABLE {table} RENAME TO {table}_major")
+                # executescript would commit the open transaction
+                for statement in SCHEMA.split(";"):
+                    if statement.strip():
+                        self.conn.execute(statement)
+                for table, money in MONEY_COLUMNS.items():
+                    names = ", ".join(columns[table])
+                    values = ", ".join(f"CAST(ROUND({column} * {SCALE}) AS INTEGER)" if column in money
+                                       else column for column in columns[table])
+                    self.conn.execute(f"INSERT INTO {table} ({names}) SELECT {values} FROM {table}_major")
+                    self.conn.execute(f"DROP TABLE {table}_major")
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('money_scale', ?)", (SCALE,))
+
+    def _migrate_pins(self):
+        '''
+        _migrate_pins: Rebuilds a credentials table whose pin column is NOT NULL, accounts
+        without a pin are stored with NULL instead of the empty string
+        '''
+        with self.locked():
+            notnull = {row[1]: row[3] for row in self.conn.execute("PRAGMA table_info(credentials)")}
+            if not notnull["pin"]:
+                return
+            self.conn.execute("ALTER TABLE credentials RENAME TO credentials_notnull")
+            self.conn.execute("CREATE TABLE credentials (account_number INTEGER PRIMARY KEY, "
+                              "pin TEXT, attempts INTEGER NOT NULL DEFAULT 0)")
+            self.conn.execute("INSERT INTO credentials (account_number, pin, attempts) "
+                              "SELECT account_number, NULLIF(pin, ''), attempts FROM credentials_notnull")
+            self.conn.execute("DROP TABLE credentials_notnull")
+
+    @contextmanager
+    def locked(self):
+        '''
+        locked: Holds the database write lock, nested calls join the outer transaction
+
+        Everything written inside commits together, or is rolled back on an exception
+        '''
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._depth = 1
+            try:
+                yield
+            except BaseException:
+                self._depth = 0
+                self.conn.execute("ROLLBACK")
+                raise
+            self._depth = 0
+            self.conn.execute("COMMIT")
+
+    def _write(self, statements):
+        '''
+        _write: Runs (sql, params) statements in a single transaction
+        '''
+        with self.locked():
+            for sql, params in statements:
+                self.conn.execute(sql, params)
+
+    def _touch(self, *acc_nos):
+        self._version += 1
+        for acc_no in acc_nos:
+            self.key_versions[str(acc_no)] = self._version
+
+    # Accounts
+    def get_account(self, acc_no):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT account_number, account_name, balance, contact_info, created_on "
+                "FROM accounts WHERE account_number = ?", (int(acc_no),)).fetchone()
+        if row is None:
+            return None
+        return self._record(row)
+
+    def _record(self, row, include_history=True):
+        account_number, account_name, balance, contact_info, created_on = row
+        return {
+            "Account Name": account_name,
+            "Account Number": str(account_number),
+            "Balance": balance,
+            "Other info": json.loads(contact_info) if contact_info else {},
+            "Created on": created_on,
+            "Transaction History": self.get_history(account_number) if include_history else []
+        }
+
+    def account_version(self, acc_no):
+        # data_version changes whenever another connection commits
+        with self._lock:
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        return (data_version, self.key_versions.get(str(acc_no), 0))
+
+    def get_balances(self, acc_nos):
+        '''
+        get_balances: Looks up several balances at once
+
+        returns dict of account number to balance, missing accounts are left out
+        '''
+        return {acc_no: balance for acc_no, (balance, _) in self.get_states(acc_nos).items()}
+
+    def get_states(self, acc_nos):
+        '''
+        get_states: Looks up balances together with their versions for compare and swap
+
+        returns dict of account number to (balance, version)
+        '''
+        acc_nos = [int(acc_no) for acc_no in set(map(str, acc_nos))]
+        states = {}
+        with self._lock:
+            # Stay below SQLite's limit on bound parameters
+            for start in range(0, len(acc_nos), 900):
+                chunk = acc_nos[start:start + 900]
+                rows = self.conn.execute(
+                    "SELECT account_number, balance, version FROM accounts WHERE account_number IN "
+                    f"({','.join('?' * len(chunk))})", chunk).fetchall()
+                states.update({str(acc_no): (balance, version) for acc_no, balance, version in rows})
+        return states
+
+    def iter_accounts(self, include_history=True, batch_size=1000):
+        '''
+        iter_accounts: Streams every account in account number order, batch_size rows per query
+
+        Args:
+            include_history(bool): False leaves "Transaction History" empty, use page_history instead
+        '''
+        last = -1
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT account_number, account_name, balance, contact_info, created_on "
+                    "FROM accounts WHERE account_number > ? ORDER BY account_number LIMIT ?",
+                    (last, batch_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._record(row, include_history)
+            last = rows[-1][0]
+
+    def reserve_account_numbers(self, count=1):
+        '''
+        reserve_account_numbers: Reserves a block of account numbers
+
+        returns the first reserved account number
+        '''
+        with self.locked():
+            first = self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'next_account_number'").fetchone()[0]
+            self.conn.execute("UPDATE meta SET value = ? WHERE key = 'next_account_number'",
+                              (first + count,))
+        return first
+
+    def add_account(self, acc_no, record, pin):
+        self._write([
+            ("INSERT INTO accounts (account_number, account_name, balance, contact_info, created_on) "
+             "VALUES (?, ?, ?, ?, ?)",
+             (int(acc_no), record["Account Name"], record["Balance"],
+              json.dumps(record["Other info"]), record["Created on"])),
+            ("INSERT INTO credentials (account_number, pin, attempts) VALUES (?, ?, 0)",
+             (int(acc_no), pin))
+        ] + [self._insert_transaction(acc_no, entry) for entry in record["Transaction History"]])
+        self._touch(acc_no)
+
+    def add_accounts(self, accounts):
+        '''
+        add_accounts: Adds many accounts in one database transaction
+
+        Args:
+            accounts(list): (account_number, record, pin) tuples
+        '''
+        with self.locked():
+            self.conn.executemany(
+                "INSERT INTO accounts (account_number, account_name, balance, contact_info, created_on) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(int(acc_no), record["Account Name"], record["Balance"],
+                  json.dumps(record["Other info"]), record["Created on"])
+                 for acc_no, record, _ in accounts])
+            self.conn.executemany(
+                "INSERT INTO credentials (account_number, pin, attempts) VALUES (?, ?, 0)",
+                [(int(acc_no), pin) for acc_no, _, pin in accounts])
+            self._touch(*[acc_no for acc_no, _, _ in accounts])
+
+    def set_contact_info(self, acc_no, contact_info):
+        self._write([("UPDATE accounts SET contact_info = ?, version = version + 1 WHERE account_number = ?",
+                      (json.dumps(contact_info), int(acc_no)))])
+        self._touch(acc_no)
+
+    def _insert_transaction(self, acc_no, entry):
+        return (f"INSERT INTO transactions (account_number, {TRANSACTION_COLUMNS}) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (int(acc_no), *entry))
+
+    def apply_transactions(self, changes, expected=None, idempotency=None):
+        '''
+        apply_transactions: Writes new balances and history entries in one database transaction
+
+        Args:
+            changes(list): (account_number, new_balance, history_entry) tuples, history_entry may be None
+
+            expected(dict): Account number to the version read by get_states. Nothing is
+            written if any of them changed in the meantime
+
+            idempotency: (key, record) stored in the same transaction, nothing is written
+            if the key is already stored
+
+        returns True if the changes were written, False on a version conflict or a known key
+        '''
+        with self.locked():
+            for acc_no, version in (expected or {}).items():
+                row = self.conn.execute("SELECT version FROM accounts WHERE account_number = ?",
+                                        (int(acc_no),)).fetchone()
+                if row is None or row[0] != version:
+                    return False
+            if idempotency is not None:
+                key, record = idempotency
+                if self.conn.execute("INSERT OR IGNORE INTO idempotency_keys (key, record, created) "
+                                     "VALUES (?, ?, ?)",
+                                     (key, json.dumps(record), record["created"])).rowcount == 0:
+                    return False
+
+            for acc_no, balance, entry in changes:
+                self.conn.execute(
+                    "UPDATE accounts SET balance = ?, version = version + 1 WHERE account_number = ?",
+                    (balance, int(acc_no)))
+                if entry is not None:
+                    self.conn.execute(*self._insert_transaction(acc_no, entry))
+            self._touch(*[acc_no for acc_no, _, _ in changes])
+        return True
+
+    # Idempotency keys
+    def get_idempotency_key(self, key):
+        with self._lock:
+            row = self.conn.execute("SELECT record FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def expire_idempotency_keys(self, before):
+        self._write([("DELETE FROM idempotency_keys WHERE created < ?", (before,))])
+
+    def get_history(self, acc_no):
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT {TRANSACTION_COLUMNS} FROM transactions "
+                "WHERE account_number = ? ORDER BY id", (int(acc_no),)).fetchall()
+        return [list(row) for row in rows]
+
+    def page_history(self, acc_no, position=None, limit=50, since=None, until=None, types=None):
+        '''
+        page_history: Reads a page of history entries, oldest first, using the (account_number, id) index
+
+        Args:
+            position: Row id the previous page stopped at, None for the start
+
+            limit(int): Maximum number of entries returned
+
+            since, until, types: Filters, see storage.history_matches
+
+        returns (entries, next position or None once the end is reached)
+        '''
+        sql = f"SELECT id, {TRANSACTION_COLUMNS} FROM transactions WHERE account_number = ? AND id > ?"
+        params = [int(acc_no), position or 0]
+        if since is not None:
+            sql += " AND timestamp >= ?"
+            params.append(since)
+        if until is not None:
+            sql += " AND timestamp <= ?"
+            params.append(until)
+        if types is not None:
+            types = list(types)
+            sql += f" AND transaction_type IN ({','.join('?' * len(types))})"
+            params.extend(types)
+        sql += " ORDER BY id LIMIT ?"
+        # One extra row tells whether there is a next page
+        params.append(limit + 1)
+
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return [list(row[1:]) for row in rows], rows[-1][0]
+        return [list(row[1:]) for row in rows], None
+
+    # Moving accounts between backends
+    def account_numbers(self, start=None, end=None):
+        '''
+        account_numbers: Account numbers stored here, optionally limited to [start, end)
+
+        returns sorted list of strings
+        '''
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT account_number FROM accounts WHERE account_number >= ? AND account_number < ? "
+                "ORDER BY account_number",
+                (start if start is not None else -1, end if end is not None else 2 ** 62)).fetchall()
+        return [str(row[0]) for row in rows]
+
+    def export_accounts(self, acc_nos):
+        '''
+        export_accounts: Everything stored for the given accounts
+
+        returns list of (account_number, record, credentials, version)
+        '''
+        entries = []
+        # One transaction, so every record matches the version exported with it
+        with self.locked():
+            for acc_no in acc_nos:
+                record = self.get_account(acc_no)
+                if record is not None:
+                    _, version = self.get_states([acc_no])[str(acc_no)]
+                    entries.append((str(acc_no), record, self.get_credentials(acc_no), version))
+        return entries
+
+    def import_accounts(self, entries):
+        '''
+        import_accounts: Stores entries from export_accounts, replacing existing accounts
+        '''
+        with self.locked():
+            for acc_no, record, credentials, version in entries:
+                self.conn.execute("DELETE FROM transactions WHERE account_number = ?", (int(acc_no),))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO accounts "
+                    "(account_number, account_name, balance, contact_info, created_on, version) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (int(acc_no), record["Account Name"], record["Balance"],
+                     json.dumps(record["Other info"]), record["Created on"], version))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO credentials (account_number, pin, attempts) VALUES (?, ?, ?)",
+                    (int(acc_no), credentials["pin"], credentials["attempts"]))
+                for entry in record["Transaction History"]:
+                    self.conn.execute(*self._insert_transaction(acc_no, entry))
+            self._touch(*[entry[0] for entry in entries])
+
+    def delete_accounts(self, acc_nos):
+        with self.locked():
+            for acc_no in acc_nos:
+                for table in ("accounts", "credentials", "transactions"):
+                    self.conn.execute(f"DELETE FROM {table} WHERE account_number = ?", (int(acc_no),))
+            self._touch(*acc_nos)
+
+    def restore_accounts(self, records):
+        '''
+        restore_accounts: Writes account records from a snapshot, replacing existing accounts
+
+        Existing credentials are kept, new accounts get no pin (NULL) and cannot
+        login until one is set.
+        History is cleared, it is restored through append_history
+        '''
+        if not records:
+            return
+        acc_nos = [(int(record["Account Number"]),) for record in records]
+        with self.locked():
+            self.conn.executemany(
+                "INSERT INTO accounts (account_number, account_name, balance, contact_info, created_on) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (account_number) DO UPDATE SET "
+                "account_name = excluded.account_name, balance = excluded.balance, "
+                "contact_info = excluded.contact_info, created_on = excluded.created_on, "
+                "version = version + 1",
+                [(int(record["Account Number"]), record["Account Name"], record["Balance"],
+                  json.dumps(record["Other info"]), record["Created on"]) for record in records])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO credentials (account_number, pin, attempts) VALUES (?, NULL, 0)", acc_nos)
+            self.conn.executemany("DELETE FROM transactions WHERE account_number = ?", acc_nos)
+            self.conn.execute(
+                "UPDATE meta SET value = MAX(value, ?) WHERE key = 'next_account_number'",
+                (max(acc_no for acc_no, in acc_nos) + 1,))
+            self._touch(*[record["Account Number"] for record in records])
+
+    def append_history(self, entries):
+        '''
+        append_history: Appends history entries without touching balances
+
+        Args:
+            entries(list): (account_number, history_entry) tuples, oldest first
+        '''
+        if not entries:
+            return
+        acc_nos = {int(acc_no) for acc_no, _ in entries}
+        with self.locked():
+            self.conn.executemany(
+                f"INSERT INTO transactions (account_number, {TRANSACTION_COLUMNS}) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(int(acc_no), *entry) for acc_no, entry in entries])
+            self.conn.executemany("UPDATE accounts SET version = version + 1 WHERE account_number = ?",
+                                  [(acc_no,) for acc_no in acc_nos])
+            self._touch(*acc_nos)
+
+    # Credentials
+    def get_credentials(self, acc_no):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT pin, attempts FROM credentials WHERE account_number = ?",
+                (int(acc_no),)).fetchone()
+        if row is None:
+            return None
+        return {"pin": row[0], "attempts": row[1]}
+
+    def set_pin(self, acc_no, pin):
+        self._write([("UPDATE credentials SET pin = ? WHERE account_number = ?", (pin, int(acc_no))),
+                     ("UPDATE accounts SET version = version + 1 WHERE account_number = ?", (int(acc_no),))])
+
+    def set_attempts(self, acc_no, attempts):
+        self._write([("UPDATE credentials SET attempts = ? WHERE account_number = ?",
+                      (attempts, int(acc_no))),
+                     ("UPDATE accounts SET version = version + 1 WHERE account_number = ?", (int(acc_no),))])
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
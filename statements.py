@@ -0,0 +1,205 @@
+import csv
+import io
+import json
+import os
+from collections import deque
+from datetime import datetime
+from transaction_log import signed_amount
+from money import to_major, format_money
+
+'''
+Bulk monthly statements
+
+The book is streamed once: every account's history is read page by page and
+only the entries of the period are kept, plus what is needed for the opening
+balance. Balances come from the ending balance stored with every transaction,
+so no history is replayed. Statements are rendered in batches in a process pool
+and appended to one file per period as the batches complete, only a bounded
+number of batches is in flight at any time. Amounts are written in major units,
+as exact decimals.
+'''
+
+STATEMENT_FORMATS = {"csv": "csv", "json": "jsonl", "text": "txt"}
+
+CSV_COLUMNS = ["Acc_no", "Name", "Period", "Opening Balance", "Closing Balance", "Transaction Id",
+               "Time Stamp", "Transaction Type", "Amount", "Ending Balance"]
+
+
+def period_bounds(period):
+    '''
+    period_bounds: First moment of the month and of the month after it, as stored time stamps
+
+    Args:
+        period(str): Month as "YYYY-MM"
+
+    returns (start, end) strings, start inclusive and end exclusive
+    '''
+    start = datetime.strptime(period, "%Y-%m")
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def account_statement(backend, record, start, end, page_size=500):
+    '''
+    account_statement: Collects one account's statement for the period [start, end)
+
+    Reading stops at the first entry after the period
+
+    returns (account number, name, opening balance, closing balance, entries in the period)
+    '''
+    acc_no = int(record["Account Number"])
+    last_before = first_after = None
+    entries = []
+    position = None
+    while first_after is None:
+        page, position = backend.page_history(acc_no, position, page_size)
+        for entry in page:
+            timestamp = str(entry[1])
+            if timestamp < start:
+                last_before = entry
+            elif timestamp < end:
+                entries.append(entry)
+            else:
+                first_after = entry
+                break
+        if position is None:
+            break
+
+    if last_before is not None:
+        opening = last_before[5]
+    elif entries or first_after is not None:
+        first = entries[0] if entries else first_after
+        opening = first[5] - signed_amount(acc_no, first)
+    else:
+        opening = record["Balance"]
+    closing = entries[-1][5] if entries else opening
+    return acc_no, record["Account Name"], opening, closing, entries
+
+
+def render_csv(period, statements):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for acc_no, name, opening, closing, entries in statements:
+        opening, closing = to_major(opening), to_major(closing)
+        if not entries:
+            writer.writerow([acc_no, name, period, opening, closing, "", "", "", "", ""])
+        for entry in entries:
+            writer.writerow([acc_no, name, period, opening, closing, entry[0], entry[1],
+                             entry[2], to_major(entry[3]), to_major(entry[5])])
+    return buffer.getvalue()
+
+
+def render_json(period, statements):
+    return "".join(json.dumps({
+        "Acc_no": acc_no,
+        "Name": name,
+        "Period": period,
+        "Opening Balance": to_major(opening),
+        "Closing Balance": to_major(closing),
+        "Transactions": [entry[:3] + [to_major(entry[3]), entry[4], to_major(entry[5])] + entry[6:]
+                         for entry in entries]
+    }, default=str) + "\n" for acc_no, name, opening, closing, entries in statements)
+
+
+def render_text(period, statements):
+    lines = []
+    for acc_no, name, opening, closing, entries in statements:
+        lines.append(f"Statement for {name}, account {acc_no:08d}, {period}")
+        lines.append(f"Opening balance: {format_money(opening)}")
+        for transaction_id, timestamp, transaction_type, amount, source, ending_balance, *destination in entries:
+            detail = ""
+            if transaction_type == "Transfer":
+                detail = f"to {destination[0]}" if str(source) == str(acc_no) else f"from {source}"
+            lines.append(f"  {timestamp}  {transaction_type:<9}{format_money(amount):>14}{format_money(ending_balance):>14}  {detail}")
+        lines.append(f"Closing balance: {format_money(closing)}")
+        lines.append("-" * 60)
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+RENDERERS = {"csv": render_csv, "json": render_json, "text": render_text}
+
+
+def render_batch(file_format, period, statements):
+    # Runs in the worker processes
+    return RENDERERS[file_format](period, statements)
+
+
+def generate_statements(backend, period, directory=".", file_format="csv", workers=None,
+                        batch_size=1000, page_size=500):
+    '''
+    generate_statements: Writes the statement of every account open during one month
+
+    Args:
+        backend: Any storage backend
+
+        period(str): Month as "YYYY-MM"
+
+        directory: Folder the statements_{period} file is written to
+
+        file_format: "csv", "json" (one statement per line) or "text"
+
+        workers(int): Processes rendering statements, 0 renders in this process.
+        Defaults to one per core
+
+        batch_size(int): Statements rendered per task
+
+        page_size(int): History entries read at a time
+
+    returns (statements file, number of statements)
+    '''
+    if file_format not in STATEMENT_FORMATS:
+        raise ValueError(f"Unknown statement format {file_format}")
+    start, end = period_bounds(period)
+    filename = os.path.join(directory, f"statements_{period}.{STATEMENT_FORMATS[file_format]}")
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+
+    pool = None
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 0:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(workers)
+    # Enough batches queued to keep every worker busy, no more
+    max_pending = 2 * workers
+
+    count = 0
+    pending = deque()
+    try:
+        with open(tmp_file, "w", newline="") as out:
+            if file_format == "csv":
+                csv.writer(out).writerow(CSV_COLUMNS)
+
+            batch = []
+            for record in backend.iter_accounts(include_history=False):
+                # Accounts opened after the period have no statement for it
+                if str(record.get("Created on", "")) >= end:
+                    continue
+                batch.append(account_statement(backend, record, start, end, page_size))
+                if len(batch) < batch_size:
+                    continue
+                count += len(batch)
+                if pool is None:
+                    out.write(render_batch(file_format, period, batch))
+                else:
+                    pending.append(pool.submit(render_batch, file_format, period, batch))
+                    # Written in submission order, so the file follows account order
+                    while len(pending) >= max_pending:
+                        out.write(pending.popleft().result())
+                batch = []
+
+            if batch:
+                count += len(batch)
+                if pool is None:
+                    out.write(render_batch(file_format, period, batch))
+                else:
+                    pending.append(pool.submit(render_batch, file_format, period, batch))
+            while pending:
+                out.write(pending.popleft().result())
+        os.replace(tmp_file, filename)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    return filename, count
@@ -0,0 +1,1017 @@
+import copy
+import json
+import os
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+from metrics import registry
+from money import SCALE, to_minor, entry_to_minor
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks on Windows, a single process is still safe
+    fcntl = None
+
+'''
+Append-only journal storage for the JSON files
+
+Instead of re-serializing the whole file on every change, each mutation is
+appended to "<file>.journal" as one compact line. The base file is only
+rewritten when the journal is compacted.
+
+Several processes can share the same files: appends and compactions hold an
+exclusive fcntl lock on "<file>.lock", loads hold a shared one, and the base
+file is always replaced through a temp file and a rename.
+
+A checkpoint writes the whole data to "<file>.snapshot" together with the
+journal offset (log sequence number) it covers, so loading only replays the
+journal written after it.
+
+How soon a record reaches the disk is set by the store's durability:
+"fsync" syncs every record before returning, "group" makes concurrent writers
+wait for one shared fsync (group commit) and "async" returns at once and syncs
+every fsync_every records.
+'''
+
+# Attempts made by compare and swap callers before giving up
+MAX_RETRIES = 10
+
+DURABILITY_LEVELS = ("fsync", "group", "async")
+
+def default_data():
+    return {"users": {
+
+    },
+    "next_account_number": 1,
+    "money_scale": SCALE}
+
+
+def dump_compact(data):
+    return json.dumps(data, separators=(",", ":"))
+
+
+def atomic_write_json(data, filename):
+    '''
+    atomic_write_json: Writes JSON to a temp file and renames it over filename
+
+    Readers see either the old or the new file, never a half written one
+    '''
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+        registry.record_io("write", filename, f.tell())
+    os.replace(tmp_file, filename)
+
+
+def writable(target, key, default, owned):
+    # Containers shared with a frozen view are copied before they are changed
+    child = target.setdefault(key, default)
+    if owned is not None and id(child) not in owned:
+        child = copy.copy(child)
+        target[key] = child
+        owned.add(id(child))
+    return child
+
+
+def apply_op(data, op, owned=None):
+    '''
+    apply_op: Applies a single journal operation to the data
+
+    Args:
+        data(dict): The loaded JSON data
+
+        op(list): [action, path, value] where action is "set", "append" or "delete"
+
+        owned(set): Ids of the containers that may be changed in place while a frozen
+        view of data is serialized, the others on the path are copied first. None
+        changes everything in place
+    '''
+    action, path, value = op
+    target = data
+    for key in path[:-1]:
+        target = writable(target, key, {}, owned)
+
+    if action == "set":
+        target[path[-1]] = value
+    elif action == "append":
+        writable(target, path[-1], [], owned).append(value)
+    elif action == "delete":
+        target.pop(path[-1], None)
+
+
+class FileLock():
+    def __init__(self, filename):
+        '''
+        FileLock: Re-entrant advisory lock on filename shared between processes
+
+        Callers must already hold the owning JournalStore's thread lock
+        '''
+        self.filename = filename
+        self._handle = None
+        self._depth = 0
+
+    def acquire(self, shared=False):
+        if self._depth == 0 and fcntl is not None:
+            if self._handle is None:
+                self._handle = open(self.filename, "a")
+            fcntl.flock(self._handle.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and fcntl is not None:
+            fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+
+
+class JournalStore():
+    def __init__(self, filename, journal_file=None, fsync_every=32, durability="async",
+                 group_window=0.002, group_size=64):
+        '''
+        JournalStore: Keeps a JSON file in memory and journals every change
+
+        Args:
+            filename: The base JSON file e.g users.json
+
+            journal_file: Where mutations are appended, defaults to <filename>.journal
+
+            fsync_every(int): Number of records written before the journal is fsynced, "async" only
+
+            durability: "fsync", "group" or "async", see DURABILITY_LEVELS
+
+            group_window(float): Seconds a group commit waits for more writers to join, "group" only
+
+            group_size(int): Writers that flush a group commit without waiting out the window
+        '''
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"durability must be one of {DURABILITY_LEVELS}")
+        self.filename = filename
+        self.journal_file = journal_file or f"{filename}.journal"
+        self.snapshot_file = f"{filename}.snapshot"
+        self.fsync_every = fsync_every
+        self.durability = durability
+        self.group_window = group_window
+        self.group_size = group_size
+        self.data = None
+        self.generation = 0
+        self.version = 0
+        self.key_versions = {}
+        self._offset = 0
+        self.checkpoint_offset = 0
+        self._base_mtime = None
+        # Containers copied since a checkpoint froze the data, see apply_op
+        self._owned = None
+        self._pending = 0
+        self._handle = None
+        self._lock = threading.RLock()
+        self._checkpoint_lock = threading.Lock()
+        self._file_lock = FileLock(f"{filename}.lock")
+        # Group commit: records written and synced by this process, counted from 1
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._waiting = 0
+        self._group_deadline = None
+        self._group = threading.Condition()
+        # Per thread lock depth and the last record it wrote, see locked
+        self._local = threading.local()
+        atexit.register(self.close)
+
+    # Loading
+    def _base_stamp(self):
+        # A compaction renames a new file into place, so the inode changes too
+        try:
+            stat = os.stat(self.filename)
+            return (stat.st_mtime_ns, stat.st_ino)
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        self._base_mtime = self._base_stamp()
+        snapshot = self._read_snapshot() if self._base_mtime is not None else None
+        if snapshot is not None:
+            self.data = snapshot["data"]
+            self._offset = snapshot["lsn"]
+        else:
+            try:
+                with open(self.filename, "r") as f:
+                    self.data = json.load(f)
+                    registry.record_io("read", self.filename, f.tell())
+            except FileNotFoundError:
+                self.data = default_data()
+                atomic_write_json(self.data, self.filename)
+            self._base_mtime = self._base_stamp()
+            self._offset = 0
+
+        self.checkpoint_offset = self._offset
+        self.generation += 1
+        self.version += 1
+        self.key_versions.clear()
+        self._replay()
+
+    def _read_snapshot(self):
+        # A snapshot only covers the base file and journal it was taken from
+        try:
+            with open(self.snapshot_file, "r") as f:
+                snapshot = json.load(f)
+                registry.record_io("read", self.snapshot_file, f.tell())
+        except (FileNotFoundError, ValueError):
+            return None
+
+        try:
+            size = os.stat(self.journal_file).st_size
+        except FileNotFoundError:
+            size = 0
+        if tuple(snapshot["base"]) != self._base_mtime or snapshot["lsn"] > size:
+            return None
+        return snapshot
+
+    def _replay(self):
+        start = self._offset
+        try:
+            with open(self.journal_file, "rb") as f:
+                f.seek(self._offset)
+                for line in f:
+                    # A line without a newline is a torn write, ignore it
+                    if not line.endswith(b"\n"):
+                        break
+                    self._apply_record(json.loads(line))
+                    self._offset += len(line)
+        except FileNotFoundError:
+            pass
+        if self._offset > start:
+            registry.record_io("read", self.journal_file, self._offset - start)
+
+    def refresh(self):
+        '''
+        refresh: Picks up changes written by other processes
+
+        Only the new tail of the journal is read, unless the base file was compacted
+        '''
+        with self._lock:
+            self._file_lock.acquire(shared=True)
+            try:
+                if self.data is None:
+                    self._load()
+                    return
+
+                try:
+                    size = os.stat(self.journal_file).st_size
+                except FileNotFoundError:
+                    size = 0
+
+                if self._base_stamp() != self._base_mtime or size < self._offset:
+                    self._load()
+                elif size > self._offset:
+                    self._replay()
+            finally:
+                self._file_lock.release()
+
+    @contextmanager
+    def locked(self):
+        '''
+        locked: Holds the exclusive lock, with the data refreshed, for a read-modify-write
+
+        Use as "with store.locked() as data:". With "group" durability the outermost
+        block returns only once everything it wrote is on disk
+        '''
+        local = self._local
+        local.depth = getattr(local, "depth", 0) + 1
+        try:
+            with self._lock:
+                self._file_lock.acquire()
+                try:
+                    self.refresh()
+                    yield self.data
+                finally:
+                    self._file_lock.release()
+        finally:
+            local.depth -= 1
+
+        # Wait after the locks are released so other writers can join the same fsync
+        lsn = getattr(local, "lsn", None)
+        if local.depth == 0 and lsn is not None:
+            local.lsn = None
+            self.commit(lsn)
+
+    def _apply_record(self, ops):
+        self.version += 1
+        for op in ops:
+            apply_op(self.data, op, self._owned)
+            path = op[1]
+            if len(path) > 1 and path[0] == "users":
+                self.key_versions[path[1]] = self.version
+            elif path[0] == "users":
+                self.generation += 1
+
+    def key_version(self, key):
+        '''
+        key_version: Version of a single user entry, changes whenever that entry changes
+
+        Args:
+            key: Account number as a string
+
+        returns tuple
+        '''
+        return (self.generation, self.key_versions.get(key, 0))
+
+    def read(self):
+        '''
+        read: Returns the current data. Treat it as read only, use set/append to change it
+
+        returns dict
+        '''
+        with self._lock:
+            self.refresh()
+            return self.data
+
+    # Writing
+    def apply(self, ops):
+        '''
+        apply: Applies a list of operations and appends them to the journal as one record
+
+        Args:
+            ops(list): List of [action, path, value] operations
+        '''
+        with self.locked():
+            payload = dump_compact(ops)
+            line = (payload + "\n").encode()
+
+            if self._handle is None:
+                self._handle = open(self.journal_file, "ab")
+            self._handle.write(line)
+            self._handle.flush()
+            self._offset += len(line)
+            registry.record_io("write", self.journal_file, len(line))
+
+            # Apply the decoded copy so the state never shares objects with the caller
+            self._apply_record(json.loads(payload))
+
+            self._written += 1
+            self._pending += 1
+            if self.durability == "fsync":
+                self.sync()
+            elif self.durability == "group":
+                self._local.lsn = self._written
+            elif self._pending >= self.fsync_every:
+                self.sync()
+
+    def set(self, path, value):
+        self.apply([["set", path, value]])
+
+    def append(self, path, value):
+        self.apply([["append", path, value]])
+
+    def sync(self):
+        '''
+        sync: Forces journal records written so far to disk
+        '''
+        with self._lock:
+            if self._handle is not None and self._pending:
+                os.fsync(self._handle.fileno())
+            self._pending = 0
+            self._mark_synced(self._written)
+
+    def _mark_synced(self, lsn):
+        with self._group:
+            if lsn > self._synced:
+                self._synced = lsn
+                self._group.notify_all()
+
+    def _flush_group(self):
+        # Syncs a duplicate of the journal handle so writers are not blocked during the fsync
+        with self._lock:
+            lsn = self._written
+            if self._handle is None or not self._pending:
+                return lsn
+            fd = os.dup(self._handle.fileno())
+            self._pending = 0
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return lsn
+
+    def commit(self, lsn):
+        '''
+        commit: Waits until record lsn of this process is on disk
+
+        The first writer to wait leads the group: it gives others group_window
+        seconds, or until group_size are waiting, to join and then syncs the
+        journal once for all of them. Only "group" durability ever waits here
+
+        Args:
+            lsn(int): Record number, counted from 1 by this store
+        '''
+        if self.durability != "group":
+            return
+        with self._group:
+            if self._synced >= lsn:
+                return
+            self._waiting += 1
+            if self._group_deadline is None:
+                self._group_deadline = time.monotonic() + self.group_window
+            if self._waiting >= self.group_size:
+                self._group.notify_all()
+            try:
+                while self._synced < lsn:
+                    if self._syncing:
+                        self._group.wait()
+                        continue
+                    remaining = (self._group_deadline or 0) - time.monotonic()
+                    if remaining > 0 and self._waiting < self.group_size:
+                        self._group.wait(remaining)
+                        continue
+
+                    self._syncing = True
+                    self._group_deadline = None
+                    synced = self._synced
+                    self._group.release()
+                    try:
+                        target = self._flush_group()
+                    finally:
+                        self._group.acquire()
+                        self._syncing = False
+                        self._group.notify_all()
+                    if target > self._synced:
+                        self._synced = target
+                    registry.inc("bank_group_commits_total", store=self.journal_file)
+                    registry.inc("bank_group_commit_records_total", target - synced,
+                                 store=self.journal_file)
+            finally:
+                self._waiting -= 1
+
+    def replace(self, data):
+        '''
+        replace: Replaces the whole data, rewriting the base file and clearing the journal
+        '''
+        with self._lock:
+            self._file_lock.acquire()
+            try:
+                self.data = data
+                self._write_base()
+            finally:
+                self._file_lock.release()
+            self.generation += 1
+            self.version += 1
+            self.key_versions.clear()
+
+    def compact(self):
+        '''
+        compact: Folds the journal into the base file and truncates the journal
+        '''
+        with self.locked():
+            self._write_base()
+
+    def _write_base(self):
+        # Callers hold the exclusive lock
+        atomic_write_json(self.data, self.filename)
+
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        open(self.journal_file, "wb").close()
+        # The snapshot covers the old base file, loads would read it only to reject it
+        try:
+            os.remove(self.snapshot_file)
+        except FileNotFoundError:
+            pass
+
+        self._base_mtime = self._base_stamp()
+        self._offset = 0
+        self.checkpoint_offset = 0
+        self._pending = 0
+        # The synced base file holds every record written so far
+        self._mark_synced(self._written)
+
+    def journal_size(self):
+        '''
+        journal_size: Bytes of journal written since the last compaction
+        '''
+        return self._offset
+
+    def tail_size(self):
+        '''
+        tail_size: Bytes of journal a load would replay after the latest checkpoint
+        '''
+        return self._offset - self.checkpoint_offset
+
+    def checkpoint(self):
+        '''
+        checkpoint: Writes a snapshot of the data tagged with the journal offset it covers
+
+        The data is frozen under the lock and serialized after it is released.
+        Until then writers copy the containers they change (copy on write), so the
+        pause is a shallow copy of the top level, not a dump of the whole data.
+        It is recorded as bank_checkpoint_pause_seconds
+
+        returns True if a snapshot was written, False if there was nothing new
+        '''
+        with self._checkpoint_lock:
+            with self._lock:
+                start = time.perf_counter()
+                self._file_lock.acquire(shared=True)
+                try:
+                    self.refresh()
+                    base, lsn = self._base_mtime, self._offset
+                    if lsn == self.checkpoint_offset:
+                        return False
+                    frozen = self.data
+                    self.data = dict(frozen)
+                    self._owned = {id(self.data)}
+                finally:
+                    self._file_lock.release()
+                registry.observe("bank_checkpoint_pause_seconds", time.perf_counter() - start,
+                                 store=self.filename)
+
+            try:
+                payload = dump_compact({"base": base, "lsn": lsn, "data": frozen})
+            finally:
+                with self._lock:
+                    self._owned = None
+
+            tmp_file = f"{self.snapshot_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.snapshot_file)
+            registry.record_io("write", self.snapshot_file, len(payload))
+
+            with self._lock:
+                # A compaction in the meantime already made the snapshot unnecessary
+                if self._base_mtime == base:
+                    self.checkpoint_offset = lsn
+            return True
+
+    def close(self):
+        with self._lock:
+            if self._handle is not None:
+                self.sync()
+                self._handle.close()
+                self._handle = None
+
+
+def history_matches(entry, since=None, until=None, types=None):
+    '''
+    history_matches: Checks a stored history entry against the history filters
+
+    Args:
+        entry(list): Stored transaction, the timestamp is "%Y-%m-%d %H:%M:%S" so it compares as text
+
+        since, until(str): Inclusive time bounds in the same format
+
+        types(set): Transaction types to keep e.g {"Deposit", "Transfer"}
+    '''
+    if since is not None and entry[1] < since:
+        return False
+    if until is not None and entry[1] > until:
+        return False
+    if types is not None and entry[2] not in types:
+        return False
+    return True
+
+
+class HistoryStore():
+    def __init__(self, directory):
+        '''
+        HistoryStore: One append-only file of transactions per account
+
+        Keeps heavy histories out of users.json and lets a page be read from a byte
+        offset without going through the entries before it.
+
+        Args:
+            directory: Folder holding <account number>.jsonl files
+        '''
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _file(self, acc_no):
+        return os.path.join(self.directory, f"{int(acc_no)}.jsonl")
+
+    def append(self, acc_no, entries):
+        payload = b"".join((dump_compact(entry) + "\n").encode() for entry in entries)
+        with open(self._file(acc_no), "ab") as f:
+            f.write(payload)
+        registry.record_io("write", self.directory, len(payload))
+
+    def read_all(self, acc_no):
+        entries, _ = self.page(acc_no, 0, None)
+        return entries
+
+    def page(self, acc_no, position, limit, since=None, until=None, types=None):
+        '''
+        page: Reads up to limit matching entries starting at byte offset position
+
+        returns (entries, next position or None once the end is reached)
+        '''
+        entries = []
+        try:
+            with open(self._file(acc_no), "rb") as f:
+                f.seek(position or 0)
+                while limit is None or len(entries) < limit:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        registry.record_io("read", self.directory, f.tell() - (position or 0))
+                        return entries, None
+                    entry = json.loads(line)
+                    if history_matches(entry, since, until, types):
+                        entries.append(entry)
+                registry.record_io("read", self.directory, f.tell() - (position or 0))
+                return entries, f.tell()
+        except FileNotFoundError:
+            return entries, None
+
+    def _write(self, filename, entries):
+        tmp_file = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(b"".join((dump_compact(entry) + "\n").encode() for entry in entries))
+        os.replace(tmp_file, filename)
+
+    def replace(self, acc_no, entries):
+        self._write(self._file(acc_no), entries)
+
+    # Rewriting every file in two steps, see JsonBackend._migrate_money
+    def stage(self, acc_no, convert):
+        '''
+        stage: Writes a converted copy of an account's history next to it
+
+        A copy left by an interrupted run is complete and kept, so staging again never
+        converts an entry twice. The copies replace the files in commit_staged
+        '''
+        staged = f"{self._file(acc_no)}.staged"
+        if os.path.exists(staged) or not os.path.exists(self._file(acc_no)):
+            return
+        self._write(staged, [convert(entry) for entry in self.read_all(acc_no)])
+
+    def commit_staged(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".jsonl.staged"):
+                staged = os.path.join(self.directory, name)
+                os.replace(staged, staged[:-len(".staged")])
+
+    def delete(self, acc_no):
+        try:
+            os.remove(self._file(acc_no))
+        except FileNotFoundError:
+            pass
+
+
+class JsonBackend():
+    def __init__(self, user_store, pin_store, history_dir=None):
+        '''
+        JsonBackend: Storage backend over the journaled users.json and utils.json
+
+        Args:
+            user_store(JournalStore): Store holding account data
+
+            pin_store(JournalStore): Store holding pins and login attempts
+
+            history_dir: Keep transaction histories in a HistoryStore in this folder
+            instead of under "Transaction History" in users.json
+        '''
+        self.user_store = user_store
+        self.pin_store = pin_store
+        self.history = HistoryStore(history_dir) if history_dir else None
+        # Default folder of the Bank's receipt store, next to users.json
+        self.receipt_dir = f"{user_store.filename}.receipts"
+        self._migrate_money()
+
+    def _migrate_money(self):
+        '''
+        _migrate_money: Converts files written before money was kept in minor units
+
+        Balances and history amounts were major unit floats. users.json is converted
+        in one rewrite that also sets "money_scale". Separate history files are staged
+        first and only swapped in once that is done, "money_migration" marks the swap
+        as pending so an interrupted run finishes it instead of converting again
+        '''
+        data = self.user_store.read()
+        if data.get("money_scale") == SCALE and "money_migration" not in data:
+            return
+
+        with self.user_store.locked() as data:
+            if data.get("money_scale") != SCALE:
+                data = json.loads(dump_compact(data))
+                for acc_no, record in data["users"].items():
+                    record["Balance"] = to_minor(record["Balance"])
+                    record["Transaction History"] = [entry_to_minor(entry)
+                                                     for entry in record.get("Transaction History", [])]
+                    if self.history is not None:
+                        self.history.stage(acc_no, entry_to_minor)
+                data["money_scale"] = SCALE
+                if self.history is not None:
+                    data["money_migration"] = "history"
+                self.user_store.replace(data)
+
+            if "money_migration" in data:
+                if self.history is not None:
+                    self.history.commit_staged()
+                self.user_store.apply([["delete", ["money_migration"], None]])
+
+    # Accounts
+    def get_account(self, acc_no):
+        return self.user_store.read()["users"].get(str(acc_no))
+
+    def account_version(self, acc_no):
+        self.user_store.refresh()
+        return self.user_store.key_version(str(acc_no))
+
+    def get_balances(self, acc_nos):
+        '''
+        get_balances: Looks up several balances at once
+
+        returns dict of account number to balance, missing accounts are left out
+        '''
+        return {acc_no: balance for acc_no, (balance, _) in self.get_states(acc_nos).items()}
+
+    def get_states(self, acc_nos):
+        '''
+        get_states: Looks up balances together with their versions for compare and swap
+
+        returns dict of account number to (balance, version)
+        '''
+        data = self.user_store.read()
+        users = data["users"]
+        versions = data.get("versions", {})
+        return {str(acc_no): (users[str(acc_no)]["Balance"], versions.get(str(acc_no), 0))
+                for acc_no in acc_nos if str(acc_no) in users}
+
+    def iter_accounts(self, include_history=True):
+        for record in list(self.user_store.read()["users"].values()):
+            yield record
+
+    def reserve_account_numbers(self, count=1):
+        '''
+        reserve_account_numbers: Reserves a block of account numbers
+
+        returns the first reserved account number
+        '''
+        with self.user_store.locked() as data:
+            first = int(data["next_account_number"])
+            self.user_store.set(["next_account_number"], first + count)
+            return first
+
+    def add_account(self, acc_no, record, pin):
+        acc_no = str(acc_no)
+        self.pin_store.set(["users", acc_no], {
+            "pin": pin,
+            "attempts": 0
+        })
+        self.user_store.set(["users", acc_no], record)
+
+    def add_accounts(self, accounts):
+        '''
+        add_accounts: Adds many accounts with one record per file
+
+        Args:
+            accounts(list): (account_number, record, pin) tuples
+        '''
+        self.pin_store.apply([["set", ["users", str(acc_no)], {"pin": pin, "attempts": 0}]
+                              for acc_no, _, pin in accounts])
+        self.user_store.apply([["set", ["users", str(acc_no)], record]
+                               for acc_no, record, _ in accounts])
+
+    def _bump_version(self, data, acc_no):
+        # Every change to an account moves its version, see apply_transactions
+        return ["set", ["versions", acc_no], data.get("versions", {}).get(acc_no, 0) + 1]
+
+    def set_contact_info(self, acc_no, contact_info):
+        acc_no = str(acc_no)
+        with self.user_store.locked() as data:
+            self.user_store.apply([
+                ["set", ["users", acc_no, "Other info"], contact_info],
+                self._bump_version(data, acc_no)
+            ])
+
+    def apply_transactions(self, changes, expected=None, idempotency=None):
+        '''
+        apply_transactions: Writes new balances and history entries as one record
+
+        Args:
+            changes(list): (account_number, new_balance, history_entry) tuples, history_entry may be None
+
+            expected(dict): Account number to the version read by get_states. Nothing is
+            written if any of them changed in the meantime
+
+            idempotency: (key, record) stored in the same record, nothing is written
+            if the key is already stored
+
+        returns True if the changes were written, False on a version conflict or a known key
+        '''
+        with self.user_store.locked() as data:
+            versions = data.get("versions", {})
+            if expected:
+                for acc_no, version in expected.items():
+                    if versions.get(str(acc_no), 0) != version:
+                        return False
+            if idempotency is not None and idempotency[0] in data.get("idempotency", {}):
+                return False
+
+            ops = []
+            bumped = {}
+            history = {}
+            for acc_no, balance, entry in changes:
+                acc_no = str(acc_no)
+                ops.append(["set", ["users", acc_no, "Balance"], balance])
+                if entry is not None:
+                    if self.history is not None:
+                        history.setdefault(acc_no, []).append(entry)
+                    else:
+                        ops.append(["append", ["users", acc_no, "Transaction History"], entry])
+                bumped[acc_no] = bumped.get(acc_no, versions.get(acc_no, 0)) + 1
+            for acc_no, version in bumped.items():
+                ops.append(["set", ["versions", acc_no], version])
+            if idempotency is not None:
+                ops.append(["set", ["idempotency", idempotency[0]], idempotency[1]])
+            if ops:
+                self.user_store.apply(ops)
+            for acc_no, entries in history.items():
+                self.history.append(acc_no, entries)
+        return True
+
+    # Idempotency keys
+    def get_idempotency_key(self, key):
+        return self.user_store.read().get("idempotency", {}).get(key)
+
+    def expire_idempotency_keys(self, before):
+        '''
+        expire_idempotency_keys: Forgets keys stored before the given epoch time
+        '''
+        with self.user_store.locked() as data:
+            expired = [key for key, record in data.get("idempotency", {}).items() if record["created"] < before]
+            if expired:
+                self.user_store.apply([["delete", ["idempotency", key], None] for key in expired])
+
+    def get_history(self, acc_no):
+        if self.history is not None:
+            return self.history.read_all(acc_no)
+        record = self.get_account(acc_no)
+        return list(record["Transaction History"]) if record else []
+
+    def page_history(self, acc_no, position=None, limit=50, since=None, until=None, types=None):
+        '''
+        page_history: Reads a page of history entries, oldest first
+
+        Args:
+            position: Where the previous page stopped, None for the start
+
+            limit(int): Maximum number of entries returned
+
+            since, until, types: Filters, see history_matches
+
+        returns (entries, next position or None once the end is reached)
+        '''
+        if self.history is not None:
+            return self.history.page(acc_no, position, limit, since, until, types)
+
+        record = self.get_account(acc_no)
+        history = record["Transaction History"] if record else []
+        index = position or 0
+        entries = []
+        while index < len(history) and len(entries) < limit:
+            if history_matches(history[index], since, until, types):
+                entries.append(history[index])
+            index += 1
+        return entries, (index if index < len(history) else None)
+
+    @contextmanager
+    def locked(self):
+        '''
+        locked: Holds the exclusive lock on both files, nested writes are allowed
+        '''
+        with self.user_store.locked(), self.pin_store.locked():
+            yield
+
+    # Moving accounts between backends
+    def account_numbers(self, start=None, end=None):
+        '''
+        account_numbers: Account numbers stored here, optionally limited to [start, end)
+
+        returns sorted list of strings
+        '''
+        numbers = [int(acc_no) for acc_no in self.user_store.read()["users"]]
+        return [str(number) for number in sorted(numbers)
+                if (start is None or number >= start) and (end is None or number < end)]
+
+    def export_accounts(self, acc_nos):
+        '''
+        export_accounts: Everything stored for the given accounts
+
+        returns list of (account_number, record, credentials, version)
+        '''
+        entries = []
+        # Locked and copied, so every record matches the version exported with it
+        with self.locked():
+            data = self.user_store.data
+            pins = self.pin_store.data["users"]
+            versions = data.get("versions", {})
+            for acc_no in map(str, acc_nos):
+                if acc_no not in data["users"]:
+                    continue
+                record = data["users"][acc_no]
+                if self.history is not None:
+                    history = self.history.read_all(acc_no)
+                else:
+                    history = list(record["Transaction History"])
+                record = dict(record, **{"Transaction History": history})
+                entries.append((acc_no, record, pins.get(acc_no), versions.get(acc_no, 0)))
+        return entries
+
+    def import_accounts(self, entries):
+        '''
+        import_accounts: Stores entries from export_accounts, replacing existing accounts
+        '''
+        if not entries:
+            return
+        if self.history is not None:
+            for acc_no, record, _, _ in entries:
+                self.history.replace(acc_no, record["Transaction History"])
+            entries = [(acc_no, dict(record, **{"Transaction History": []}), credentials, version)
+                       for acc_no, record, credentials, version in entries]
+        self.pin_store.apply([["set", ["users", acc_no], credentials]
+                              for acc_no, _, credentials, _ in entries])
+        self.user_store.apply([op for acc_no, record, _, version in entries
+                               for op in (["set", ["users", acc_no], record],
+                                          ["set", ["versions", acc_no], version])])
+
+    def delete_accounts(self, acc_nos):
+        if not acc_nos:
+            return
+        self.pin_store.apply([["delete", ["users", str(acc_no)], None] for acc_no in acc_nos])
+        self.user_store.apply([op for acc_no in acc_nos
+                               for op in (["delete", ["users", str(acc_no)], None],
+                                          ["delete", ["versions", str(acc_no)], None])])
+        if self.history is not None:
+            for acc_no in acc_nos:
+                self.history.delete(acc_no)
+
+    def restore_accounts(self, records):
+        '''
+        restore_accounts: Writes account records from a snapshot, replacing existing accounts
+
+        Existing credentials are kept, new accounts get no pin (None) and cannot
+        login until one is set.
+        History is cleared, it is restored through append_history
+        '''
+        if not records:
+            return
+        with self.user_store.locked() as data, self.pin_store.locked() as pins:
+            versions = data.get("versions", {})
+            ops = []
+            for record in records:
+                acc_no = record["Account Number"]
+                ops.append(["set", ["users", acc_no], dict(record, **{"Transaction History": []})])
+                ops.append(["set", ["versions", acc_no], versions.get(acc_no, 0) + 1])
+            highest = max(int(record["Account Number"]) for record in records)
+            if highest >= int(data["next_account_number"]):
+                ops.append(["set", ["next_account_number"], highest + 1])
+
+            self.pin_store.apply([["set", ["users", record["Account Number"]], {"pin": None, "attempts": 0}]
+                                  for record in records if record["Account Number"] not in pins["users"]])
+            self.user_store.apply(ops)
+            if self.history is not None:
+                for record in records:
+                    self.history.delete(record["Account Number"])
+
+    def append_history(self, entries):
+        '''
+        append_history: Appends history entries without touching balances
+
+        Args:
+            entries(list): (account_number, history_entry) tuples, oldest first
+        '''
+        by_account = {}
+        for acc_no, entry in entries:
+            by_account.setdefault(str(acc_no), []).append(entry)
+        if not by_account:
+            return
+        with self.user_store.locked() as data:
+            versions = data.get("versions", {})
+            ops = [["set", ["versions", acc_no], versions.get(acc_no, 0) + 1] for acc_no in by_account]
+            if self.history is None:
+                ops.extend(["append", ["users", acc_no, "Transaction History"], entry]
+                           for acc_no, account_entries in by_account.items() for entry in account_entries)
+            self.user_store.apply(ops)
+            if self.history is not None:
+                for acc_no, account_entries in by_account.items():
+                    self.history.append(acc_no, account_entries)
+
+    # Credentials
+    def get_credentials(self, acc_no):
+        return self.pin_store.read()["users"].get(str(acc_no))
+
+    def set_pin(self, acc_no, pin):
+        acc_no = str(acc_no)
+        with self.locked():
+            self.pin_store.set(["users", acc_no, "pin"], pin)
+            self.user_store.apply([self._bump_version(self.user_store.data, acc_no)])
+
+    def set_attempts(self, acc_no, attempts):
+        acc_no = str(acc_no)
+        with self.locked():
+            self.pin_store.set(["users", acc_no, "attempts"], attempts)
+            self.user_store.apply([self._bump_version(self.user_store.data, acc_no)])
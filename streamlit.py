@@ -1,38 +1,49 @@
 import streamlit as st
-import pandas as pd
-import json
+import os
 import time
-from main import Account, Bank, hash_pin, read_json
+import uuid
+from main import Bank, hash_pin
+from metrics import render_streamlit
+from money import to_minor
 
-user_file = "users.json"
-users_data = read_json(user_file)
+st.title("Welcome to the Royal Bank")
 
-pin_file = "utils.json"
-pin_data = read_json(pin_file)
+# The metrics page shows operation counts, latencies and file paths, so it is
+# only offered to operators who start the app with BANK_SHOW_METRICS=1
+SHOW_METRICS = os.environ.get("BANK_SHOW_METRICS", "0") == "1"
+
+# One Bank per server process, shared by every session and rerun. Its account
+# cache compares the stored version on every lookup, so changes written by other
+# sessions or processes show up without reloading the whole book.
+@st.cache_resource
+def get_bank():
+    return Bank("The Royal Bank")
+
+bank = get_bank()
+
+
+# A deposit, withdrawal or transfer keeps its idempotency key until its result is
+# shown, so a rerun that interrupts the script after the write replays the result
+def submission_key(action):
+    name = f"{action}_idempotency_key"
+    if name not in st.session_state:
+        st.session_state[name] = uuid.uuid4().hex
+    return st.session_state[name]
+
+
+def submission_done(action):
+    st.session_state.pop(f"{action}_idempotency_key", None)
 
-st.title("Welcome to the Royal Bank")
-    
-# Initialize bank
-if 'bank' not in st.session_state:
-    st.session_state.bank = Bank("The Royal Bank")
-    
 # Initialize login and account number
 if 'login' not in st.session_state:
     st.session_state.login = False
     st.session_state.account_number = None
 
-# Initialize trial
-if 'trial' not in st.session_state:
-    st.session_state.trial = 0
-
-# Initialize max trials
-if 'max_trials' not in st.session_state:
-    st.session_state.max_trials = 3
-
 if not st.session_state.login:
     st.sidebar.title("Home Page Functions")
     function_option = st.sidebar.selectbox("Home Page Functions", ["Create New Account",
-                                               "Login", "About/Help Information"])
+                                               "Login", "About/Help Information"]
+                                           + (["Metrics"] if SHOW_METRICS else []))
 else:
     st.sidebar.title("Main Bank Functions")
     function_option = st.sidebar.selectbox("What do you want to do today?",
@@ -63,7 +74,8 @@ if function_option == "Create New Account":
         if st.form_submit_button("Create Account"):
             if name and deposit and input_pin and contact_info:
                 pin = hash_pin(input_pin)
-                result = st.session_state.bank.create_account(name, deposit, pin, contact_info)
+                # Amounts are typed in major units and kept in minor units
+                result = bank.create_account(name, to_minor(deposit), pin, contact_info)
                 st.success(result)
                 time.sleep(3)
                 st.rerun()
@@ -76,37 +88,26 @@ elif function_option == "Login":
         
     account_number = st.number_input("Account Number", placeholder="Please enter your account number", step=1)
     input_pin = st.text_input("pin", placeholder="Please input your pin", type="password", max_chars=4)
-    acc_nos = str(account_number)
-    
-    
-    max_trials = st.session_state.max_trials
-    user_file = "users.json"
-    users_data = read_json(user_file)
-    
-
 
 
     if st.button("Login"):
         if account_number and input_pin:
             if len(input_pin) == 4:
-                for acc_no in users_data["users"].keys():
-                    trial = int(pin_data["users"][acc_nos]["attempts"])
-
-                    if trial <= (max_trials - 1):
-                        if account_number == int(acc_no):
-                            pin = hash_pin(input_pin)
-                            result = st.session_state.bank.authenticate(account_number, pin)
-                            st.success(result)
-
-                            if result == "Login successful":
-                                st.session_state.login = True
-                                st.session_state.account_number = account_number
-                            
-                                st.rerun()
-                        else:
-                            st.info("Account not found. Please create an account or check input")
-                    else:
-                        st.warning("Please refer to Support ")
+                # One pin check, later pages only validate the session token
+                pin = hash_pin(input_pin)
+                result, token = bank.login(account_number, pin)
+
+                if token is not None:
+                    st.session_state.login = True
+                    st.session_state.account_number = account_number
+                    st.session_state.session_token = token
+                    st.rerun()
+                elif result.startswith("No account number found"):
+                    st.info("Account not found. Please create an account or check input")
+                elif result.startswith("You have exceeded"):
+                    st.warning("Please refer to Support ")
+                else:
+                    st.success(result)
             else:
                 st.info("Pin must be a minimum of 4 digits")
         else:
@@ -126,84 +127,93 @@ elif function_option == "About/Help Information":
     st.markdown("If you'd like to join us, please create an account or login")
     st.markdown("If you have more questions, please reach out to us on 0xfoenix@gmail.com")
 
-# Initialize login
-if st.session_state.login:
-    acc_no = str(st.session_state.account_number)
-    for acc_no in users_data["users"].keys():
-        if int(acc_no) == st.session_state.account_number:
-            st.title(f"Welcome, {users_data["users"][acc_no]["Account Name"]}")
+# Admin view of the operation metrics
+elif function_option == "Metrics" and SHOW_METRICS:
+    render_streamlit()
+
+# Expired sessions go back to the login page
+if st.session_state.login and bank.session_account(
+        st.session_state.get("session_token")) != st.session_state.account_number:
+    st.session_state.login = False
+    st.session_state.account_number = None
+    st.rerun()
+
+# The logged in account, looked up by its number
+account = bank.find_account(st.session_state.account_number) if st.session_state.login else None
+
+if account is not None:
+    st.title(f"Welcome, {account.account_name}")
+
 
-    
 # Deposit function
 if function_option == "Deposit":
-    if st.session_state.account_number:
+    if account is not None:
         amount = st.number_input("Amount", placeholder="Input the amount you want to deposit", min_value=100)
-        acc_no = str(st.session_state.account_number)
-        acc_data = list(users_data["users"][acc_no].values())
         Deposit = st.button("Deposit", key=f"deposit_{st.session_state.account_number}")
-        
-        for acc_no in users_data["users"].keys():
-            if Deposit:
-                if int(acc_no) == st.session_state.account_number:
-                    if amount:
-                        if amount >= 100:
-                            account = Account(*acc_data)
-                            result = account.deposit(amount)
-                            st.success(result)
-                        else:
-                            st.info("Please increase deposit amount")
-                    else:
-                        st.info("Please input a valid amount")
+
+        if Deposit:
+            if amount:
+                if amount >= 100:
+                    result = account.deposit(to_minor(amount), idempotency_key=submission_key("deposit"))
+                    st.success(result)
+                    submission_done("deposit")
+                else:
+                    st.info("Please increase deposit amount")
+            else:
+                st.info("Please input a valid amount")
     else:
         st.info("Please log in")
 
 
 # Withdraw function
 elif function_option == "Withdraw":
-    if st.session_state.account_number:
+    if account is not None:
         amount = st.number_input("Amount", placeholder="Input the amount you wish to withdraw", min_value=10)
-        acc_no = str(st.session_state.account_number)
-        acc_data = list(users_data["users"][acc_no].values())
         Withdraw = st.button("Withdraw", key=f"withdraw_{st.session_state.account_number}")
-        
-        for acc_no in users_data["users"].keys():
-            if Withdraw:
-                if int(acc_no) == st.session_state.account_number:
-                    if amount:
-                        if amount >=10:
-                            account = Account(*acc_data)
-                            st.write(account.balance)
-                            result = account.withdraw(amount)
-                            st.success(result)
-                        else:
-                            st.info("Please increase amount to withdraw")
-                    else:
-                        st.info("Please input a valid amount")
+
+        if Withdraw:
+            if amount:
+                if amount >=10:
+                    result = account.withdraw(to_minor(amount), idempotency_key=submission_key("withdraw"))
+                    st.success(result)
+                    submission_done("withdraw")
+                else:
+                    st.info("Please increase amount to withdraw")
+            else:
+                st.info("Please input a valid amount")
     else:
         st.warning("Please log in or Create an account")
     
 # Transfer function
 elif function_option == "Transfer":
-    if st.session_state.account_number:
+    if account is not None:
         d_account = st.number_input("Account", placeholder="Input the account you want to transfer to", step=1)
         amount = st.number_input("Amount", placeholder="Input the amount you want to transfer", step=1)
         s_account = st.session_state.account_number
-        d_acc_no = str(d_account)
         
         Transfer = st.button("Transfer", key=f"transfer_{st.session_state.account_number}")
         
             
         if Transfer:
             if d_account and amount:
-                for acc_no in users_data["users"].keys():
-                    if d_account == int(acc_no):
-                        if amount > 0:
-                            result, message = st.session_state.bank.transfer(s_account, d_account, amount)
-                            st.success(message)
-
-                            st.write(result)
-                        else:
-                            st.info("Please enter a valid amount to withdraw")
+                if bank.find_account(d_account) is None:
+                    st.info("Account not found. Please check the account number")
+                elif int(d_account) == int(s_account):
+                    st.info("Please choose another account to transfer to")
+                elif amount > 0:
+                    result = bank.transfer(s_account, d_account, to_minor(amount),
+                                           idempotency_key=submission_key("transfer"))
+                    # Failed transfers only return a message
+                    if isinstance(result, tuple):
+                        receipt, message = result
+                        st.success(message)
+
+                        st.write(receipt)
+                    else:
+                        st.info(result)
+                    submission_done("transfer")
+                else:
+                    st.info("Please enter a valid amount to withdraw")
             else:
                 st.warning("Please input the necessary details")
     else:
@@ -211,18 +221,13 @@ elif function_option == "Transfer":
 
 # Check balance function
 elif function_option == "Check Balance":
-    acc_no = str(st.session_state.account_number)
-    acc_data = list(users_data["users"][acc_no].values())
-    account = Account(*acc_data)
     Check_Bal = st.button("Check Balance", key=f"check_bal_{st.session_state.account_number}")
 
 
-    if st.session_state.account_number:
+    if account is not None:
         if Check_Bal:
-            for acc_no in users_data["users"].keys():
-                if int(acc_no) == st.session_state.account_number:
-                    result = account.check_balance()
-                    st.success(result)
+            result = account.check_balance()
+            st.success(result)
                 
         
     else:
@@ -230,92 +235,91 @@ elif function_option == "Check Balance":
 
 # View Transaction history
 elif function_option == "View Transaction history":
-    acc_no = str(st.session_state.account_number)
-    acc_data = list(users_data["users"][acc_no].values())
-    account = Account(*acc_data)
-    View_tx = st.button("View tx history", key=f"view_tx_{st.session_state.account_number}")
-
-    if st.session_state.account_number:
-        if View_tx:
-            for acc_no in users_data["users"].keys():
-                if int(acc_no) == st.session_state.account_number:
-                    tx_data = account.get_transaction_history()
+    if account is not None:
+        tx_types = st.multiselect("Transaction types", ["Deposit", "Withdraw", "Transfer"],
+                                  default=["Deposit", "Withdraw", "Transfer"])
+        page_size = st.selectbox("Transactions per page", [25, 50, 100])
+        View_tx = st.button("View tx history", key=f"view_tx_{st.session_state.account_number}")
+
+        # Pages already loaded and the token for the next one, for the logged in account only
+        if (View_tx or "tx_pages" not in st.session_state
+                or st.session_state.get("tx_account") != st.session_state.account_number):
+            st.session_state.tx_pages = []
+            st.session_state.tx_token = None
+            st.session_state.tx_done = not View_tx
+            st.session_state.tx_account = st.session_state.account_number
+
+        if View_tx or (st.session_state.tx_pages and st.button("Load more", disabled=st.session_state.tx_done)):
+            page, token = account.get_transaction_page(page_size, types=tx_types,
+                                                       token=st.session_state.tx_token)
+            st.session_state.tx_pages.append(page)
+            st.session_state.tx_token = token
+            st.session_state.tx_done = token is None
+
+        for page in st.session_state.tx_pages:
+            st.write(page)
+        if st.session_state.tx_pages and not any(st.session_state.tx_pages):
+            st.write("No transactions yet")
 
-                    st.write(tx_data)
-                
     else:
         st.info("Please login or create an account")
     
 # Update an account info
 elif function_option == "Update account information":
-    if st.session_state.account_number:
-        acc_no = str(st.session_state.account_number)
-        acc_data = list(users_data["users"][acc_no].values())
-        account = Account(*acc_data)
-        Update = st.form_submit_button("Update Account Info")
-
-        for acc_no in users_data["users"].keys():
-            if int(acc_no) == st.session_state.account_number:
-
-                with st.form("Edit contact info"):
-                    edit_phone = st.text_input("Phone_number", placeholder="Please input your number", value=account.contact_info["phone"])
-                    edit_address = st.text_input("Address", placeholder="Please input your address", value=account.contact_info["address"])
-                    edit_next_of_kin = st.text_input("Next of Kin(Optional)", placeholder="Please add the name of your next of kin", value=account.contact_info["next of kin"])
-                    edit_next_of_kin_phone = st.text_input("Next of Kin phone(Optional)", placeholder="Please add the phone of your next of kin", value=account.contact_info["next of kin phone"])
-
-                    if Update:
-                        if edit_phone and edit_address and edit_next_of_kin and edit_next_of_kin_phone:
-                            new_info = {
-                                edit_phone,
-                                edit_address,
-                                edit_next_of_kin,
-                                edit_next_of_kin_phone
-                            }
-
-                            result = account.update_contact_info(new_info)
-                            st.success(result)
-                        else:
-                            st.info("Please input the necessary details")
+    if account is not None:
+        with st.form("Edit contact info"):
+            edit_phone = st.text_input("Phone_number", placeholder="Please input your number", value=account.contact_info.get("phone", ""))
+            edit_address = st.text_input("Address", placeholder="Please input your address", value=account.contact_info.get("address", ""))
+            edit_next_of_kin = st.text_input("Next of Kin(Optional)", placeholder="Please add the name of your next of kin", value=account.contact_info.get("next of kin", ""))
+            edit_next_of_kin_phone = st.text_input("Next of Kin phone(Optional)", placeholder="Please add the phone of your next of kin", value=account.contact_info.get("next of kin phone", ""))
+
+            if st.form_submit_button("Update Account Info"):
+                if edit_phone and edit_address:
+                    new_info = {
+                        "phone": edit_phone,
+                        "address": edit_address,
+                        "next of kin": edit_next_of_kin,
+                        "next of kin phone": edit_next_of_kin_phone
+                    }
+
+                    result = account.update_contact_info(new_info)
+                    st.success(result)
+                else:
+                    st.info("Please input the necessary details")
     else:
         st.info("Please create an account or login")
 
 # Change PIN
 elif function_option == "Change PIN":
-    acc_no = str(st.session_state.account_number)
-    acc_data = list(users_data["users"][acc_no].values())
-    account = Account(*acc_data)
     Change_PIN = st.button("Change PIN", key=f"change_pin_{st.session_state.account_number}")
 
-    if st.session_state.account_number:
+    if account is not None:
         i_old_pin = st.text_input("Old Pin", placeholder="Please input your current pin", type="password", max_chars=4, key=f"old_pin_{st.session_state.account_number}")
         i_new_pin = st.text_input("New Pin", placeholder="Please input your new pin", type="password", max_chars=4, key=f"new_pin_{st.session_state.account_number}")
         i_new_pin2 = st.text_input("New Pin", placeholder="Enter your new pin again", type="password", max_chars=4, key=f"new_pin2{st.session_state.account_number}")
         
 
         if Change_PIN:
-            for acc_no in users_data["users"].keys():
-                if int(acc_no) == st.session_state.account_number:
-                        if i_old_pin and i_new_pin and i_new_pin2:
-                            old_pin = hash_pin(i_old_pin)
-                            new_pin = hash_pin(i_new_pin)
-                            new_pin2 = hash_pin(i_new_pin2)
-                            if new_pin == new_pin2:
-                                result = account.change_pin(old_pin, new_pin)
-                                st.success(result)
-                            else:
-                                st.info("Pin does not match")
-                        else:
-                            st.info("Please input pin")
+            if i_old_pin and i_new_pin and i_new_pin2:
+                old_pin = hash_pin(i_old_pin)
+                new_pin = hash_pin(i_new_pin)
+                new_pin2 = hash_pin(i_new_pin2)
+                if new_pin == new_pin2:
+                    result = account.change_pin(old_pin, new_pin)
+                    st.success(result)
+                else:
+                    st.info("Pin does not match")
+            else:
+                st.info("Please input pin")
     else:
         st.info("Please create a new account or login")
 
 elif function_option == "Find Account":
     Find = st.button("Find Account", key=f"find_{st.session_state.account_number}")
 
-    if st.session_state.account_number:
+    if account is not None:
         if Find:
-            result =st.session_state.bank.find_account(st.session_state.account_number)
-            st.write(result)
+            st.write(account)
 
     
 # Log out
@@ -324,10 +328,12 @@ elif function_option == "Logout":
 
     if st.session_state.account_number:
         if Logout:
+            bank.logout(st.session_state.get("session_token"))
             st.session_state.login = False
             st.session_state.account_number = None
+            st.session_state.session_token = None
+            for name in ("tx_pages", "tx_token", "tx_done", "tx_account"):
+                st.session_state.pop(name, None)
             st.rerun()
     else:
         st.info("Please login or create an account")
-            
-            
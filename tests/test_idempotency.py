@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from idempotency import KEY_REUSED
+from main import Bank
+from sqlite_backend import SQLiteBackend
+from storage import JournalStore, JsonBackend
+
+
+class IdempotencyTests():
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = self.open_backend()
+        self.bank = self.open_bank()
+        for index in range(2):
+            self.bank.create_account(f"owner {index}", 10000, "pin", {"phone": str(index)})
+
+    def open_bank(self):
+        return Bank("test", backend=self.backend, receipt_dir=os.path.join(self.directory, "receipts"))
+
+    def test_replay_returns_the_first_result(self):
+        account = self.bank.find_account(1)
+        first = account.deposit(500, idempotency_key="deposit")
+        self.assertEqual(account.deposit(500, idempotency_key="deposit"), first)
+        receipt, message = self.bank.transfer(1, 2, 300, idempotency_key="transfer")
+        self.assertEqual(self.bank.transfer(1, 2, 300, idempotency_key="transfer"), (receipt, message))
+        self.assertEqual(self.backend.get_balances(["1", "2"]), {"1": 10200, "2": 10300})
+
+    def test_replay_from_storage(self):
+        self.bank.find_account(1).withdraw(500, idempotency_key="withdraw")
+        # A new Bank has nothing in memory, the key comes from the backend
+        restarted = self.open_bank()
+        self.assertEqual(restarted.find_account(1).withdraw(500, idempotency_key="withdraw"),
+                         "Your withdrawal of 5.00 is successful")
+        self.assertEqual(self.backend.get_balances(["1"]), {"1": 9500})
+
+    def test_key_reused_for_another_request(self):
+        self.bank.find_account(1).deposit(500, idempotency_key="key")
+        self.assertEqual(self.bank.find_account(1).deposit(600, idempotency_key="key"), KEY_REUSED)
+        self.assertEqual(self.bank.transfer(1, 2, 500, idempotency_key="key"), KEY_REUSED)
+        self.assertEqual(self.backend.get_balances(["1", "2"]), {"1": 10500, "2": 10000})
+
+    def test_expired_key_is_accepted_again(self):
+        self.bank.idempotency.ttl = 0.01
+        self.bank.find_account(1).deposit(500, idempotency_key="key")
+        time.sleep(0.02)
+        self.bank.idempotency.cache.clear()
+        self.assertEqual(self.bank.find_account(1).deposit(500, idempotency_key="key"),
+                         "Your deposit of 5.00 is successful")
+        self.assertEqual(self.backend.get_balances(["1"]), {"1": 11000})
+
+
+class TestJsonIdempotency(IdempotencyTests, unittest.TestCase):
+    def open_backend(self):
+        return JsonBackend(JournalStore(os.path.join(self.directory, "users.json")),
+                           JournalStore(os.path.join(self.directory, "utils.json")))
+
+
+class TestSQLiteIdempotency(IdempotencyTests, unittest.TestCase):
+    def open_backend(self):
+        return SQLiteBackend(os.path.join(self.directory, "bank.db"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import Bank
+from money import SCALE, minor_amount, to_minor
+from sqlite_backend import SQLiteBackend
+from storage import JournalStore, JsonBackend
+
+
+def legacy_entry(transaction_id, amount, ending_balance):
+    # History entries written before money was kept in minor units
+    return [transaction_id, "2024-01-02 10:00:00", "Deposit", amount, 1, ending_balance, None]
+
+
+class TestMinorAmount(unittest.TestCase):
+    def test_integers_only(self):
+        self.assertEqual(minor_amount(1250), 1250)
+        for amount in (12.5, "1250", True, None):
+            self.assertIsNone(minor_amount(amount))
+
+    def test_to_minor_is_exact(self):
+        self.assertEqual(to_minor(10.1), 1010)
+        self.assertEqual(to_minor("150.25"), 15025)
+
+
+class TestJsonMigration(unittest.TestCase):
+    def test_major_units_are_converted_once(self):
+        directory = tempfile.mkdtemp()
+        user_file = os.path.join(directory, "users.json")
+        with open(user_file, "w") as f:
+            json.dump({"users": {"1": {
+                "Account Name": "owner",
+                "Account Number": "1",
+                "Balance": 110.1,
+                "Other info": {},
+                "Created on": "2024-01-01 09:00:00",
+                "Transaction History": [legacy_entry("a", 10.1, 110.1)]
+            }}, "next_account_number": 2}, f)
+
+        backend = JsonBackend(JournalStore(user_file), JournalStore(os.path.join(directory, "utils.json")))
+        self.assertEqual(backend.get_account("1")["Balance"], 11010)
+        self.assertEqual(backend.get_history("1"), [legacy_entry("a", 1010, 11010)])
+        self.assertEqual(backend.user_store.read()["money_scale"], SCALE)
+
+        reopened = JsonBackend(JournalStore(user_file), JournalStore(os.path.join(directory, "utils.json")))
+        self.assertEqual(reopened.get_account("1")["Balance"], 11010)
+
+
+class TestSQLiteMigration(unittest.TestCase):
+    def test_real_columns_become_minor_units(self):
+        db_file = os.path.join(tempfile.mkdtemp(), "bank.db")
+        conn = sqlite3.connect(db_file)
+        conn.executescript("""
+            CREATE TABLE accounts (account_number INTEGER PRIMARY KEY, account_name TEXT NOT NULL,
+                                   balance REAL NOT NULL, contact_info TEXT, created_on TEXT);
+            CREATE TABLE credentials (account_number INTEGER PRIMARY KEY, pin TEXT NOT NULL,
+                                      attempts INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, account_number INTEGER NOT NULL,
+                                       transaction_id TEXT NOT NULL, timestamp TEXT NOT NULL,
+                                       transaction_type TEXT NOT NULL, amount REAL NOT NULL,
+                                       source_account INTEGER, ending_balance REAL NOT NULL,
+                                       destination_account INTEGER);
+            INSERT INTO accounts VALUES (1, 'owner', 110.1, '{}', '2024-01-01 09:00:00');
+            INSERT INTO credentials VALUES (1, 'hash', 0), (2, '', 0);
+            INSERT INTO transactions (account_number, transaction_id, timestamp, transaction_type, amount,
+                                      source_account, ending_balance)
+                VALUES (1, 'a', '2024-01-02 10:00:00', 'Deposit', 10.1, 1, 110.1);
+        """)
+        conn.commit()
+        conn.close()
+
+        backend = SQLiteBackend(db_file)
+        self.assertEqual(backend.get_account("1")["Balance"], 11010)
+        self.assertEqual(backend.get_history("1"), [legacy_entry("a", 1010, 11010)])
+        # Empty pins of the old schema mean no pin
+        self.assertEqual(backend.get_credentials("1")["pin"], "hash")
+        self.assertIsNone(backend.get_credentials("2")["pin"])
+        backend.close()
+
+        reopened = SQLiteBackend(db_file)
+        self.assertEqual(reopened.get_account("1")["Balance"], 11010)
+
+
+class TestInitialDeposits(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        backend = JsonBackend(JournalStore(os.path.join(directory, "users.json")),
+                              JournalStore(os.path.join(directory, "utils.json")))
+        self.bank = Bank("test", backend=backend, receipt_dir=os.path.join(directory, "receipts"))
+
+    def test_create_account_refuses_non_positive_deposits(self):
+        for amount in (-500, 0, 12.5):
+            self.assertEqual(self.bank.create_account("owner", amount, "pin", {"phone": "1"}), "Invalid amount")
+        self.assertIsNone(self.bank.find_account(1))
+
+    def test_create_accounts_reports_non_positive_deposits(self):
+        customers = [{"name": f"owner {index}", "initial_deposit": amount, "pin": "pin", "contact_info": {"phone": "1"}}
+                     for index, amount in enumerate((-500, 1000, -7, 0))]
+        created, errors = self.bank.create_accounts(customers, workers=0)
+        self.assertEqual(created, [1])
+        self.assertEqual(errors, [(0, "Invalid amount"), (2, "Invalid amount"), (3, "Invalid amount")])
+        self.assertEqual(self.bank.backend.get_balances(["1"]), {"1": 1000})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import Bank, generate_transaction_id
+from receipts import ReceiptStore
+from storage import JournalStore, JsonBackend
+
+
+def receipt(transaction_id, amount=100):
+    return {"Transaction Id": transaction_id, "Time Stamp": "2024-01-02 10:00:00",
+            "Transaction Type": "Deposit", "Amount": amount, "Account": 1, "Ending Balance": amount}
+
+
+class TestReceiptStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ReceiptStore(self.directory, capacity=4)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_lookup_after_the_index_grows(self):
+        ids = [generate_transaction_id() for _ in range(50)]
+        self.store.add([receipt(transaction_id, index) for index, transaction_id in enumerate(ids)])
+        self.assertEqual(len(self.store), 50)
+        for index, transaction_id in enumerate(ids):
+            self.assertEqual(self.store.get(transaction_id)["Amount"], index)
+        self.assertIsNone(self.store.get(generate_transaction_id()))
+
+    def test_legacy_ids_and_replacement(self):
+        self.store.add([receipt("3f2c-legacy-uuid", 100)])
+        self.store.add([receipt("3f2c-legacy-uuid", 200)])
+        self.assertEqual(self.store.get("3f2c-legacy-uuid")["Amount"], 200)
+        self.assertEqual(len(self.store), 1)
+
+    def test_reopen_and_torn_write(self):
+        transaction_id = generate_transaction_id()
+        self.store.add([receipt(transaction_id)])
+        # A crash left half a line behind, the next writer cuts it off
+        with open(self.store.data_file, "ab") as f:
+            f.write(b'{"Transaction Id": "torn')
+
+        reopened = ReceiptStore(self.directory)
+        later = generate_transaction_id()
+        reopened.add([receipt(later, 300)])
+        self.assertEqual(reopened.get(transaction_id)["Amount"], 100)
+        self.assertEqual(reopened.get(later)["Amount"], 300)
+        reopened.close()
+
+
+class TestBankReceipts(unittest.TestCase):
+    def test_receipts_of_every_transaction(self):
+        directory = tempfile.mkdtemp()
+        backend = JsonBackend(JournalStore(os.path.join(directory, "users.json")),
+                              JournalStore(os.path.join(directory, "utils.json")))
+        bank = Bank("test", backend=backend)
+        # Next to the backend's files unless a folder is given
+        self.assertEqual(bank.receipts.directory, backend.receipt_dir)
+
+        for index in range(2):
+            bank.create_account(f"owner {index}", 10000, "pin", {"phone": str(index)})
+        bank.find_account(1).deposit(500)
+        (transfer, _), = bank.transfer_many([(1, 2, 300)])
+        for entry in bank.backend.get_history("1"):
+            self.assertEqual(bank.get_receipt(entry[0])["Transaction Type"], entry[2])
+        self.assertEqual(bank.get_receipt(transfer["Transaction Id"])["Receiver"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
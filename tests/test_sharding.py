@@ -0,0 +1,136 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import Bank
+from sharding import ShardedBackend
+from sqlite_backend import SQLiteBackend
+
+
+class ShardCrash(Exception):
+    pass
+
+
+def fail_once(backend):
+    # The next intent written to this shard fails before anything is stored
+    apply_transactions = backend.apply_transactions
+
+    def failing(changes, expected=None, idempotency=None):
+        backend.apply_transactions = apply_transactions
+        raise ShardCrash()
+    backend.apply_transactions = failing
+
+
+class ShardedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bank = self.open_bank()
+        for index in range(4):
+            self.bank.create_account(f"owner {index}", 10000, "pin", {"phone": str(index)})
+
+    def open_bank(self):
+        shards = {name: SQLiteBackend(os.path.join(self.directory, f"{name}.db")) for name in ("a", "b")}
+        backend = ShardedBackend(shards, os.path.join(self.directory, "shards.json"), shard_size=2)
+        return Bank("test", backend=backend, receipt_dir=os.path.join(self.directory, "receipts"))
+
+    def balances(self, bank=None):
+        backend = (bank or self.bank).backend
+        return backend.get_balances([str(acc_no) for acc_no in range(1, 5)])
+
+    def total(self, bank=None):
+        return sum(self.balances(bank).values())
+
+
+class TestTwoPhaseCommit(ShardedTestCase):
+    def test_cross_shard_transfer(self):
+        receipt, message = self.bank.transfer(1, 3, 2500)
+        self.assertEqual(message, "Transfer successful")
+        self.assertEqual(self.balances()["1"], 7500)
+        self.assertEqual(self.balances()["3"], 12500)
+        self.assertEqual(self.bank.backend.directory.read()["intents"], {})
+
+    def test_crash_before_source_shard_then_restart(self):
+        fail_once(self.bank.backend.shards["a"])
+        with self.assertRaises(ShardCrash):
+            self.bank.transfer(1, 3, 2500)
+        self.assertEqual(len(self.bank.backend.directory.read()["intents"]), 1)
+
+        restarted = self.open_bank()
+        self.assertEqual(restarted.backend.directory.read()["intents"], {})
+        self.assertEqual(self.balances(restarted), {"1": 7500, "2": 10000, "3": 12500, "4": 10000})
+
+    def test_crash_after_one_shard_then_write_to_its_account(self):
+        # Shard "a" (source) is written first, "b" (destination) fails
+        fail_once(self.bank.backend.shards["b"])
+        with self.assertRaises(ShardCrash):
+            self.bank.transfer(1, 3, 2500)
+
+        # The account is fenced until the transfer is finished, so the deposit lands on top of it
+        self.bank.find_account(3).deposit(100)
+        self.assertEqual(self.balances(), {"1": 7500, "2": 10000, "3": 12600, "4": 10000})
+
+        restarted = self.open_bank()
+        self.assertEqual(self.total(restarted), 40100)
+        self.assertEqual(len(restarted.backend.get_history("3")), 2)
+
+    def test_write_to_source_after_failed_phase_two(self):
+        fail_once(self.bank.backend.shards["a"])
+        with self.assertRaises(ShardCrash):
+            self.bank.transfer(1, 3, 3000)
+
+        self.bank.find_account(1).deposit(1)
+        restarted = self.open_bank()
+        self.assertEqual(self.balances(restarted), {"1": 7001, "2": 10000, "3": 13000, "4": 10000})
+
+    def test_idempotency_key_after_recovery(self):
+        fail_once(self.bank.backend.shards["b"])
+        with self.assertRaises(ShardCrash):
+            self.bank.transfer(1, 3, 2500, idempotency_key="t1")
+
+        restarted = self.open_bank()
+        result = restarted.transfer(1, 3, 2500, idempotency_key="t1")
+        self.assertEqual(result[1], "Transfer successful")
+        self.assertEqual(self.balances(restarted)["1"], 7500)
+
+
+class TestAddShard(ShardedTestCase):
+    def test_add_shard(self):
+        self.bank.transfer(1, 4, 100)
+        new_shard = SQLiteBackend(os.path.join(self.directory, "c.db"))
+        self.assertEqual(self.bank.backend.add_shard("c", new_shard, 4), "Moved 1 accounts to shard c")
+        self.assertEqual(self.bank.backend.shard_name(4), "c")
+        self.assertEqual(self.balances()["4"], 10100)
+        self.assertEqual(self.bank.backend.shards["b"].account_numbers(), ["3"])
+        self.assertEqual(len(self.bank.backend.get_history("4")), 1)
+
+    def test_add_shard_under_writes(self):
+        stop = threading.Event()
+        results = []
+
+        def transfers():
+            while not stop.is_set():
+                results.append(self.bank.transfer(3, 4, 1))
+                results.append(self.bank.transfer(1, 4, 1))
+
+        writer = threading.Thread(target=transfers)
+        writer.start()
+        try:
+            new_shard = SQLiteBackend(os.path.join(self.directory, "c.db"))
+            self.bank.backend.add_shard("c", new_shard, 4, batch_size=1)
+        finally:
+            stop.set()
+            writer.join()
+
+        succeeded = sum(1 for result in results if isinstance(result, tuple))
+        self.assertTrue(succeeded)
+        self.assertEqual(self.total(), 40000)
+        self.assertEqual(self.balances()["4"], 10000 + succeeded)
+        self.assertEqual(self.bank.backend.account_numbers(), ["1", "2", "3", "4"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import Bank, NO_PIN
+from settlement import SettlementEngine
+from sqlite_backend import SQLiteBackend
+from storage import JournalStore, JsonBackend
+
+SAME_ACCOUNT = "Cannot transfer to the same account"
+
+
+def messages(results):
+    # Receipts carry fresh ids and times, compare what happened
+    return [result[1] if isinstance(result, tuple) else result for result in results]
+
+
+class BankTestCase(unittest.TestCase):
+    accounts = 20
+
+    def open_bank(self):
+        directory = tempfile.mkdtemp()
+        backend = JsonBackend(JournalStore(os.path.join(directory, "users.json")),
+                              JournalStore(os.path.join(directory, "utils.json")))
+        bank = Bank("test", backend=backend, receipt_dir=os.path.join(directory, "receipts"))
+        bank.create_accounts([{"name": f"owner {index}", "initial_deposit": 10000, "pin": "pin",
+                               "contact_info": {"phone": str(index)}} for index in range(self.accounts)], workers=0)
+        return bank
+
+    def balances(self, bank):
+        return bank.backend.get_balances([str(acc_no) for acc_no in range(1, self.accounts + 1)])
+
+
+class TestSelfTransfers(BankTestCase):
+    def setUp(self):
+        self.bank = self.open_bank()
+
+    def test_transfer(self):
+        self.assertEqual(self.bank.transfer(1, 1, 500), SAME_ACCOUNT)
+
+    def test_transfer_many(self):
+        results = self.bank.transfer_many([(1, 1, 500), (1, 2, 500)])
+        self.assertEqual(messages(results), [SAME_ACCOUNT, "Transfer successful"])
+        self.assertEqual(len(self.bank.backend.get_history("1")), 1)
+
+    def test_settle(self):
+        results = self.bank.settle([(1, 1, 500), (1, 2, 500)], workers=0)
+        self.assertEqual(messages(results), [SAME_ACCOUNT, "Transfer successful"])
+        self.assertEqual(len(self.bank.backend.get_history("1")), 1)
+        self.assertEqual(self.balances(self.bank)["1"], 9500)
+
+
+class TestSettlement(BankTestCase):
+    def batch(self, count=500):
+        rng = random.Random(7)
+        transfers = [(rng.randint(1, self.accounts), rng.randint(1, self.accounts), rng.randint(-5, 4000))
+                     for _ in range(count)]
+        return transfers + [(3, 3, 10), (4, 999, 10), (5, 6, 2.5)]
+
+    def assertSameOutcome(self, transfers, settle):
+        serial, settled = self.open_bank(), self.open_bank()
+        expected = serial.transfer_many(transfers)
+        self.assertEqual(messages(settle(settled, transfers)), messages(expected))
+        self.assertEqual(self.balances(settled), self.balances(serial))
+
+    def test_matches_transfer_many(self):
+        self.assertSameOutcome(self.batch(), lambda bank, transfers: bank.settle(transfers, workers=0))
+
+    def test_matches_transfer_many_in_epochs(self):
+        # Partitioned by account parity, local runs first so every epoch has work
+        transfers = sorted(self.batch(), key=lambda transfer: transfer[0] % 2 != transfer[1] % 2)
+        self.assertSameOutcome(transfers, lambda bank, batch: SettlementEngine(
+            bank, workers=2, partitions=2, min_parallel=1).settle(batch))
+
+    def test_pool_not_started_for_small_epochs(self):
+        engine = SettlementEngine(self.open_bank(), workers=2, min_parallel=1000)
+        balances = {str(acc_no): 10000 for acc_no in range(1, self.accounts + 1)}
+        _, epochs = engine._plan(self.batch(2000), balances)
+        self.assertFalse(any(engine._parallel(segments) for segments, _ in epochs))
+
+
+class RestoredPinTests():
+    def test_restored_account_cannot_login_without_pin(self):
+        directory = tempfile.mkdtemp()
+        backend = self.open_backend(directory)
+        bank = Bank("test", backend=backend, receipt_dir=os.path.join(directory, "receipts"))
+        backend.restore_accounts([{"Account Name": "owner", "Account Number": "1", "Balance": 1000,
+                                   "Other info": {}, "Created on": "2024-01-01 09:00:00"}])
+
+        self.assertEqual(bank.login(1, ""), (NO_PIN, None))
+        self.assertEqual(bank.authenticate(1, None), NO_PIN)
+        self.assertEqual(bank.find_account(1).change_pin(None, "1234"), NO_PIN)
+
+        backend.set_pin("1", "hash")
+        self.assertEqual(bank.login(1, "hash")[0], "Login successful")
+
+
+class TestJsonRestoredPin(RestoredPinTests, unittest.TestCase):
+    def open_backend(self, directory):
+        return JsonBackend(JournalStore(os.path.join(directory, "users.json")),
+                           JournalStore(os.path.join(directory, "utils.json")))
+
+
+class TestSQLiteRestoredPin(RestoredPinTests, unittest.TestCase):
+    def open_backend(self, directory):
+        return SQLiteBackend(os.path.join(directory, "bank.db"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,386 @@
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import datetime
+
+'''
+Columnar storage for transactions
+
+Instead of one object (or tuple) per transaction, every field is kept in its
+own typed array. A transaction costs roughly 100 bytes instead of several
+hundred, and filters and totals run over whole columns. Amounts and balances
+are integer minor units (see money.py), so totals are exact. Time stamps are
+kept as the stored text and only parsed, in one pass, by the first time query.
+'''
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+TYPE_CODES = {"Deposit": 0, "Withdraw": 1, "Transfer": 2}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# Account numbers start at 1, so 0 stands for "no destination"
+NO_ACCOUNT = 0
+
+_numpy = False
+
+
+def load_numpy():
+    '''
+    load_numpy: numpy if it is installed, imported on first use to keep imports fast
+
+    returns the numpy module or None
+    '''
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = None
+    return _numpy
+
+
+def to_epoch(timestamp):
+    '''
+    to_epoch: Converts a datetime or a "%Y-%m-%d %H:%M:%S" string to epoch seconds
+    '''
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    if isinstance(timestamp, str):
+        # Reads TIME_FORMAT several times faster than strptime
+        timestamp = datetime.fromisoformat(timestamp)
+    return timestamp.timestamp()
+
+
+def signed_amount(acc_no, entry):
+    '''
+    signed_amount: How much a stored history entry changed the balance of acc_no
+    '''
+    _, _, transaction_type, amount, source = entry[:5]
+    if transaction_type == "Withdraw":
+        return -amount
+    if transaction_type == "Transfer" and str(source) == str(acc_no):
+        return -amount
+    return amount
+
+
+class TransactionLog():
+    def __init__(self):
+        '''
+        TransactionLog: Append-only, column per field list of transactions
+
+        Columns: transaction id, timestamp (stored text, see timestamps), type code,
+        amount, source account, destination account and ending balance
+        '''
+        self._ids = bytearray()
+        self._id_ends = array("Q")
+        self._times = bytearray()
+        self._time_ends = array("Q")
+        self._epochs = array("d")
+        self._parse_lock = threading.Lock()
+        self.type_codes = array("B")
+        self.amounts = array("q")
+        self.sources = array("q")
+        self.destinations = array("q")
+        self.ending_balances = array("q")
+
+    @classmethod
+    def from_entries(cls, entries):
+        '''
+        from_entries: Builds a log from Transactions or stored history entries
+        '''
+        log = cls()
+        if entries is not None:
+            log.extend(entries)
+        return log
+
+    # Adding transactions
+    def append(self, transaction):
+        '''
+        append: Adds a Transaction, or a stored entry
+        [id, timestamp, type, amount, source, ending balance, destination]
+        '''
+        if isinstance(transaction, (list, tuple)):
+            transaction_id, timestamp, transaction_type, amount, source, ending_balance, destination = \
+                (list(transaction) + [None])[:7]
+        else:
+            transaction_id = transaction.transaction_id
+            timestamp = transaction.timestamp
+            transaction_type = transaction.transaction_type
+            amount = transaction.amount
+            source = transaction.source_account
+            ending_balance = transaction.ending_balance
+            destination = transaction.destination_account
+
+        self._ids.extend(str(transaction_id).encode())
+        self._id_ends.append(len(self._ids))
+        if isinstance(timestamp, (int, float)):
+            timestamp = datetime.fromtimestamp(timestamp)
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.strftime(TIME_FORMAT)
+        self._times.extend(timestamp.encode())
+        self._time_ends.append(len(self._times))
+        self.type_codes.append(TYPE_CODES[transaction_type])
+        self.amounts.append(amount)
+        self.sources.append(int(source))
+        self.destinations.append(int(destination) if destination is not None else NO_ACCOUNT)
+        self.ending_balances.append(ending_balance)
+
+    def extend(self, transactions):
+        for transaction in transactions:
+            self.append(transaction)
+
+    # Reading transactions
+    def __len__(self):
+        return len(self.type_codes)
+
+    def transaction_id(self, index):
+        start = self._id_ends[index - 1] if index > 0 else 0
+        return self._ids[start:self._id_ends[index]].decode()
+
+    def time_stamp(self, index):
+        start = self._time_ends[index - 1] if index > 0 else 0
+        return self._times[start:self._time_ends[index]].decode()
+
+    @property
+    def timestamps(self):
+        '''
+        timestamps: Epoch seconds of every transaction
+
+        Parsed on first use, later calls only parse the transactions added since
+
+        returns array of floats
+        '''
+        with self._parse_lock:
+            parsed = len(self._epochs)
+            if parsed < len(self):
+                self._epochs.extend(to_epoch(self.time_stamp(index)) for index in range(parsed, len(self)))
+            return self._epochs
+
+    def entry(self, index):
+        '''
+        entry: The transaction at index in the stored history format
+
+        returns list
+        '''
+        if index < 0:
+            index += len(self)
+        destination = self.destinations[index]
+        return [
+            self.transaction_id(index),
+            self.time_stamp(index),
+            TYPE_NAMES[self.type_codes[index]],
+            self.amounts[index],
+            self.sources[index],
+            self.ending_balances[index],
+            destination if destination != NO_ACCOUNT else None
+        ]
+
+    def __getitem__(self, index):
+        return self.entry(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.entry(index)
+
+    def to_entries(self):
+        return list(self)
+
+    def __repr__(self):
+        return f"TransactionLog({len(self)} transactions)"
+
+    # Filtering and aggregation
+    def mask(self, types=None, since=None, until=None, account=None):
+        '''
+        mask: Marks the transactions matching every given filter
+
+        Args:
+            types(list): Transaction types to keep
+
+            since, until(datetime or str): Inclusive time range
+
+            account(int): Keep transactions where this account is the source or destination
+
+        returns a list of booleans, or a numpy array when numpy is installed
+        '''
+        np = load_numpy()
+        if np is not None:
+            keep = np.ones(len(self), dtype=bool)
+            if types is not None:
+                keep &= np.isin(np.frombuffer(self.type_codes, dtype=np.uint8),
+                                [TYPE_CODES[name] for name in types])
+            if since is not None or until is not None:
+                timestamps = np.frombuffer(self.timestamps, dtype=np.float64)
+                if since is not None:
+                    keep &= timestamps >= to_epoch(since)
+                if until is not None:
+                    keep &= timestamps <= to_epoch(until)
+            if account is not None:
+                keep &= ((np.frombuffer(self.sources, dtype=np.int64) == account)
+                         | (np.frombuffer(self.destinations, dtype=np.int64) == account))
+            return keep
+
+        codes = {TYPE_CODES[name] for name in types} if types is not None else None
+        since = to_epoch(since) if since is not None else None
+        until = to_epoch(until) if until is not None else None
+        timestamps = self.timestamps if since is not None or until is not None else [None] * len(self)
+        return [
+            (codes is None or code in codes)
+            and (since is None or timestamp >= since)
+            and (until is None or timestamp <= until)
+            and (account is None or source == account or destination == account)
+            for code, timestamp, source, destination in zip(
+                self.type_codes, timestamps, self.sources, self.destinations)
+        ]
+
+    def select(self, mask):
+        '''
+        select: A new log holding only the transactions where mask is true
+        '''
+        log = TransactionLog()
+        for index, keep in enumerate(mask):
+            if keep:
+                log.append(self.entry(index))
+        return log
+
+    def total(self, mask=None):
+        '''
+        total: Sum of the amounts, optionally only where mask is true
+        '''
+        np = load_numpy()
+        if np is not None:
+            amounts = np.frombuffer(self.amounts, dtype=np.int64)
+            return int(amounts[mask].sum() if mask is not None else amounts.sum())
+        if mask is None:
+            return sum(self.amounts)
+        return sum(amount for amount, keep in zip(self.amounts, mask) if keep)
+
+    def totals_by_type(self):
+        '''
+        totals_by_type: Sum of the amounts for each transaction type
+
+        returns dict of type name to total
+        '''
+        np = load_numpy()
+        if np is not None:
+            codes = np.frombuffer(self.type_codes, dtype=np.uint8)
+            amounts = np.frombuffer(self.amounts, dtype=np.int64)
+            return {name: int(amounts[codes == code].sum()) for name, code in TYPE_CODES.items()}
+        totals = {name: 0 for name in TYPE_CODES}
+        for code, amount in zip(self.type_codes, self.amounts):
+            totals[TYPE_NAMES[code]] += amount
+        return totals
+
+
+class BalanceIndex():
+    def __init__(self, acc_no, created=None, balance=0, page_size=256):
+        '''
+        BalanceIndex: Ending balance after every transaction of one account, sorted by time
+
+        Answers balance_at by bisection. The index remembers where in the stored
+        history it stopped, so catch_up only reads the entries recorded since.
+
+        Args:
+            acc_no: Account number
+
+            created(float): Epoch seconds the account was created at, None if unknown
+
+            balance: Balance of the account when it has no history yet
+
+            page_size(int): History entries read at a time
+        '''
+        self.acc_no = str(acc_no)
+        self.created = created
+        self.opening = balance
+        self.page_size = page_size
+        self.timestamps = array("d")
+        self.balances = array("q")
+        self.version = None
+        # Start of the last page read, how many of its entries are indexed and the last id
+        self._position = None
+        self._skip = 0
+        self._last_id = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, backend, acc_no, page_size=256):
+        '''
+        build: Indexes the whole stored history of an account
+
+        returns BalanceIndex, or None if the account does not exist
+        '''
+        record = backend.get_account(acc_no)
+        if record is None:
+            return None
+        try:
+            created = to_epoch(record["Created on"])
+        except (TypeError, ValueError):
+            created = None
+        index = cls(acc_no, created, record["Balance"], page_size)
+        index.catch_up(backend)
+        return index
+
+    def refresh(self, backend, version):
+        '''
+        refresh: Catches up unless the index already reflects version of the account
+
+        returns False if the index has to be built again
+        '''
+        with self._lock:
+            if self.version == version:
+                return True
+            if not self.catch_up(backend):
+                return False
+            self.version = version
+            return True
+
+    def append(self, entry):
+        '''
+        append: Adds a stored history entry, out of order time stamps are inserted in place
+        '''
+        timestamp = to_epoch(entry[1])
+        if not self.timestamps:
+            self.opening = entry[5] - signed_amount(self.acc_no, entry)
+        position = len(self.timestamps)
+        if position and timestamp < self.timestamps[-1]:
+            position = bisect_right(self.timestamps, timestamp)
+        self.timestamps.insert(position, timestamp)
+        self.balances.insert(position, entry[5])
+        self._last_id = str(entry[0])
+
+    def catch_up(self, backend):
+        '''
+        catch_up: Indexes the history entries recorded since the last call, see refresh
+
+        returns False if the stored history was rewritten and the index has to be built again
+        '''
+        position, skip = self._position, self._skip
+        while True:
+            entries, next_position = backend.page_history(self.acc_no, position, self.page_size)
+            if len(entries) < skip or (skip and str(entries[skip - 1][0]) != self._last_id):
+                return False
+            for entry in entries[skip:]:
+                self.append(entry)
+            if next_position is None:
+                self._position, self._skip = position, len(entries)
+                return True
+            position, skip = next_position, 0
+
+    def balance_at(self, timestamp):
+        '''
+        balance_at: The balance right after the last transaction at or before timestamp
+
+        Args:
+            timestamp(datetime, str or float): Point in time
+
+        returns the balance, or None if the account did not exist yet
+        '''
+        timestamp = to_epoch(timestamp)
+        if self.created is not None and timestamp < self.created:
+            return None
+        with self._lock:
+            position = bisect_right(self.timestamps, timestamp)
+            return self.balances[position - 1] if position else self.opening
+
+    def __len__(self):
+        return len(self.timestamps)